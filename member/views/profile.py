@@ -154,7 +154,7 @@ def profile_activity(request, username):
 @login_required
 def profile_billing(request, username):
     user = get_object_or_404(User, username=username)
-    bills = UserBill.objects.filter(user=user).order_by('-due_date')[:12]
+    bills = UserBill.objects.with_details().filter(user=user).order_by('-due_date')[:12]
     context = {
         'user': user,
         'bills': bills,
@@ -2,8 +2,10 @@ from django.contrib import admin
 
 from nadine.admin.core import StyledAdmin
 from nadine.models.billing import BillingBatch, UserBill, BillLineItem
-from nadine.models.billing import Payment, PaymentMethod
+from nadine.models.billing import Payment, PaymentMethod, BillingEvent
 from nadine.models.billing import TaxRate, LineItemTax
+from nadine.models.billing import XeroInvoice, XeroSync
+from nadine.models.billing import USAePayTransaction, USAePayCustomer
 
 
 class BillLineItemInline(admin.TabularInline):
@@ -74,8 +76,62 @@ class BillingBatchAdmin(StyledAdmin):
     readonly_fields = ('id', bills, 'created_ts', 'created_by', 'completed_ts', 'error')
 
 
+class XeroSyncAdmin(StyledAdmin):
+    model = XeroSync
+    date_hierarchy = 'created_ts'
+    list_display = ('id', 'created_ts', 'completed_ts', 'successful', 'contacts_linked', 'invoices_updated', 'bills_pushed')
+    readonly_fields = ('created_ts', 'created_by', 'completed_ts', 'since', 'contacts_linked', 'invoices_updated', 'bills_pushed', 'error')
+
+
+class XeroInvoiceAdmin(StyledAdmin):
+    model = XeroInvoice
+    list_display = ('invoice_number', 'user', 'date', 'status', 'total', 'amount_due', 'updated_ts')
+    list_filter = ('status', )
+    search_fields = ('invoice_number', 'user__username')
+    raw_id_fields = ('user', 'bill')
+
+
+class USAePayTransactionAdmin(StyledAdmin):
+    model = USAePayTransaction
+    date_hierarchy = 'date_time'
+    list_display = ('transaction_id', 'username', 'date_time', 'transaction_type', 'card_type', 'status', 'amount')
+    list_filter = ('status', 'transaction_type', 'card_type')
+    search_fields = ('transaction_id', 'username')
+    raw_id_fields = ('user', )
+
+
+class USAePayCustomerAdmin(StyledAdmin):
+    model = USAePayCustomer
+    list_display = ('customer_number', 'username', 'enabled', 'next_date', 'amount')
+    list_filter = ('enabled', )
+    search_fields = ('customer_number', 'username')
+    raw_id_fields = ('user', )
+
+
+class BillingEventAdmin(StyledAdmin):
+    model = BillingEvent
+    date_hierarchy = 'created_ts'
+    list_display = ('created_ts', 'bill_id', 'source', 'action', 'description', 'amount_before', 'amount_after')
+    list_filter = ('source', 'action')
+    search_fields = ('bill__id', 'description')
+
+    def has_add_permission(self, request):
+        return False
+
+    def has_change_permission(self, request, obj=None):
+        return False
+
+    def has_delete_permission(self, request, obj=None):
+        return False
+
+
 admin.site.register(BillingBatch, BillingBatchAdmin)
 admin.site.register(UserBill, UserBillAdmin)
 admin.site.register(PaymentMethod, PaymentMethodAdmin)
 admin.site.register(TaxRate, TaxRateAdmin)
 admin.site.register(LineItemTax, LineItemTaxAdmin)
+admin.site.register(XeroSync, XeroSyncAdmin)
+admin.site.register(XeroInvoice, XeroInvoiceAdmin)
+admin.site.register(USAePayTransaction, USAePayTransactionAdmin)
+admin.site.register(USAePayCustomer, USAePayCustomerAdmin)
+admin.site.register(BillingEvent, BillingEventAdmin)
@@ -1,7 +1,11 @@
 
+import csv
+import json
+import sys
 from datetime import datetime
 
-from django.core.management.base import BaseCommand
+from django.core.management.base import BaseCommand, CommandError
+from django.core.serializers.json import DjangoJSONEncoder
 
 from nadine.models.billing import BillingBatch, UserBill
 
@@ -28,9 +32,37 @@ class Command(BaseCommand):
             default=None,
             help='End date for batch run',
         )
+        parser.add_argument(
+            '--bulk',
+            action='store_true',
+            dest='bulk',
+            default=None,
+            help='Run the whole range in memory and save with bulk queries',
+        )
+        parser.add_argument(
+            '--shards',
+            type=int,
+            default=None,
+            help='Split the payers in to this many shards and run them in parallel',
+        )
+        parser.add_argument(
+            '--dry-run',
+            action='store_true',
+            dest='dry-run',
+            default=False,
+            help='Calculate the bills and print what would change without saving anything',
+        )
+        parser.add_argument(
+            '--format',
+            choices=['json', 'csv'],
+            default='json',
+            help='Output format for --dry-run',
+        )
 
     def handle(self, *args, **options):
         start_date = end_date = None
+        if options['dry-run'] and options['delete-open']:
+            raise CommandError("--delete-open can not be used with --dry-run")
         if options['delete-open']:
             open_bills = UserBill.objects.open().order_by('period_start')
             if open_bills:
@@ -46,10 +78,36 @@ class Command(BaseCommand):
         if options['end']:
             end_date = datetime.strptime(options['end'], "%Y-%m-%d").date()
 
+        if options['dry-run']:
+            preview = BillingBatch.objects.preview(start_date, end_date)
+            if options['format'] == 'csv':
+                self.write_csv(preview)
+            else:
+                print(json.dumps(preview, cls=DjangoJSONEncoder, indent=2))
+            return
+
         print("Running Batch: start=%s end=%s" % (start_date, end_date))
-        batch = BillingBatch.objects.run(start_date, end_date)
+        batch = BillingBatch.objects.run(start_date, end_date, bulk=options['bulk'], shards=options['shards'])
         print("%d Bills" % batch.bills.count())
 
+    def write_csv(self, preview):
+        writer = csv.writer(sys.stdout)
+        writer.writerow(['bill_id', 'username', 'status', 'period_start', 'period_end', 'amount_before', 'amount_after', 'added', 'changed', 'removed'])
+        for row in preview:
+            actions = [i['action'] for i in row['line_items']]
+            writer.writerow([
+                row['bill_id'] or '',
+                row['username'],
+                row['status'],
+                row['period_start'],
+                row['period_end'],
+                '' if row['amount_before'] is None else row['amount_before'],
+                row['amount_after'],
+                actions.count('added'),
+                actions.count('changed'),
+                actions.count('removed'),
+            ])
+
 
 # Copyright 2021 Office Nomads LLC (https://officenomads.com/) Licensed under the AGPL License, Version 3.0 (the "License"); you may not use this file except in compliance with the License. You may obtain a copy of the License at https://www.gnu.org/licenses/agpl-3.0.html. Unless required by applicable law or agreed to in writing, software distributed under the License is distributed on an "AS IS" BASIS, WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the License for the specific language governing permissions and limitations under the License.
 
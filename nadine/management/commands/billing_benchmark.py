@@ -0,0 +1,78 @@
+from django.db import transaction
+from django.test import override_settings
+from django.core.management.base import BaseCommand
+
+from nadine.utils.benchmark import SyntheticDataset, BillingBenchmark
+
+
+class Rollback(Exception):
+    pass
+
+
+class Command(BaseCommand):
+    help = "Generates a synthetic coworking space and times billing and stats against it."
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--members',
+            type=int,
+            default=200,
+            help='Number of members to create',
+        )
+        parser.add_argument(
+            '--organizations',
+            type=int,
+            default=10,
+            help='Number of organizations to create',
+        )
+        parser.add_argument(
+            '--months',
+            type=int,
+            default=12,
+            help='Months of activity to create',
+        )
+        parser.add_argument(
+            '--seed',
+            type=int,
+            default=1,
+            help='Random seed for the generated data',
+        )
+        parser.add_argument(
+            '--bulk',
+            action='store_true',
+            dest='bulk',
+            default=False,
+            help='Use the bulk billing engine',
+        )
+        parser.add_argument(
+            '--keep',
+            action='store_true',
+            dest='keep',
+            default=False,
+            help='Keep the generated data instead of rolling it back',
+        )
+
+    def handle(self, *args, **options):
+        try:
+            with override_settings(SUSPEND_MEMBER_ALERTS=True), transaction.atomic():
+                print("Generating %d members, %d organizations, %d months..." % (options['members'], options['organizations'], options['months']))
+                dataset = SyntheticDataset(
+                    members=options['members'],
+                    organizations=options['organizations'],
+                    months=options['months'],
+                    seed=options['seed'],
+                ).generate()
+
+                benchmark = BillingBenchmark(dataset, bulk=options['bulk'])
+                results = benchmark.run()
+                print("%-40s %10s %10s" % ("Operation", "Seconds", "Queries"))
+                for result in results:
+                    print("%-40s %10.3f %10d" % result)
+
+                if not options['keep']:
+                    raise Rollback()
+        except Rollback:
+            print("Rolled back generated data")
+
+
+# Copyright 2021 Office Nomads LLC (https://officenomads.com/) Licensed under the AGPL License, Version 3.0 (the "License"); you may not use this file except in compliance with the License. You may obtain a copy of the License at https://www.gnu.org/licenses/agpl-3.0.html. Unless required by applicable law or agreed to in writing, software distributed under the License is distributed on an "AS IS" BASIS, WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the License for the specific language governing permissions and limitations under the License.
@@ -0,0 +1,50 @@
+from django.core.management.base import BaseCommand, CommandError
+
+from nadine.models.billing import UserBill, BillingEvent
+
+
+class Command(BaseCommand):
+    help = "Shows the history of a bill or checks the bills against the billing journal."
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--bill',
+            type=int,
+            default=None,
+            help='Show every event for this bill',
+        )
+        parser.add_argument(
+            '--verify',
+            action='store_true',
+            dest='verify',
+            default=False,
+            help='Compare the line items and cached totals to what the journal says they should be',
+        )
+
+    def handle(self, *args, **options):
+        if not options['bill'] and not options['verify']:
+            raise CommandError("Nothing to do!  Use --bill or --verify")
+
+        if options['bill']:
+            events = BillingEvent.objects.for_bill(options['bill']).select_related('created_by')
+            for event in events:
+                who = event.source
+                if event.batch_id:
+                    who = "batch %d" % event.batch_id
+                elif event.created_by:
+                    who = event.created_by.username
+                print("%s %-16s %-12s %s: %s -> %s" % (event.created_ts.strftime("%Y-%m-%d %H:%M"), event.action, who, event.description, event.amount_before, event.amount_after))
+
+        if options['verify']:
+            bills = None
+            if options['bill']:
+                bills = UserBill.objects.filter(id=options['bill'])
+            mismatches = BillingEvent.objects.verify(bills)
+            for m in mismatches:
+                print("UserBill %d: journal $%s, line items $%s, cached $%s, missing %s, changed %s" % (m['bill_id'], m['journal_amount'], m['actual_amount'], m['cached_amount'], m['missing'], m['changed']))
+            if mismatches:
+                raise CommandError("%d bills do not match the journal" % len(mismatches))
+            print("All bills match the journal")
+
+
+# Copyright 2021 Office Nomads LLC (https://officenomads.com/) Licensed under the AGPL License, Version 3.0 (the "License"); you may not use this file except in compliance with the License. You may obtain a copy of the License at https://www.gnu.org/licenses/agpl-3.0.html. Unless required by applicable law or agreed to in writing, software distributed under the License is distributed on an "AS IS" BASIS, WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the License for the specific language governing permissions and limitations under the License.
@@ -0,0 +1,78 @@
+import sys
+from datetime import datetime
+
+from django.core.management.base import BaseCommand, CommandError
+
+from nadine.utils.billing_export import EXPORT_COLUMNS, export_stream, export_filename
+
+
+class Command(BaseCommand):
+    help = "Exports bills, line items, taxes or payments for a date range as CSV or XLSX."
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            'export',
+            choices=list(EXPORT_COLUMNS.keys()),
+            help='What to export',
+        )
+        parser.add_argument(
+            'start',
+            help='Start date (YYYY-MM-DD)',
+        )
+        parser.add_argument(
+            'end',
+            help='End date (YYYY-MM-DD)',
+        )
+        parser.add_argument(
+            '--columns',
+            default=None,
+            help='Comma separated list of columns (defaults to all of them)',
+        )
+        parser.add_argument(
+            '--format',
+            choices=['csv', 'xlsx'],
+            default='csv',
+            help='File format (xlsx requires openpyxl)',
+        )
+        parser.add_argument(
+            '--gzip',
+            action='store_true',
+            dest='gzip',
+            default=False,
+            help='Compress the output with gzip',
+        )
+        parser.add_argument(
+            '--output',
+            default=None,
+            help='File to write to, "-" for stdout (defaults to a generated file name)',
+        )
+
+    def handle(self, *args, **options):
+        try:
+            start_date = datetime.strptime(options['start'], "%Y-%m-%d").date()
+            end_date = datetime.strptime(options['end'], "%Y-%m-%d").date()
+        except ValueError as e:
+            raise CommandError("Invalid date: %s" % e)
+        columns = None
+        if options['columns']:
+            columns = [c.strip() for c in options['columns'].split(',') if c.strip()]
+
+        export = options['export']
+        try:
+            stream = export_stream(export, start_date, end_date, columns=columns, format=options['format'], gzip=options['gzip'])
+        except Exception as e:
+            raise CommandError(str(e))
+
+        output = options['output'] or export_filename(export, start_date, end_date, options['format'], options['gzip'])
+        if output == '-':
+            for chunk in stream:
+                sys.stdout.buffer.write(chunk)
+            sys.stdout.buffer.flush()
+        else:
+            with open(output, 'wb') as f:
+                for chunk in stream:
+                    f.write(chunk)
+            print("Exported %s to %s" % (export, output))
+
+
+# Copyright 2021 Office Nomads LLC (https://officenomads.com/) Licensed under the AGPL License, Version 3.0 (the "License"); you may not use this file except in compliance with the License. You may obtain a copy of the License at https://www.gnu.org/licenses/agpl-3.0.html. Unless required by applicable law or agreed to in writing, software distributed under the License is distributed on an "AS IS" BASIS, WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the License for the specific language governing permissions and limitations under the License.
@@ -0,0 +1,68 @@
+from datetime import datetime
+
+from django.core.management.base import BaseCommand, CommandError
+from django.contrib.auth.models import User
+
+from nadine.models.membership import MembershipPackage
+from nadine.models.package_migration import PackageMigration
+
+
+class Command(BaseCommand):
+    help = "Moves every membership on one package to another package (or to the current rates of the same package)"
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            'from_package',
+            help='Name of the package the memberships are on now',
+        )
+        parser.add_argument(
+            '--to',
+            default=None,
+            help='Name of the package to move them to (defaults to the same package with its current rates)',
+        )
+        parser.add_argument(
+            '--date',
+            default=None,
+            help='First day on the new package (defaults to today)',
+        )
+        parser.add_argument(
+            '--created-by',
+            default=None,
+            help='Username to record on the new subscriptions',
+        )
+        parser.add_argument(
+            '--dry-run',
+            action='store_true',
+            dest='dry-run',
+            default=False,
+            help='Print the changes without saving anything',
+        )
+
+    def handle(self, *args, **options):
+        change_date = created_by = None
+        try:
+            if options['date']:
+                change_date = datetime.strptime(options['date'], "%Y-%m-%d").date()
+            if options['created_by']:
+                created_by = User.objects.get(username=options['created_by'])
+            migration = PackageMigration(options['from_package'], options['to'], change_date, created_by)
+        except ValueError as e:
+            raise CommandError("Invalid date: %s" % e)
+        except (User.DoesNotExist, MembershipPackage.DoesNotExist) as e:
+            raise CommandError(e)
+
+        changes = migration.plan()
+        for change in changes:
+            print(change)
+        if options['dry-run']:
+            print("%d memberships would move to %s on %s" % (len(changes), migration.to_package, migration.change_date))
+            return
+
+        try:
+            migration.apply()
+        except Exception as e:
+            raise CommandError(e)
+        print("%d memberships moved to %s on %s" % (len(changes), migration.to_package, migration.change_date))
+
+
+# Copyright 2021 Office Nomads LLC (https://officenomads.com/) Licensed under the AGPL License, Version 3.0 (the "License"); you may not use this file except in compliance with the License. You may obtain a copy of the License at https://www.gnu.org/licenses/agpl-3.0.html. Unless required by applicable law or agreed to in writing, software distributed under the License is distributed on an "AS IS" BASIS, WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the License for the specific language governing permissions and limitations under the License.
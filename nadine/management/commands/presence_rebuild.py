@@ -0,0 +1,46 @@
+from datetime import datetime, timedelta
+
+from django.core.management.base import BaseCommand, CommandError
+from django.utils.timezone import localtime, now
+
+from nadine.models.presence import PresenceSession
+
+
+class Command(BaseCommand):
+    help = "Recreates the presence sessions for a range of days from the arp logs, door events and coworking days"
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--start',
+            default=None,
+            help='First day to rebuild (defaults to 30 days ago)',
+        )
+        parser.add_argument(
+            '--end',
+            default=None,
+            help='Last day to rebuild (defaults to today)',
+        )
+        parser.add_argument(
+            '--chunk-days',
+            type=int,
+            default=30,
+            help='Number of days to rebuild at a time',
+        )
+
+    def handle(self, *args, **options):
+        today = localtime(now()).date()
+        try:
+            start_date = datetime.strptime(options['start'], "%Y-%m-%d").date() if options['start'] else today - timedelta(days=30)
+            end_date = datetime.strptime(options['end'], "%Y-%m-%d").date() if options['end'] else today
+        except ValueError as e:
+            raise CommandError("Invalid date: %s" % e)
+
+        chunk_start = start_date
+        while chunk_start <= end_date:
+            chunk_end = min(chunk_start + timedelta(days=options['chunk_days'] - 1), end_date)
+            count = PresenceSession.objects.rebuild(chunk_start, chunk_end)
+            print("Rebuilt %d sessions from %s to %s" % (count, chunk_start, chunk_end))
+            chunk_start = chunk_end + timedelta(days=1)
+
+
+# Copyright 2021 Office Nomads LLC (https://officenomads.com/) Licensed under the AGPL License, Version 3.0 (the "License"); you may not use this file except in compliance with the License. You may obtain a copy of the License at https://www.gnu.org/licenses/agpl-3.0.html. Unless required by applicable law or agreed to in writing, software distributed under the License is distributed on an "AS IS" BASIS, WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the License for the specific language governing permissions and limitations under the License.
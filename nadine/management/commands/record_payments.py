@@ -0,0 +1,69 @@
+import os
+
+from django.core.management.base import BaseCommand, CommandError
+from django.contrib.auth.models import User
+
+from nadine.models.billing import Payment, read_payment_rows
+
+
+class Command(BaseCommand):
+    help = "Records a batch of payments from a CSV or JSON file."
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            'file',
+            help='CSV or JSON file with bill, amount, method, external_id, payment_date and note',
+        )
+        parser.add_argument(
+            '--format',
+            choices=['json', 'csv'],
+            default=None,
+            help='File format (defaults to the file extension)',
+        )
+        parser.add_argument(
+            '--created-by',
+            dest='created-by',
+            default=None,
+            help='Username to record the payments as',
+        )
+        parser.add_argument(
+            '--dry-run',
+            action='store_true',
+            dest='dry-run',
+            default=False,
+            help='Validate the payments without recording them',
+        )
+
+    def handle(self, *args, **options):
+        file_format = options['format']
+        if not file_format:
+            file_format = "json" if os.path.splitext(options['file'])[1].lower() == ".json" else "csv"
+        created_by = None
+        if options['created-by']:
+            created_by = User.objects.filter(username=options['created-by']).first()
+            if not created_by:
+                raise CommandError("User '%s' not found" % options['created-by'])
+
+        with open(options['file']) as f:
+            try:
+                rows = read_payment_rows(f.read(), file_format)
+            except Exception as e:
+                raise CommandError("Could not read %s: %s" % (options['file'], e))
+
+        if options['dry-run']:
+            results = Payment.objects.validate_payments(rows)
+        else:
+            results = Payment.objects.record_payments(rows, created_by=created_by)
+
+        for result in results:
+            if 'error' in result:
+                print("Row %d: ERROR %s" % (result['row'], result['error']))
+            elif options['dry-run']:
+                print("Row %d: Bill %s $%s OK" % (result['row'], result['bill'], result['payment'].amount))
+            else:
+                print("Row %d: Bill %s $%s recorded (Payment %d)" % (result['row'], result['bill'], result['payment'].amount, result['payment'].id))
+        errors = len([r for r in results if 'error' in r])
+        print("%d payments %s, %d errors" % (len(results) - errors, "valid" if options['dry-run'] else "recorded", errors))
+
+
+# Copyright 2021 Office Nomads LLC (https://officenomads.com/) Licensed under the AGPL License, Version 3.0 (the "License"); you may not use this file except in compliance with the License. You may obtain a copy of the License at https://www.gnu.org/licenses/agpl-3.0.html. Unless required by applicable law or agreed to in writing, software distributed under the License is distributed on an "AS IS" BASIS, WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the License for the specific language governing permissions and limitations under the License.
@@ -0,0 +1,48 @@
+from datetime import datetime, timedelta
+
+from django.core.management.base import BaseCommand, CommandError
+from django.utils.timezone import localtime, now
+
+from nadine.models.stats import DailyStats
+
+
+class Command(BaseCommand):
+    help = "Recalculates the daily stats for every day in a range"
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--start',
+            default=None,
+            help='First day to calculate (defaults to the first subscription or coworking day)',
+        )
+        parser.add_argument(
+            '--end',
+            default=None,
+            help='Last day to calculate (defaults to today)',
+        )
+        parser.add_argument(
+            '--chunk-days',
+            type=int,
+            default=365,
+            help='Number of days to calculate at a time',
+        )
+
+    def handle(self, *args, **options):
+        try:
+            start_date = datetime.strptime(options['start'], "%Y-%m-%d").date() if options['start'] else DailyStats.objects.first_day()
+            end_date = datetime.strptime(options['end'], "%Y-%m-%d").date() if options['end'] else localtime(now()).date()
+        except ValueError as e:
+            raise CommandError("Invalid date: %s" % e)
+        if start_date is None:
+            print("Nothing to calculate")
+            return
+
+        chunk_start = start_date
+        while chunk_start <= end_date:
+            chunk_end = min(chunk_start + timedelta(days=options['chunk_days'] - 1), end_date)
+            DailyStats.objects.refresh(chunk_start, chunk_end)
+            print("Calculated %s to %s" % (chunk_start, chunk_end))
+            chunk_start = chunk_end + timedelta(days=1)
+
+
+# Copyright 2021 Office Nomads LLC (https://officenomads.com/) Licensed under the AGPL License, Version 3.0 (the "License"); you may not use this file except in compliance with the License. You may obtain a copy of the License at https://www.gnu.org/licenses/agpl-3.0.html. Unless required by applicable law or agreed to in writing, software distributed under the License is distributed on an "AS IS" BASIS, WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the License for the specific language governing permissions and limitations under the License.
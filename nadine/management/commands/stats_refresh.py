@@ -0,0 +1,14 @@
+from django.core.management.base import BaseCommand
+
+from nadine.models.stats import DailyStats
+
+
+class Command(BaseCommand):
+    help = "Recalculates the daily stats for recent days and any days changed since the last run"
+
+    def handle(self, *args, **options):
+        refreshed = DailyStats.objects.refresh_stale()
+        print("Refreshed daily stats for %d days" % refreshed)
+
+
+# Copyright 2021 Office Nomads LLC (https://officenomads.com/) Licensed under the AGPL License, Version 3.0 (the "License"); you may not use this file except in compliance with the License. You may obtain a copy of the License at https://www.gnu.org/licenses/agpl-3.0.html. Unless required by applicable law or agreed to in writing, software distributed under the License is distributed on an "AS IS" BASIS, WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the License for the specific language governing permissions and limitations under the License.
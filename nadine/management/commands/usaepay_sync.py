@@ -0,0 +1,57 @@
+from datetime import datetime, timedelta
+
+from django.core.management.base import BaseCommand, CommandError
+from django.utils.timezone import localtime, now
+
+from nadine.models.billing import USAePayTransaction, USAePayCustomer
+from nadine.utils.payment_api import PaymentAPI
+
+
+class Command(BaseCommand):
+    help = "Pulls transactions and customers from USAePay and reconciles them with outstanding bills."
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--date',
+            default=None,
+            help='Last day to pull (defaults to today)',
+        )
+        parser.add_argument(
+            '--days',
+            type=int,
+            default=2,
+            help='Number of days to pull ending on --date',
+        )
+        parser.add_argument(
+            '--skip-customers',
+            action='store_true',
+            dest='skip-customers',
+            default=False,
+            help='Only pull transactions',
+        )
+
+    def handle(self, *args, **options):
+        end_date = localtime(now()).date()
+        if options['date']:
+            try:
+                end_date = datetime.strptime(options['date'], "%Y-%m-%d").date()
+            except ValueError as e:
+                raise CommandError("Invalid date: %s" % e)
+
+        api = PaymentAPI()
+        if not api.enabled:
+            raise CommandError("USAePay is not configured")
+
+        for i in reversed(range(options['days'])):
+            day = end_date - timedelta(days=i)
+            count = USAePayTransaction.objects.sync_day(day, api)
+            transactions = USAePayTransaction.objects.reconcile(USAePayTransaction.objects.for_day(day))
+            matched = len([t for t in transactions if t.bill_match])
+            print("%s: %d transactions, %d matched to a bill" % (day, count, matched))
+
+        if not options['skip-customers']:
+            count = USAePayCustomer.objects.sync(api=api)
+            print("Customers: %d" % count)
+
+
+# Copyright 2021 Office Nomads LLC (https://officenomads.com/) Licensed under the AGPL License, Version 3.0 (the "License"); you may not use this file except in compliance with the License. You may obtain a copy of the License at https://www.gnu.org/licenses/agpl-3.0.html. Unless required by applicable law or agreed to in writing, software distributed under the License is distributed on an "AS IS" BASIS, WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the License for the specific language governing permissions and limitations under the License.
@@ -0,0 +1,49 @@
+from datetime import datetime
+
+from django.core.management.base import BaseCommand, CommandError
+
+from nadine.models.billing import XeroSync
+
+
+class Command(BaseCommand):
+    help = "Pulls changed contacts and invoices from Xero and optionally pushes new bills."
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--full',
+            action='store_true',
+            dest='full',
+            default=False,
+            help='Pull everything instead of only what changed since the last sync',
+        )
+        parser.add_argument(
+            '--push-bills',
+            action='store_true',
+            dest='push-bills',
+            default=False,
+            help='Create invoices in Xero for finished bills that have not been sent',
+        )
+        parser.add_argument(
+            '--push-since',
+            default=None,
+            help='Only push bills starting on or after this date (YYYY-MM-DD)',
+        )
+
+    def handle(self, *args, **options):
+        push_since = None
+        if options['push_since']:
+            try:
+                push_since = datetime.strptime(options['push_since'], "%Y-%m-%d").date()
+            except ValueError as e:
+                raise CommandError("Invalid date: %s" % e)
+
+        sync = XeroSync.objects.create()
+        sync.run(full=options['full'], push_bills=options['push-bills'], push_since=push_since)
+        print("Contacts linked: %d" % sync.contacts_linked)
+        print("Invoices updated: %d" % sync.invoices_updated)
+        print("Bills pushed: %d" % sync.bills_pushed)
+        if not sync.successful:
+            raise CommandError(sync.error)
+
+
+# Copyright 2021 Office Nomads LLC (https://officenomads.com/) Licensed under the AGPL License, Version 3.0 (the "License"); you may not use this file except in compliance with the License. You may obtain a copy of the License at https://www.gnu.org/licenses/agpl-3.0.html. Unless required by applicable law or agreed to in writing, software distributed under the License is distributed on an "AS IS" BASIS, WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the License for the specific language governing permissions and limitations under the License.
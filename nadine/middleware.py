@@ -0,0 +1,24 @@
+from django.conf import settings
+
+from nadine.models.profile import user_helper_cache
+
+
+class UserHelperCacheMiddleware:
+    ''' Share User.helper results for the length of a request.
+
+    Only requests that read (GET and HEAD) are cached.  Anything that might
+    write gets fresh results every time.  Set USER_HELPER_CACHE = False to turn it off.
+    '''
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+
+    def __call__(self, request):
+        enabled = getattr(settings, 'USER_HELPER_CACHE', True) and request.method in ('GET', 'HEAD')
+        if not enabled:
+            return self.get_response(request)
+        with user_helper_cache():
+            return self.get_response(request)
+
+
+# Copyright 2021 Office Nomads LLC (https://officenomads.com/) Licensed under the AGPL License, Version 3.0 (the "License"); you may not use this file except in compliance with the License. You may obtain a copy of the License at https://www.gnu.org/licenses/agpl-3.0.html. Unless required by applicable law or agreed to in writing, software distributed under the License is distributed on an "AS IS" BASIS, WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the License for the specific language governing permissions and limitations under the License.
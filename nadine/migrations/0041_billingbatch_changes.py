@@ -0,0 +1,18 @@
+# Generated by Django 4.2.30 on 2026-10-18 19:42
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('nadine', '0040_phone_numbers'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='billingbatch',
+            name='changes',
+            field=models.TextField(blank=True, help_text='Line items changed when recalculating existing bills', null=True),
+        ),
+    ]
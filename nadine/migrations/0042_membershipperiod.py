@@ -0,0 +1,60 @@
+# Generated by Django 4.2.30 on 2026-10-18 19:51
+
+from datetime import timedelta
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+def merge_date_ranges(ranges):
+    # A copy of nadine.models.membership.merge_date_ranges as it was when this
+    # migration was written so later changes can't alter what it does
+    merged = []
+    valid = [r for r in ranges if r[1] is None or r[1] >= r[0]]
+    for start_date, end_date in sorted(valid, key=lambda r: r[0]):
+        if merged:
+            last_start, last_end = merged[-1]
+            if last_end is None:
+                break
+            if start_date <= last_end + timedelta(days=1):
+                if end_date is None or end_date > last_end:
+                    merged[-1] = (last_start, end_date)
+                continue
+        merged.append((start_date, end_date))
+    return merged
+
+
+def forward(apps, schema_editor):
+    Membership = apps.get_model("nadine", "Membership")
+    MembershipPeriod = apps.get_model("nadine", "MembershipPeriod")
+    ResourceSubscription = apps.get_model("nadine", "ResourceSubscription")
+    periods = []
+    for membership_id in Membership.objects.values_list('id', flat=True):
+        ranges = ResourceSubscription.objects.filter(membership_id=membership_id).values_list('start_date', 'end_date')
+        for start_date, end_date in merge_date_ranges(ranges):
+            periods.append(MembershipPeriod(membership_id=membership_id, start_date=start_date, end_date=end_date))
+    MembershipPeriod.objects.bulk_create(periods, batch_size=500)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('nadine', '0041_billingbatch_changes'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='MembershipPeriod',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('start_date', models.DateField()),
+                ('end_date', models.DateField(blank=True, null=True)),
+                ('membership', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='periods', to='nadine.membership')),
+            ],
+            options={
+                'ordering': ['membership', 'start_date'],
+                'indexes': [models.Index(fields=['membership', 'start_date', 'end_date'], name='nadine_memb_members_bc3930_idx')],
+            },
+        ),
+        migrations.RunPython(forward, migrations.RunPython.noop),
+    ]
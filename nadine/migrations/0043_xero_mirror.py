@@ -0,0 +1,53 @@
+# Generated by Django 4.2.30 on 2026-10-18 20:19
+
+from django.conf import settings
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+        ('nadine', '0042_membershipperiod'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='XeroSync',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('created_ts', models.DateTimeField(auto_now_add=True)),
+                ('completed_ts', models.DateTimeField(blank=True, null=True)),
+                ('since', models.DateTimeField(blank=True, help_text='Only pull what changed in Xero after this time', null=True)),
+                ('contacts_linked', models.IntegerField(default=0)),
+                ('invoices_updated', models.IntegerField(default=0)),
+                ('bills_pushed', models.IntegerField(default=0)),
+                ('error', models.TextField(blank=True, null=True)),
+                ('created_by', models.ForeignKey(blank=True, null=True, on_delete=django.db.models.deletion.CASCADE, related_name='+', to=settings.AUTH_USER_MODEL)),
+            ],
+            options={
+                'ordering': ['-created_ts'],
+                'get_latest_by': 'created_ts',
+            },
+        ),
+        migrations.CreateModel(
+            name='XeroInvoice',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('invoice_id', models.CharField(max_length=64, unique=True)),
+                ('invoice_number', models.CharField(blank=True, max_length=64, null=True)),
+                ('contact_id', models.CharField(db_index=True, max_length=64)),
+                ('status', models.CharField(max_length=32)),
+                ('date', models.DateField(blank=True, null=True)),
+                ('due_date', models.DateField(blank=True, null=True)),
+                ('total', models.DecimalField(decimal_places=2, default=0, max_digits=9)),
+                ('amount_due', models.DecimalField(decimal_places=2, default=0, max_digits=9)),
+                ('amount_paid', models.DecimalField(decimal_places=2, default=0, max_digits=9)),
+                ('updated_ts', models.DateTimeField(blank=True, help_text='When this invoice was last changed in Xero', null=True)),
+                ('synced_ts', models.DateTimeField(auto_now=True)),
+                ('bill', models.OneToOneField(blank=True, null=True, on_delete=django.db.models.deletion.SET_NULL, related_name='xero_invoice', to='nadine.userbill')),
+                ('user', models.ForeignKey(blank=True, null=True, on_delete=django.db.models.deletion.SET_NULL, related_name='xero_invoices', to=settings.AUTH_USER_MODEL)),
+            ],
+        ),
+    ]
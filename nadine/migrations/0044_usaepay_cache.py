@@ -0,0 +1,49 @@
+# Generated by Django 4.2.30 on 2026-10-18 20:22
+
+from django.conf import settings
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+        ('nadine', '0043_xero_mirror'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='USAePayTransaction',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('transaction_id', models.CharField(max_length=64, unique=True)),
+                ('username', models.CharField(db_index=True, max_length=128)),
+                ('date_time', models.DateTimeField()),
+                ('transaction_date', models.DateField(db_index=True)),
+                ('settled_date', models.DateField(blank=True, db_index=True, help_text='When this check settled', null=True)),
+                ('card_type', models.CharField(max_length=16)),
+                ('status', models.CharField(max_length=32)),
+                ('transaction_type', models.CharField(max_length=32)),
+                ('amount', models.DecimalField(decimal_places=2, max_digits=9)),
+                ('description', models.CharField(blank=True, max_length=255, null=True)),
+                ('note', models.TextField(blank=True, null=True)),
+                ('synced_ts', models.DateTimeField(auto_now=True)),
+                ('user', models.ForeignKey(blank=True, null=True, on_delete=django.db.models.deletion.SET_NULL, related_name='+', to=settings.AUTH_USER_MODEL)),
+            ],
+        ),
+        migrations.CreateModel(
+            name='USAePayCustomer',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('customer_number', models.CharField(max_length=64, unique=True)),
+                ('username', models.CharField(db_index=True, max_length=128)),
+                ('enabled', models.BooleanField(default=False)),
+                ('next_date', models.DateField(blank=True, null=True)),
+                ('amount', models.DecimalField(blank=True, decimal_places=2, max_digits=9, null=True)),
+                ('description', models.CharField(blank=True, max_length=255, null=True)),
+                ('synced_ts', models.DateTimeField(auto_now=True)),
+                ('user', models.ForeignKey(blank=True, null=True, on_delete=django.db.models.deletion.SET_NULL, related_name='+', to=settings.AUTH_USER_MODEL)),
+            ],
+        ),
+    ]
@@ -0,0 +1,37 @@
+# Generated by Django 4.2.30 on 2026-10-18 20:31
+
+from django.conf import settings
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+        ('nadine', '0044_usaepay_cache'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='BillingEvent',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('created_ts', models.DateTimeField(auto_now_add=True)),
+                ('source', models.CharField(choices=[('batch', 'Billing batch'), ('staff', 'Staff'), ('signal', 'Signal')], max_length=16)),
+                ('action', models.CharField(choices=[('added', 'Line item added'), ('updated', 'Line item updated'), ('removed', 'Line item removed'), ('recalculated', 'Recalculated'), ('closed', 'Closed'), ('payment', 'Payment'), ('payment_removed', 'Payment removed')], max_length=16)),
+                ('line_item_id', models.IntegerField(blank=True, null=True)),
+                ('payment_id', models.IntegerField(blank=True, null=True)),
+                ('description', models.CharField(blank=True, max_length=200)),
+                ('amount_before', models.DecimalField(blank=True, decimal_places=2, max_digits=9, null=True)),
+                ('amount_after', models.DecimalField(blank=True, decimal_places=2, max_digits=9, null=True)),
+                ('batch', models.ForeignKey(blank=True, db_constraint=False, null=True, on_delete=django.db.models.deletion.DO_NOTHING, related_name='billing_events', to='nadine.billingbatch')),
+                ('bill', models.ForeignKey(db_constraint=False, on_delete=django.db.models.deletion.DO_NOTHING, related_name='billing_events', to='nadine.userbill')),
+                ('created_by', models.ForeignKey(blank=True, db_constraint=False, null=True, on_delete=django.db.models.deletion.DO_NOTHING, related_name='+', to=settings.AUTH_USER_MODEL)),
+            ],
+            options={
+                'ordering': ['created_ts', 'id'],
+                'indexes': [models.Index(fields=['bill', 'created_ts'], name='nadine_bill_bill_id_02f85f_idx')],
+            },
+        ),
+    ]
@@ -0,0 +1,39 @@
+# Generated by Django 4.2.30 on 2026-10-18 20:42
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('nadine', '0045_billing_events'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='DailyStats',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('day', models.DateField(unique=True)),
+                ('memberships', models.IntegerField(default=0)),
+                ('members_by_package', models.JSONField(blank=True, default=dict)),
+                ('desks', models.IntegerField(default=0)),
+                ('monthly_revenue', models.DecimalField(decimal_places=2, default=0, max_digits=11)),
+                ('started', models.IntegerField(default=0, help_text='Subscriptions started on this day')),
+                ('ended', models.IntegerField(default=0, help_text='Subscriptions ended on this day')),
+                ('coworking_days', models.IntegerField(default=0)),
+                ('billed_days', models.IntegerField(default=0)),
+                ('trial_days', models.IntegerField(default=0)),
+                ('waived_days', models.IntegerField(default=0)),
+                ('door_users', models.IntegerField(default=0)),
+                ('arp_users', models.IntegerField(default=0)),
+                ('arp_devices', models.IntegerField(default=0)),
+                ('stale', models.BooleanField(default=False)),
+                ('updated_ts', models.DateTimeField(auto_now=True)),
+            ],
+            options={
+                'verbose_name_plural': 'Daily stats',
+                'ordering': ['day'],
+            },
+        ),
+    ]
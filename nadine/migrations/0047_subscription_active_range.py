@@ -0,0 +1,28 @@
+from django.db import migrations
+
+
+INDEX_NAME = "nadine_resourcesubscription_active_range"
+
+
+def create_index(apps, schema_editor):
+    # Range indexes are PostgreSQL only.  Everything else uses the start/end date filters.
+    if schema_editor.connection.vendor != 'postgresql':
+        return
+    schema_editor.execute("CREATE INDEX IF NOT EXISTS %s ON nadine_resourcesubscription USING gist ((CASE WHEN end_date < start_date THEN 'empty'::daterange ELSE daterange(start_date, end_date, '[]') END))" % INDEX_NAME)
+
+
+def drop_index(apps, schema_editor):
+    if schema_editor.connection.vendor != 'postgresql':
+        return
+    schema_editor.execute("DROP INDEX IF EXISTS %s" % INDEX_NAME)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('nadine', '0046_daily_stats'),
+    ]
+
+    operations = [
+        migrations.RunPython(create_index, drop_index),
+    ]
@@ -0,0 +1,31 @@
+# Generated by Django 4.2.30 on 2026-10-18 20:56
+
+from django.conf import settings
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+        ('nadine', '0047_subscription_active_range'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='PresenceSession',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('source', models.CharField(choices=[('arp', 'Network'), ('door', 'Door'), ('coworking', 'Signed In')], max_length=16)),
+                ('day', models.DateField()),
+                ('start_ts', models.DateTimeField()),
+                ('end_ts', models.DateTimeField()),
+                ('user', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='presence_sessions', to=settings.AUTH_USER_MODEL)),
+            ],
+            options={
+                'ordering': ['start_ts'],
+                'indexes': [models.Index(fields=['day', 'source', 'user'], name='nadine_pres_day_c171da_idx'), models.Index(fields=['user', 'start_ts'], name='nadine_pres_user_id_8c885c_idx'), models.Index(fields=['user', 'end_ts'], name='nadine_pres_user_id_1b7e0b_idx'), models.Index(fields=['end_ts'], name='nadine_pres_end_ts_62f029_idx')],
+            },
+        ),
+    ]
@@ -0,0 +1,77 @@
+from datetime import datetime, timedelta
+
+from django.conf import settings
+from django.db import migrations
+from django.utils.timezone import localtime, make_aware
+
+
+def sessions_from(PresenceSession, source, sightings, gap):
+    # A copy of PresenceSessionManager.sessions_from() as it was when this
+    # migration was written so later changes can't alter what it does
+    session = None
+    for user_id, timestamp in sightings:
+        day = localtime(timestamp).date()
+        if session and session.user_id == user_id and session.day == day and timestamp - session.end_ts <= gap:
+            session.end_ts = timestamp
+            continue
+        if session:
+            yield session
+        session = PresenceSession(user_id=user_id, source=source, day=day, start_ts=timestamp, end_ts=timestamp)
+    if session:
+        yield session
+
+
+def save_in_batches(PresenceSession, sessions, batch_size=1000):
+    batch = []
+    for session in sessions:
+        batch.append(session)
+        if len(batch) >= batch_size:
+            PresenceSession.objects.bulk_create(batch)
+            batch = []
+    PresenceSession.objects.bulk_create(batch)
+
+
+def get_model(apps, app_label, model_name):
+    # The arpwatch and keymaster apps are optional
+    try:
+        return apps.get_model(app_label, model_name)
+    except LookupError:
+        return None
+
+
+def forward(apps, schema_editor):
+    PresenceSession = apps.get_model("nadine", "PresenceSession")
+    CoworkingDay = apps.get_model("nadine", "CoworkingDay")
+    gap = timedelta(minutes=getattr(settings, 'PRESENCE_SESSION_GAP', 30))
+    PresenceSession.objects.all().delete()
+
+    ArpLog = get_model(apps, "arpwatch", "ArpLog")
+    if ArpLog:
+        query = ArpLog.objects.filter(device__ignore=False, device__user__isnull=False)
+        sightings = query.values_list('device__user', 'runtime').order_by('device__user', 'runtime').iterator()
+        save_in_batches(PresenceSession, sessions_from(PresenceSession, "arp", sightings, gap))
+
+    DoorEvent = get_model(apps, "keymaster", "DoorEvent")
+    if DoorEvent:
+        sightings = DoorEvent.objects.filter(user__isnull=False).values_list('user', 'timestamp').order_by('user', 'timestamp').iterator()
+        save_in_batches(PresenceSession, sessions_from(PresenceSession, "door", sightings, gap))
+
+    def coworking_sessions():
+        # Same as nadine.models.presence.coworking_session()
+        for user_id, visit_date, created_ts in CoworkingDay.objects.values_list('user', 'visit_date', 'created_ts').iterator():
+            timestamp = created_ts
+            if not timestamp or localtime(timestamp).date() != visit_date:
+                timestamp = make_aware(datetime.combine(visit_date, datetime.min.time()))
+            yield PresenceSession(user_id=user_id, source="coworking", day=visit_date, start_ts=timestamp, end_ts=timestamp)
+    save_in_batches(PresenceSession, coworking_sessions())
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('nadine', '0048_presence_sessions'),
+    ]
+
+    operations = [
+        migrations.RunPython(forward, migrations.RunPython.noop),
+    ]
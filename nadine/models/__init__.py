@@ -6,6 +6,8 @@ from nadine.models.resource import *
 from nadine.models.membership import *
 from nadine.models.organization import *
 from nadine.models.alerts import *
+from nadine.models.stats import *
+from nadine.models.presence import *
 # from nadine.models.old_models import *
 
 # User too for good measure
@@ -35,6 +35,7 @@ sign_in = Signal()
 profile_save = Signal()
 file_upload = Signal()
 change_membership = Signal()
+change_memberships = Signal()
 new_membership = Signal()
 ending_membership = Signal()
 new_desk_membership = Signal()
@@ -110,6 +111,11 @@ class MemberAlertManager(models.Manager):
         logger.debug("handle_change_membership: %s" % user)
         change_membership.send(sender=self.__class__, user=user)
 
+    def handle_change_memberships(self, users):
+        ''' One pass for many users whose memberships changed together. '''
+        logger.debug("handle_change_memberships: %d users" % len(users))
+        change_memberships.send(sender=self.__class__, users=users)
+
     def handle_ending_membership(self, user, target_date=None):
         logger.debug("handle_ending_membership: %s, %s" % (user, target_date))
         ending_membership.send(sender=self.__class__, user=user)
@@ -1,14 +1,22 @@
+import io
+import csv
+import json
 import logging
+import re
+import threading
 import traceback
+from concurrent.futures import ProcessPoolExecutor
+from contextlib import contextmanager
 from decimal import Decimal
-from datetime import timedelta, date
+from datetime import datetime, timedelta, date, timezone
 from dateutil.relativedelta import relativedelta
 
-from django.db import models
-from django.db.models import F, Q, Count, Sum, Value, ExpressionWrapper
+import django
+from django.db import connection, connections, models, transaction
+from django.db.models import F, Q, Count, Max, Sum, Value, ExpressionWrapper, OuterRef, Subquery
 from django.db.models.functions import Coalesce
 from django.db.models.fields import DecimalField
-from django.utils.timezone import localtime, now
+from django.utils.timezone import localtime, now, make_aware
 from django.urls import reverse
 from django.contrib.auth.models import User
 from django.conf import settings
@@ -21,15 +29,134 @@ from nadine.models.usage import CoworkingDay, Event
 logger = logging.getLogger(__name__)
 
 
+# Sections of the outstanding bills report in display order
+OUTSTANDING_CATEGORIES = ['subscriptions', 'closed', 'dropin', 'other', 'in_progress']
+
+# The fields on UserBill calculated from line items, taxes and payments
+CACHED_TOTAL_FIELDS = ['cached_total_amount', 'cached_total_tax_amount', 'cached_total_paid', 'cached_total_owed']
+
+# Bill IDs waiting on a cached total update for each thread
+_deferred_totals = threading.local()
+
+
+@contextmanager
+def deferred_bill_totals():
+    ''' Hold off on updating cached totals until the end of this block.
+
+    The line item and payment signals record the bill instead of updating it
+    and all the recorded bills are updated at once when the outermost block
+    exits.  Yields the set of bill IDs so more can be added.
+    '''
+    bill_ids = getattr(_deferred_totals, 'bill_ids', None)
+    if bill_ids is not None:
+        # Nested inside another block which will do the update
+        yield bill_ids
+        return
+
+    bill_ids = _deferred_totals.bill_ids = set()
+    try:
+        yield bill_ids
+    finally:
+        _deferred_totals.bill_ids = None
+    UserBill.objects.update_cached_totals(bill_ids)
+
+
+def reset_billing_blocks():
+    ''' Forget the journal and deferred totals blocks this thread is in.
+
+    A forked worker process starts with a copy of its parent's thread local
+    state.  Without this its own blocks would think they are nested inside
+    blocks that never exit in the worker, and nothing would be written.
+    '''
+    _deferred_totals.bill_ids = None
+    _journal.events = None
+    _journal.defaults = None
+
+
+def defer_bill_totals(bill_id):
+    ''' Record this bill for later if we are in a deferred_bill_totals block. '''
+    bill_ids = getattr(_deferred_totals, 'bill_ids', None)
+    if bill_ids is None:
+        return False
+    bill_ids.add(bill_id)
+    return True
+
+
+# Billing events waiting to be written for each thread
+_journal = threading.local()
+
+
+@contextmanager
+def billing_journal(source=None, batch=None, created_by=None):
+    ''' Collect BillingEvents in this block and write them all at once when the outermost block exits.
+
+    Events recorded in the block get the given source, batch and user unless
+    they say otherwise.  The batch and user can be objects or ids.  Inner blocks can change these for their own events.
+    The events from a block that raises an exception are thrown away instead of written.
+    Yields the list of events waiting to be written.
+    '''
+    defaults = {}
+    if source:
+        defaults['source'] = source
+    if batch:
+        defaults['batch_id'] = getattr(batch, 'pk', batch)
+    if created_by:
+        defaults['created_by_id'] = getattr(created_by, 'pk', created_by)
+
+    events = getattr(_journal, 'events', None)
+    if events is not None:
+        # Nested inside another block which will do the writing
+        outer_defaults = _journal.defaults
+        _journal.defaults = dict(outer_defaults, **defaults)
+        mark = len(events)
+        try:
+            yield events
+        except Exception:
+            del events[mark:]
+            raise
+        finally:
+            _journal.defaults = outer_defaults
+        return
+
+    events = _journal.events = []
+    _journal.defaults = defaults
+    try:
+        yield events
+    finally:
+        _journal.events = None
+        _journal.defaults = None
+    BillingEvent.objects.bulk_create(events, batch_size=500)
+
+
 class BatchManager(models.Manager):
 
-    def run(self, start_date=None, end_date=None, created_by=None):
+    def run(self, start_date=None, end_date=None, created_by=None, bulk=None, shards=None):
         batch = self.create(created_by=created_by)
-        if batch.run(start_date, end_date):
+        if batch.run(start_date, end_date, bulk=bulk, shards=shards):
             return batch
         else:
             raise Exception(batch.error)
 
+    def billing_range(self, start_date=None, end_date=None):
+        ''' Fill in the default dates for a billing run. '''
+        # If no end_date, go until today
+        if not end_date:
+            end_date = localtime(now()).date()
+
+        # If no start_date, start from the last successful batch run
+        if not start_date:
+            last_batch = self.filter(error__isnull=True).order_by('created_ts').last()
+            start_date = localtime(last_batch.created_ts).date()
+        return (start_date, end_date)
+
+    def preview(self, start_date=None, end_date=None):
+        ''' Calculate a billing run in memory and describe the new, changed and closed bills without saving anything. '''
+        from nadine.models.billing_engine import BillingEngine
+        start_date, end_date = self.billing_range(start_date, end_date)
+        engine = BillingEngine(start_date, end_date)
+        engine.run()
+        return engine.preview()
+
 class BillingBatch(models.Model):
     """Gathers all untracked subscriptions and activity and associates it with a UserBill."""
     objects = BatchManager()
@@ -37,6 +164,7 @@ class BillingBatch(models.Model):
     created_by = models.ForeignKey(settings.AUTH_USER_MODEL, related_name="+", null=True, blank=True, on_delete=models.CASCADE)
     completed_ts = models.DateTimeField(blank=True, null=True)
     error = models.TextField(blank=True, null=True)
+    changes = models.TextField(blank=True, null=True, help_text="Line items changed when recalculating existing bills")
     bills = models.ManyToManyField('UserBill')
 
     class Meta:
@@ -51,36 +179,46 @@ class BillingBatch(models.Model):
     def successful(self):
         return self.completed_ts != None and self.error == None
 
-    def run(self, start_date=None, end_date=None):
+    def run(self, start_date=None, end_date=None, bulk=None, shards=None):
         ''' Run billing for every day since the last successful billing run. '''
-        logger.info("run(start_date=%s, end_date=%s)" % (start_date, end_date))
+        logger.info("run(start_date=%s, end_date=%s, bulk=%s, shards=%s)" % (start_date, end_date, bulk, shards))
+        if bulk is None:
+            bulk = getattr(settings, 'BILLING_BATCH_BULK', False)
+        if shards is None:
+            shards = getattr(settings, 'BILLING_BATCH_SHARDS', 1)
+
+        with billing_journal(source=BillingEvent.SOURCE_BATCH, batch=self), deferred_bill_totals() as bill_ids:
+            self.run_range(start_date, end_date, bulk, shards)
+            # Update cached totals on all associated bills
+            bill_ids.update(self.bills.values_list('id', flat=True))
+
+        # Indicate if we ran successsfully or not
+        return self.successful
+
+    def run_range(self, start_date, end_date, bulk, shards=1):
+        ''' Run billing for the given range and record any errors on this batch. '''
         try:
             # Make sure no other batches are running
             if BillingBatch.objects.filter(completed_ts=None).exclude(id=self.id).count() > 0:
                 raise Exception("Found a BillingBatch that has not yet completed!")
 
-            # If no end_date, go until today
-            if not end_date:
-                end_date = localtime(now()).date()
+            target_date, end_date = BillingBatch.objects.billing_range(start_date, end_date)
 
-            # If no start_date, start from the last successful batch run
-            target_date = start_date
-            if not target_date:
-                last_batch = BillingBatch.objects.filter(error__isnull=True).order_by('created_ts').last()
-                target_date = localtime(last_batch.created_ts).date()
-
-            # Run for each day in our range
-            while target_date <= end_date:
-                self.run_billing_for_day(target_date)
-                target_date = target_date + timedelta(days=1)
+            if shards > 1:
+                # Split the payers up and run each group separately
+                self.run_sharded(target_date, end_date, shards)
+            elif bulk:
+                # Run the whole range in memory and save it all at once
+                self.run_bulk(target_date, end_date)
+            else:
+                # Run for each day in our range
+                while target_date <= end_date:
+                    self.run_billing_for_day(target_date)
+                    target_date = target_date + timedelta(days=1)
 
             # Close out batch
             self.close()
 
-            # Update cached totals on all associated bills
-            for bill in self.bills.all():
-                bill.update_cached_totals()
-
         except Exception as e:
             # Save all error messages
             self.error = str(e)
@@ -88,8 +226,41 @@ class BillingBatch(models.Model):
             logger.error(self.error)
             self.close()
 
-        # Indicate if we ran successsfully or not
-        return self.successful
+    def run_bulk(self, start_date, end_date):
+        ''' Run billing for the given range with a fixed number of queries instead of day by day. '''
+        from nadine.models.billing_engine import BillingEngine
+        engine = BillingEngine(start_date, end_date)
+        engine.run()
+        with transaction.atomic():
+            bills = engine.save()
+            self.bills.add(*bills)
+        self.record_changes(engine.change_log())
+
+    def run_sharded(self, start_date, end_date, shards):
+        ''' Split the payers in to shards and run the bulk engine on each in its own transaction.
+
+        This batch stays open while the shards run so no other batch can start.
+        Shards run in worker processes unless BILLING_BATCH_PARALLEL is False.
+        '''
+        from nadine.models.billing_engine import run_billing_shard, billing_shard_worker
+        if getattr(settings, 'BILLING_BATCH_PARALLEL', True):
+            # Child processes have to make their own database connections
+            connections.close_all()
+            with ProcessPoolExecutor(max_workers=shards, initializer=django.setup) as executor:
+                futures = [executor.submit(billing_shard_worker, start_date, end_date, i, shards, self.id) for i in range(shards)]
+                results = [f.result() for f in futures]
+        else:
+            results = [run_billing_shard(start_date, end_date, i, shards, self.id) for i in range(shards)]
+
+        # Collect the results from each shard
+        errors = []
+        for result in sorted(results, key=lambda r: r['shard']):
+            self.bills.add(*result['bill_ids'])
+            self.record_changes(result['changes'])
+            if result['error']:
+                errors.append("Shard %d: %s" % (result['shard'] + 1, result['error']))
+        if errors:
+            raise Exception("\n".join(errors))
 
     def run_billing_for_day(self, target_date):
         ''' Run billing for a specific day. '''
@@ -103,7 +274,8 @@ class BillingBatch(models.Model):
 
         # Recalculate all the bills that need it
         for bill in self.to_recalculate:
-            bill.recalculate()
+            changes = bill.recalculate()
+            self.record_changes(["UserBill %d: %s" % (bill.id, c) for c in changes])
 
         # Close all open subscription based bills that end on this day
         self.close_bills_at_end_of_period(target_date)
@@ -135,12 +307,15 @@ class BillingBatch(models.Model):
                     self.to_recalculate.add(bill)
 
     def run_usage(self, target_date):
+        # Keep running usage totals for each bill while we add to them
+        usage = {}
+
         # Pull and add all past unbilled CoworkingDays
         for day in CoworkingDay.objects.unbilled(target_date).order_by('visit_date'):
             logger.debug("Found Coworking Day: %s %s %s" % (day.user, day.visit_date, day.payment))
             # Find the open bill for the period of this one day
             bill = UserBill.objects.get_or_create_open_bill(day.payer, day.visit_date, day.visit_date)
-            bill.add_coworking_day(day)
+            bill.add_coworking_day(day, usage.setdefault(bill.id, BillUsage(bill)))
             self.bills.add(bill)
 
         # Pull and add all past unbilled Events
@@ -149,7 +324,7 @@ class BillingBatch(models.Model):
             logger.debug("Found Event: %s %s" % (event.user, day))
             # Find the open bill for the period of this one day
             bill = UserBill.objects.get_or_create_open_bill(event.payer, day, day)
-            bill.add_event(event)
+            bill.add_event(event, usage.setdefault(bill.id, BillUsage(bill)))
 
     def close_bills_at_end_of_period(self, target_date):
         ''' Close the open bills at the end of their period. '''
@@ -161,6 +336,13 @@ class BillingBatch(models.Model):
                 bill.close()
                 self.bills.add(bill)
 
+    def record_changes(self, changes):
+        ''' Add these changes to the log saved with this batch. '''
+        if not changes:
+            return
+        lines = self.changes.splitlines() if self.changes else []
+        self.changes = "\n".join(lines + changes)
+
     def close(self):
         self.completed_ts = localtime(now())
         self.save()
@@ -231,6 +413,29 @@ class BillManager(models.Manager):
         )
         return bill
 
+    def update_cached_totals(self, bill_ids=None):
+        ''' Update the cached totals on the given bills (or all bills) with one aggregate query per table. '''
+        bills = self.all()
+        if bill_ids is not None:
+            bills = bills.filter(id__in=bill_ids)
+        bill_query = bills.values('id')
+
+        amounts = BillLineItem.objects.filter(bill__in=bill_query).values('bill').annotate(total=Sum('amount'))
+        amounts = {r['bill']: r['total'] for r in amounts}
+        taxes = LineItemTax.objects.total_by_bill(bills)
+        payments = Payment.objects.filter(bill__in=bill_query).values('bill').annotate(total=Sum('amount'))
+        payments = {r['bill']: r['total'] for r in payments}
+
+        updated = []
+        for bill in bills.only('id', *CACHED_TOTAL_FIELDS):
+            bill.cached_total_amount = amounts.get(bill.id) or Decimal(0)
+            bill.cached_total_tax_amount = taxes.get(bill.id) or Decimal(0)
+            bill.cached_total_paid = payments.get(bill.id) or Decimal(0)
+            bill.cached_total_owed = bill.cached_total_amount + bill.cached_total_tax_amount - bill.cached_total_paid
+            updated.append(bill)
+        self.bulk_update(updated, CACHED_TOTAL_FIELDS, batch_size=500)
+        return len(updated)
+
     def open(self):
         return self.filter(closed_ts__isnull=True)
 
@@ -267,6 +472,74 @@ class BillManager(models.Manager):
         return self.filter(mark_paid=False, cached_total_owed__gt = 0) \
             .annotate(bill_total=F('cached_total_amount') + F('cached_total_tax_amount'))
 
+    def with_details(self):
+        ''' Bills with their user, line items, subscriptions, days, events, taxes and payments
+        prefetched so they can be listed without any queries per bill. '''
+        line_items = BillLineItem.objects.select_related(
+            'subscriptionlineitem__subscription__resource',
+            'coworkingdaylineitem__day__user',
+            'eventlineitem__event__user',
+            'eventlineitem__event__room',
+        ).prefetch_related('lineitemtax_set__tax_rate')
+        return self.select_related('user').prefetch_related(
+            models.Prefetch('line_items', queryset=line_items),
+            'payment_set',
+        )
+
+    def outstanding_report(self):
+        ''' Every outstanding bill for the outstanding bills dashboard in one query.
+
+        Each bill is annotated with subscription_count, report_monthly_rate, report_overage,
+        report_day_count, report_billable_day_count and a report_category of 'subscriptions',
+        'dropin', 'other', 'closed' or 'in_progress'.  Returns a dictionary with the bills and
+        total for each category along with the overall bill_count and bill_total.
+        '''
+        def subquery_sum(query, expression):
+            sum_query = query.annotate(report_sum=models.Func(expression, function='SUM')).values('report_sum')
+            return Coalesce(models.Subquery(sum_query), Value(0), output_field=DecimalField())
+
+        def subquery_count(query, field):
+            count_query = query.annotate(report_count=models.Func(models.F(field), function='COUNT')).values('report_count')
+            return Coalesce(models.Subquery(count_query, output_field=models.IntegerField()), Value(0))
+
+        line_items = SubscriptionLineItem.objects.filter(bill=models.OuterRef('pk')).order_by().values('bill')
+        subscription_ids = SubscriptionLineItem.objects.filter(bill=models.OuterRef(models.OuterRef('pk'))).values('subscription')
+        subscriptions = ResourceSubscription.objects.filter(id__in=subscription_ids).order_by().values('id')
+        days = CoworkingDayLineItem.objects.filter(bill=models.OuterRef('pk')).order_by().values('bill')
+        billable_days = days.filter(day__payment="Bill")
+
+        subscriptions_due = Q(report_monthly_rate__gt=0, cached_total_paid__lt=F('report_monthly_rate'))
+        bills = self.outstanding() \
+            .select_related('user', 'user__profile') \
+            .annotate(subscription_count=subquery_count(line_items, 'subscription')) \
+            .annotate(report_monthly_rate=subquery_sum(subscriptions.values('monthly_rate'), F('monthly_rate'))) \
+            .annotate(report_day_count=subquery_count(days, 'day')) \
+            .annotate(report_billable_day_count=subquery_count(billable_days, 'day')) \
+            .annotate(report_overage=models.Case(
+                models.When(report_monthly_rate__gt=0, cached_total_amount__gt=F('report_monthly_rate'), then=F('cached_total_amount') - F('report_monthly_rate')),
+                default=Value(0),
+                output_field=DecimalField(),
+            )) \
+            .annotate(report_category=models.Case(
+                models.When(in_progress=True, then=Value('in_progress')),
+                models.When(closed_ts__isnull=False, then=Value('closed')),
+                models.When(subscriptions_due, then=Value('subscriptions')),
+                models.When(subscription_count=0, then=Value('dropin')),
+                default=Value('other'),
+                output_field=models.CharField(),
+            )) \
+            .order_by('due_date', 'id')
+
+        report = {'bill_count': 0, 'bill_total': Decimal(0)}
+        for category in OUTSTANDING_CATEGORIES:
+            report[category] = {'bills': [], 'total': Decimal(0)}
+        for bill in bills:
+            report[bill.report_category]['bills'].append(bill)
+            report[bill.report_category]['total'] += bill.bill_total
+            report['bill_count'] += 1
+            report['bill_total'] += bill.bill_total
+        return report
+
     def non_zero(self):
         return self \
             .annotate(bill_amount=Sum('line_items__amount')) \
@@ -300,6 +573,9 @@ class UserBill(models.Model):
 
     @property
     def total_paid(self):
+        payments = self.prefetched('payment_set')
+        if payments is not None:
+            return sum((p.amount for p in payments), Decimal(0))
         return self.payment_set.aggregate(paid=Coalesce(Sum('amount'), Value(0.00), output_field=DecimalField()))['paid']
 
     @property
@@ -308,6 +584,13 @@ class UserBill(models.Model):
 
     @property
     def amount(self):
+        line_items = self.prefetched('line_items')
+        if line_items is not None:
+            return sum((i.amount for i in line_items), Decimal(0))
+        return self.saved_amount()
+
+    def saved_amount(self):
+        ''' The sum of the line items as they are in the database, never the cached or prefetched amount. '''
         return self.line_items.aggregate(amount=Coalesce(Sum('amount'), Value(0.00), output_field=DecimalField()))['amount']
 
     @property
@@ -334,6 +617,8 @@ class UserBill(models.Model):
     @property
     def monthly_rate(self):
         ''' Add up all rates for all the subscriptions. '''
+        if self.prefetched('line_items') is not None:
+            return sum((s.monthly_rate for s in self.subscriptions_list()), Decimal(0))
         return self.subscriptions().aggregate(rate=Coalesce(Sum('monthly_rate'), Value(0.00), output_field=DecimalField()))['rate']
 
     @property
@@ -358,7 +643,7 @@ class UserBill(models.Model):
     def package_name(self):
         ''' If all subscriptions have the same package_name we'll assume that name for this bill as well. '''
         package_name = None
-        for s in self.subscriptions():
+        for s in self.subscriptions_list():
             if package_name:
                 if s.package_name != package_name:
                     return None
@@ -374,6 +659,17 @@ class UserBill(models.Model):
     def is_closed(self):
         return self.closed_ts != None
 
+    def prefetched(self, name):
+        ''' The related objects loaded by prefetch_related() or None if they were not prefetched. '''
+        cache = getattr(self, '_prefetched_objects_cache', {})
+        if name in cache:
+            return list(cache[name])
+        return None
+
+    def clear_prefetched(self):
+        if hasattr(self, '_prefetched_objects_cache'):
+            self._prefetched_objects_cache = {}
+
     ############################################################################
     # URL Methods
     ############################################################################
@@ -387,12 +683,34 @@ class UserBill(models.Model):
     def get_admin_url(self):
         return reverse('admin:nadine_userbill_change', args=[self.id])
 
+    def xero_invoice_data(self):
+        ''' This bill as an invoice for the Xero API. '''
+        line_items = []
+        account_code = getattr(settings, 'XERO_SALES_ACCOUNT', None)
+        for line_item in self.line_items.all():
+            item = {'Description': line_item.description, 'Quantity': 1, 'UnitAmount': line_item.amount}
+            if account_code:
+                item['AccountCode'] = account_code
+            line_items.append(item)
+        return {
+            'Type': 'ACCREC',
+            'Contact': {'ContactID': self.user.xero_contact.xero_id},
+            'Date': self.period_start,
+            'DueDate': self.due_date,
+            'Reference': "Bill %d" % self.id,
+            'Status': getattr(settings, 'XERO_INVOICE_STATUS', 'DRAFT'),
+            'LineAmountTypes': 'Exclusive',
+            'LineItems': line_items,
+        }
+
     ############################################################################
     # Resource Methods
     ############################################################################
 
     def resource_allowance(self, resource):
         ''' Look at the subscriptions added to this bill to determine the allowance for the given resource. '''
+        if self.prefetched('line_items') is not None:
+            return sum(s.allowance for s in self.subscriptions_list() if s.resource_id == resource.id)
         query = self.subscriptions().filter(resource=resource)
         return query.aggregate(sum=Coalesce(Sum('allowance'), Value(0.00), output_field=DecimalField()))['sum']
 
@@ -403,6 +721,11 @@ class UserBill(models.Model):
         # This will cause problems if there are multiple subscriptions
         # with different rates!!! Since this should not be the case 99%
         # of the time I'm going to do it the simple way --JLS
+        if self.prefetched('line_items') is not None:
+            subscriptions = [s for s in self.subscriptions_list() if s.resource_id == resource.id]
+            if subscriptions:
+                return subscriptions[0].overage_rate
+            return resource.default_rate
         subscriptions = self.subscriptions().filter(resource=resource)
         if subscriptions:
             return subscriptions.first().overage_rate
@@ -438,15 +761,33 @@ class UserBill(models.Model):
         subscription_ids = SubscriptionLineItem.objects.filter(bill=self).values('subscription')
         return ResourceSubscription.objects.filter(id__in=subscription_ids)
 
+    def subscriptions_list(self):
+        ''' The subscriptions as a list, taken from the line items if they were prefetched. '''
+        line_items = self.prefetched('line_items')
+        if line_items is None:
+            return list(self.subscriptions().order_by('id'))
+        subscriptions = {}
+        for i in line_items:
+            if hasattr(i, 'subscriptionlineitem'):
+                subscriptions[i.subscriptionlineitem.subscription_id] = i.subscriptionlineitem.subscription
+        return [subscriptions[k] for k in sorted(subscriptions)]
+
     def has_subscription(self, subscription):
         ''' Return True if the given subscription is in the line items. '''
-        return subscription in self.subscriptions()
+        return subscription in self.subscriptions_list()
 
     def add_subscription(self, subscription):
         ''' Create a line item for this ResourceSubscription. '''
         if self.has_subscription(subscription):
             return
+        line_item = self.subscription_line_item(subscription)
+        line_item.save()
+        BillingEvent.objects.record(self.id, BillingEvent.ADDED, line_item=line_item, amount_after=line_item.amount)
+        self.add_lineitem_taxes(line_item.calculate_taxes())
+        return line_item
 
+    def subscription_line_item(self, subscription):
+        ''' Build an unsaved line item for this ResourceSubscription. '''
         # Start with a generic description
         description = ""
         if subscription.package_name:
@@ -477,15 +818,12 @@ class UserBill(models.Model):
         prorate = subscription.prorate_for_period(self.period_start, self.period_end)
         amount = prorate * subscription.monthly_rate
 
-        # Create our new line item
-        line_item = SubscriptionLineItem.objects.create(
+        return SubscriptionLineItem(
             bill = self,
             subscription = subscription,
             description = description,
             amount = amount
         )
-        self.add_lineitem_taxes(line_item.calculate_taxes())
-        return line_item
 
     ###########################################################################
     # Coworking Day Methods
@@ -496,22 +834,39 @@ class UserBill(models.Model):
         day_ids = CoworkingDayLineItem.objects.filter(bill=self).values('day')
         return CoworkingDay.objects.filter(id__in=day_ids)
 
+    def coworking_days_list(self):
+        ''' The coworking days as a list, taken from the line items if they were prefetched. '''
+        line_items = self.prefetched('line_items')
+        if line_items is None:
+            return list(self.coworking_days())
+        return [i.coworkingdaylineitem.day for i in line_items if hasattr(i, 'coworkingdaylineitem')]
+
     def includes_coworking_day(self, coworking_day):
         ''' Return True if the given day is in the line items. '''
-        return coworking_day in self.coworking_days()
+        return coworking_day in self.coworking_days_list()
 
-    def add_coworking_day(self, day):
-        ''' Add the given coworking day to this bill. '''
+    def add_coworking_day(self, day, usage=None):
+        ''' Add the given coworking day to this bill.
+        Pass the same BillUsage when adding many days to skip counting the ones already here. '''
+        if usage is None:
+            usage = BillUsage(self)
         resource = Resource.objects.day_resource
-        allowance = self.resource_allowance(resource)
-        overage_rate = self.resource_overage_rate(resource)
+        line_item = self.coworking_day_line_item(day, resource, usage.day_allowance, usage.day_overage_rate, usage.billable_days)
+        line_item.save()
+        BillingEvent.objects.record(self.id, BillingEvent.ADDED, line_item=line_item, amount_after=line_item.amount)
+        self.add_lineitem_taxes(line_item.calculate_taxes())
+        if day.billable:
+            usage.billable_days += 1
+        return line_item
 
+    def coworking_day_line_item(self, day, resource, allowance, overage_rate, billable_count):
+        ''' Build an unsaved line item for the given day given the billable days already on this bill. '''
         # Start building our description
         description = "%s %s" % (resource.name, day.visit_date)
 
         amount = 0
         if day.billable:
-            billable_count = self.coworking_day_billable_count + 1
+            billable_count = billable_count + 1
             if billable_count > allowance:
                 amount = overage_rate
             description += " (%d) " % billable_count
@@ -523,25 +878,26 @@ class UserBill(models.Model):
         if day.user != self.user:
             description += " for " + day.user.username
 
-        # Create the line item
-        line_item = CoworkingDayLineItem.objects.create(
+        return CoworkingDayLineItem(
             bill = self,
             description = description,
             amount = amount,
             day = day,
         )
-        self.add_lineitem_taxes(line_item.calculate_taxes())
-        return line_item
 
 
     @property
     def coworking_day_count(self):
         ''' The number of coworking days on with this bill. '''
+        if self.prefetched('line_items') is not None:
+            return len(self.coworking_days_list())
         return self.coworking_days().count()
 
     @property
     def coworking_day_billable_count(self):
         ''' The number of billable coworking days on this bill. '''
+        if self.prefetched('line_items') is not None:
+            return len([d for d in self.coworking_days_list() if d.billable])
         return self.coworking_days().filter(payment="Bill").count()
 
     @property
@@ -565,11 +921,27 @@ class UserBill(models.Model):
         event_ids = EventLineItem.objects.filter(bill=self).values('event')
         return Event.objects.filter(id__in=event_ids)
 
+    def events_list(self):
+        ''' The events as a list, taken from the line items if they were prefetched. '''
+        line_items = self.prefetched('line_items')
+        if line_items is None:
+            return list(self.events())
+        return [i.eventlineitem.event for i in line_items if hasattr(i, 'eventlineitem')]
+
     def includes_event(self, event):
         ''' Return True if the given event is in the line items. '''
-        return event in self.events()
+        return event in self.events_list()
 
     def calculate_event_charge(self, event):
+        # First check to see if there is a set charge on this event
+        if event.charge:
+            return event.charge
+
+        is_member = self.user.membership.active_subscriptions().exists()
+        return self.event_charge_for_usage(event, is_member, self.event_hours_used, self.event_hour_allowance, self.event_hour_overage_rate)
+
+    def event_charge_for_usage(self, event, is_member, hours_used, hour_allowance, hour_overage_rate):
+        ''' Calculate the charge for an event given the hours already used on this bill. '''
         # First check to see if there is a set charge on this event
         if event.charge:
             return event.charge
@@ -577,18 +949,20 @@ class UserBill(models.Model):
             if not event.room:
                 raise Exception("Event must have room specified or a specific charge set.")
 
-        if self.user.membership.active_subscriptions():
-            total_hours = Decimal(self.event_hours_used + event.hours)
-            overage = total_hours - self.event_hour_allowance
+        # Without an active membership none of the hours are covered
+        overage = Decimal(event.hours)
+        if is_member:
+            total_hours = Decimal(hours_used + event.hours)
+            overage = total_hours - hour_allowance
             if overage < 0:
                 overage = Decimal(0.00)
 
         # Member only rooms get charged depending on subscriptions
         if event.room.members_only:
-            return overage * float(self.event_hour_overage_rate)
+            return overage * float(hour_overage_rate)
 
         # Calculate the charge based on the default rate for the room
-        if self.event_hour_allowance == 0:
+        if hour_allowance == 0:
             return event.room.default_rate
         else:
             # If there is an allowance, they are an active member and get a discount
@@ -606,30 +980,44 @@ class UserBill(models.Model):
             description += " by " + event.user.username
         return description
 
-    def add_event(self, event):
-        ''' Add the given event to this bill. '''
+    def add_event(self, event, usage=None):
+        ''' Add the given event to this bill.
+        Pass the same BillUsage when adding many events to skip adding up the hours already here. '''
         logger.debug("add_event(%s)" % event)
-        amount = self.calculate_event_charge(event)
-        description = self.calculate_event_description(event)
-        line_item = EventLineItem.objects.create(
+        if usage is None:
+            usage = BillUsage(self)
+        if event.charge:
+            amount = event.charge
+        else:
+            amount = self.event_charge_for_usage(event, usage.is_member, usage.hours_used, usage.hour_allowance, usage.hour_overage_rate)
+        line_item = self.event_line_item(event, amount)
+        line_item.save()
+        BillingEvent.objects.record(self.id, BillingEvent.ADDED, line_item=line_item, amount_after=line_item.amount)
+        self.add_lineitem_taxes(line_item.calculate_taxes())
+        usage.hours_used += event.hours
+        return line_item
+
+    def event_line_item(self, event, amount):
+        ''' Build an unsaved line item for the given event. '''
+        return EventLineItem(
             bill = self,
-            description = description,
+            description = self.calculate_event_description(event),
             amount = amount,
             event = event,
         )
-        self.add_lineitem_taxes(line_item.calculate_taxes())
-        return line_item
 
     @property
     def event_count(self):
         ''' The number of events on this bill. '''
+        if self.prefetched('line_items') is not None:
+            return len(self.events_list())
         return self.events().count()
 
     @property
     def event_hours_used(self):
         ''' The number of event hours on this bill. '''
         hours = 0
-        for event in self.events():
+        for event in self.events_list():
             hours += event.hours
         return hours
 
@@ -663,7 +1051,7 @@ class UserBill(models.Model):
         for item in CoworkingDayLineItem.objects.filter(bill=self):
             taxes += item.calculate_taxes()
         for item in EventLineItem.objects.filter(bill=self):
-            taxes = item.calculate_taxes()
+            taxes += item.calculate_taxes()
         return taxes
 
     def add_lineitem_taxes(self, lineitem_taxes):
@@ -673,93 +1061,163 @@ class UserBill(models.Model):
 
     def total_tax_applied(self):
         ''' Provide the total amount of tax added to bill '''
-        total = 0
-        for _,amount in self.total_tax_applied_by_rate():
-            total += amount
-        return total
+        line_items = self.prefetched('line_items')
+        if line_items is not None:
+            return sum((t.amount for i in line_items for t in i.lineitemtax_set.all()), Decimal(0))
+        return LineItemTax.objects.total_by_bill(self.id).get(self.id, Decimal(0))
 
     def total_tax_applied_by_rate(self):
         ''' Produce list of tax rates and amounts (rate<TaxRate>, amount<Decimal>) '''
-        taxes = []
-        for taxrate in TaxRate.objects.all():
-            total = self.total_tax_applied_for_rate(taxrate)
-            taxes.append((taxrate, total))
-        return taxes
+        totals = LineItemTax.objects.total_by_bill_and_rate(self.id)
+        return [(rate, totals.get((self.id, rate.id), Decimal(0))) for rate in TaxRate.objects.all().order_by('id')]
 
     def total_tax_applied_for_rate(self, rate):
         ''' Total tax amount applied for given rate '''
-        total = 0
-        for item in BillLineItem.objects.filter(bill=self):
-            tax = item.get_applied_tax(rate)
-            if tax is not None:
-                total += tax.amount
-        return total
+        totals = LineItemTax.objects.total_by_bill_and_rate(self.id)
+        return totals.get((self.id, rate.id), Decimal(0))
 
     ############################################################################
     # Other Methods
     ############################################################################
 
-    def recalculate(self):
-        ''' Recalculate bill by evaluating all subscriptions and activity. '''
-        logger.info("Recalculating bill %d for %s" % (self.id, self.user))
+    def desired_line_items(self):
+        ''' Build the unsaved line items this bill should have for its subscriptions and activity. '''
+        line_items = []
+        for s in self.subscriptions().select_related('resource', 'membership__individualmembership__user').order_by('id'):
+            line_items.append(self.subscription_line_item(s))
 
-        # Hold on to the existing data
-        subscriptions = list(self.subscriptions())
-        coworking_days = list(self.coworking_days().order_by('visit_date'))
-        custom_items = list(self.line_items.filter(custom=True))
-        total_before = self.amount
-
-        # Delete all the line items
-        for line_item in self.line_items.all():
-            line_item.delete()
-
-        # Add everything back
-        for s in subscriptions:
-            self.add_subscription(s)
-        for d in coworking_days:
-            self.add_coworking_day(d)
-        for c in custom_items:
-            c.save()
+        # Coworking days are numbered in the order they were used
+        resource = Resource.objects.day_resource
+        allowance = self.resource_allowance(resource)
+        overage_rate = self.resource_overage_rate(resource)
+        billable_count = 0
+        for day in self.coworking_days().select_related('user').order_by('visit_date', 'id'):
+            line_items.append(self.coworking_day_line_item(day, resource, allowance, overage_rate, billable_count))
+            if day.billable:
+                billable_count += 1
+
+        # Events use up the hour allowance in the order they happened
+        events = list(self.events().select_related('user', 'room').order_by('start_ts', 'id'))
+        if events:
+            is_member = self.user.membership.active_subscriptions().exists()
+            allowance = self.event_hour_allowance
+            overage_rate = self.event_hour_overage_rate
+            hours_used = 0
+            for event in events:
+                amount = self.event_charge_for_usage(event, is_member, hours_used, allowance, overage_rate)
+                line_items.append(self.event_line_item(event, amount))
+                hours_used += event.hours
+        return line_items
 
-        # Recalculate the cache as well
-        self.update_cached_totals()
+    def recalculate(self):
+        ''' Recalculate bill by evaluating all subscriptions and activity.
 
+        The line items the bill should have are compared to the ones it has
+        and only the line items and taxes that differ are written.  Custom
+        line items are left alone.  Returns a list describing each change.
+        '''
+        logger.info("Recalculating bill %d for %s" % (self.id, self.user))
+        # Anything prefetched is about to change
+        self.clear_prefetched()
+        total_before = self.amount
+        changes = []
+
+        # The existing line items by what they are for
+        existing = {}
+        for model in [SubscriptionLineItem, CoworkingDayLineItem, EventLineItem]:
+            for line_item in model.objects.filter(bill=self).prefetch_related('lineitemtax_set'):
+                existing[line_item_key(line_item)] = line_item
+        no_key = Q(subscriptionlineitem__isnull=True, coworkingdaylineitem__isnull=True, eventlineitem__isnull=True)
+        orphans = list(self.line_items.filter(no_key, custom=False))
+
+        with deferred_bill_totals() as bill_ids:
+            tax_rates = {}
+            for desired in self.desired_line_items():
+                line_item = existing.pop(line_item_key(desired), None)
+                if line_item is None:
+                    desired.save()
+                    changes.append("Added %s: $%s" % (desired.description, desired.amount))
+                    BillingEvent.objects.record(self.id, BillingEvent.ADDED, line_item=desired, amount_after=desired.amount)
+                    line_item = desired
+                    current_taxes = {}
+                else:
+                    if line_item.amount != desired.amount or line_item.description != desired.description:
+                        changes.append("Updated %s: $%s to %s: $%s" % (line_item.description, line_item.amount, desired.description, desired.amount))
+                        BillingEvent.objects.record(self.id, BillingEvent.UPDATED, line_item=line_item, description=desired.description, amount_before=line_item.amount, amount_after=desired.amount)
+                        line_item.amount = desired.amount
+                        line_item.description = desired.description
+                        line_item.save(update_fields=['amount', 'description'])
+                    current_taxes = {t.tax_rate_id: t for t in line_item.lineitemtax_set.all()}
+
+                # Bring the taxes in line with the amount
+                resource = line_item.get_resource()
+                if resource.id not in tax_rates:
+                    tax_rates[resource.id] = list(resource.taxrate_set.all())
+                rates = tax_rates[resource.id] if line_item.amount != 0 else []
+                for rate in rates:
+                    amount = line_item.calculate_tax_amount(rate)
+                    tax = current_taxes.pop(rate.id, None)
+                    if tax is None:
+                        LineItemTax.objects.create(line_item=line_item, tax_rate=rate, amount=amount)
+                    elif tax.amount != amount:
+                        changes.append("Updated %s on %s: $%s to $%s" % (rate.name, line_item.description, tax.amount, amount))
+                        tax.amount = amount
+                        tax.save(update_fields=['amount'])
+                for tax in current_taxes.values():
+                    tax.delete()
+
+            # Anything left over no longer belongs on this bill
+            for line_item in list(existing.values()) + orphans:
+                changes.append("Removed %s: $%s" % (line_item.description, line_item.amount))
+                line_item.delete()
+
+            # Recalculate the cache as well
+            bill_ids.add(self.id)
+        self.refresh_from_db(fields=CACHED_TOTAL_FIELDS)
+        BillingEvent.objects.record(self.id, BillingEvent.RECALCULATED, description="%d changes" % len(changes), amount_before=total_before, amount_after=self.saved_amount())
+
+        for change in changes:
+            logger.info("UserBill %d: %s" % (self.id, change))
         logger.debug("Previous amount: %s, New amount: %s" % (total_before, self.amount))
+        return changes
 
     def combine(self, bill, recalculate=True):
         ''' Combine the given bill with this bill. '''
         if bill.user != self.user:
             raise Exception("Can not combine bills from different users (%s and %s)" % (self.user, bill.user))
 
-        # Change the dates
-        if bill.period_start < self.period_start:
-            self.period_start = bill.period_start
-        if bill.period_end > self.period_end:
-            self.period_end = bill.period_end
-        if bill.due_date > self.due_date:
-            self.due_date = bill.due_date
-        self.save()
-
-        # Pull all the line items in to memory and delete the other bill
-        subscriptions = list(bill.subscriptions())
-        coworking_days = list(bill.coworking_days())
-        events = list(bill.events())
-        custom_items = list(bill.line_items.filter(custom=True))
-        bill.delete()
-
-        # Add all the subscriptions, days, and custom items
-        for s in subscriptions:
-            self.add_subscription(s)
-        for d in coworking_days:
-            self.add_coworking_day(d)
-        for e in events:
-            self.add_event(e)
-        for line_item in custom_items:
-            line_item.bill = self
-            line_item.save()
-
-        if recalculate:
-            self.recalculate()
+        with deferred_bill_totals() as bill_ids:
+            # Change the dates
+            if bill.period_start < self.period_start:
+                self.period_start = bill.period_start
+            if bill.period_end > self.period_end:
+                self.period_end = bill.period_end
+            if bill.due_date > self.due_date:
+                self.due_date = bill.due_date
+            self.save()
+
+            # Pull all the line items in to memory and delete the other bill
+            subscriptions = list(bill.subscriptions())
+            coworking_days = list(bill.coworking_days())
+            events = list(bill.events())
+            custom_items = list(bill.line_items.filter(custom=True))
+            bill.delete()
+
+            # Add all the subscriptions, days, and custom items
+            for s in subscriptions:
+                self.add_subscription(s)
+            for d in coworking_days:
+                self.add_coworking_day(d)
+            for e in events:
+                self.add_event(e)
+            for line_item in custom_items:
+                line_item.bill = self
+                line_item.save()
+
+            if recalculate:
+                self.recalculate()
+            bill_ids.add(self.id)
+        self.refresh_from_db(fields=CACHED_TOTAL_FIELDS)
 
     def update_cached_totals(self):
         self.cached_total_amount = self.amount
@@ -774,6 +1232,58 @@ class UserBill(models.Model):
         self.closed_ts = localtime(now())
         self.in_progress = False
         self.save()
+        BillingEvent.objects.record(self.id, BillingEvent.CLOSED, amount_after=self.saved_amount())
+
+
+def line_item_key(line_item):
+    ''' What a line item is billing for, used to match line items up when recalculating. '''
+    if isinstance(line_item, SubscriptionLineItem):
+        return ('subscription', line_item.subscription_id)
+    if isinstance(line_item, CoworkingDayLineItem):
+        return ('day', line_item.day_id)
+    if isinstance(line_item, EventLineItem):
+        return ('event', line_item.event_id)
+    return ('line_item', line_item.id)
+
+
+class BillUsage(object):
+    ''' Running usage counters for one bill.
+
+    Each value is loaded from the database the first time it is needed and the
+    counters are then kept up to date as days and events are added, so pricing
+    the next one does not count everything already on the bill again.
+    '''
+
+    def __init__(self, bill):
+        self.bill = bill
+
+    @cached_property
+    def day_allowance(self):
+        return self.bill.resource_allowance(Resource.objects.day_resource)
+
+    @cached_property
+    def day_overage_rate(self):
+        return self.bill.resource_overage_rate(Resource.objects.day_resource)
+
+    @cached_property
+    def billable_days(self):
+        return self.bill.coworking_day_billable_count
+
+    @cached_property
+    def hour_allowance(self):
+        return self.bill.event_hour_allowance
+
+    @cached_property
+    def hour_overage_rate(self):
+        return self.bill.event_hour_overage_rate
+
+    @cached_property
+    def hours_used(self):
+        return self.bill.event_hours_used
+
+    @cached_property
+    def is_member(self):
+        return self.bill.user.membership.active_subscriptions().exists()
 
 
 class BillLineItem(models.Model):
@@ -849,7 +1359,136 @@ class PaymentMethod(models.Model):
         return self.name
 
 
+def read_payment_rows(data, format="csv"):
+    ''' Parse a list of payments given as CSV with a header row or a JSON list of objects. '''
+    if format == "json":
+        rows = json.loads(data)
+        if not isinstance(rows, list):
+            raise Exception("Expected a list of payments")
+        return rows
+    elif format == "csv":
+        reader = csv.DictReader(io.StringIO(data))
+        return [{k.strip(): (v or "").strip() for k, v in row.items() if k} for row in reader]
+    raise Exception("Unknown format '%s'" % format)
+
+
+class PaymentManager(models.Manager):
+
+    def validate_payments(self, rows):
+        ''' Check a list of payments before recording them.
+
+        Each row needs a 'bill' id and an 'amount' with an optional 'method' (name or id),
+        'external_id', 'payment_date' (YYYY-MM-DD) and 'note'.  Returns one result per
+        row with an 'error' for the rows that can not be recorded and an unsaved
+        'payment' for the ones that can.
+        '''
+        bill_ids = set()
+        external_ids = set()
+        for row in rows:
+            if not isinstance(row, dict):
+                continue
+            try:
+                bill_ids.add(int(row.get('bill')))
+            except (TypeError, ValueError):
+                pass
+            if row.get('external_id'):
+                external_ids.add(str(row['external_id']))
+        bills = UserBill.objects.in_bulk(bill_ids)
+        methods = {}
+        for method in PaymentMethod.objects.all():
+            methods[str(method.id)] = method
+            methods[method.name.lower()] = method
+        recorded = set(self.filter(external_id__in=external_ids).values_list('external_id', flat=True))
+
+        results = []
+        owed = {}
+        for n, row in enumerate(rows, start=1):
+            if not isinstance(row, dict):
+                results.append({'row': n, 'bill': None, 'amount': None, 'external_id': None, 'error': "Expected a payment but got '%s'" % row})
+                continue
+            result = {'row': n, 'bill': row.get('bill'), 'amount': row.get('amount'), 'external_id': row.get('external_id') or None}
+            results.append(result)
+            try:
+                bill = bills.get(int(row.get('bill')))
+            except (TypeError, ValueError):
+                bill = None
+            if not bill:
+                result['error'] = "Bill '%s' not found" % row.get('bill')
+                continue
+            try:
+                amount = Decimal(str(row.get('amount'))).quantize(Decimal('0.01'))
+            except ArithmeticError:
+                amount = None
+            if amount is None or not amount.is_finite():
+                result['error'] = "Invalid amount '%s'" % row.get('amount')
+                continue
+            if amount <= 0:
+                result['error'] = "Amount must be positive"
+                continue
+            owed.setdefault(bill.id, bill.cached_total_owed)
+            if amount > owed[bill.id]:
+                result['error'] = "Amount of $%s exceeds amount owed $%s" % (amount, owed[bill.id])
+                continue
+            method = None
+            if row.get('method'):
+                method = methods.get(str(row['method']).lower())
+                if not method:
+                    result['error'] = "Unknown payment method '%s'" % row['method']
+                    continue
+            external_id = result['external_id']
+            if external_id:
+                if str(external_id) in recorded:
+                    result['error'] = "Payment '%s' already recorded" % external_id
+                    continue
+                recorded.add(str(external_id))
+            payment_date = None
+            if row.get('payment_date'):
+                try:
+                    payment_date = date.fromisoformat(str(row['payment_date']))
+                except ValueError:
+                    result['error'] = "Invalid payment date '%s'" % row['payment_date']
+                    continue
+            owed[bill.id] -= amount
+            result['payment_date'] = payment_date
+            result['payment'] = Payment(bill=bill, user=bill.user, amount=amount, method=method, external_id=external_id, note=row.get('note') or None)
+        return results
+
+    def record_payments(self, rows, created_by=None):
+        ''' Record a batch of payments and refresh the totals of the bills they pay.
+
+        All the valid rows are saved in one transaction and the invalid ones are skipped.
+        Returns the results from validate_payments() with the 'payment' saved.
+        '''
+        results = self.validate_payments(rows)
+        valid = [r for r in results if 'payment' in r]
+        with transaction.atomic():
+            payments = [r['payment'] for r in valid]
+            for payment in payments:
+                payment.created_by = created_by
+            # The journal and backdating below need the primary keys
+            if connection.features.can_return_rows_from_bulk_insert:
+                self.bulk_create(payments, batch_size=500)
+            else:
+                for payment in payments:
+                    payment.save()
+            with billing_journal(source=BillingEvent.SOURCE_STAFF, created_by=created_by):
+                for payment in payments:
+                    BillingEvent.objects.record(payment.bill_id, BillingEvent.PAYMENT, payment=payment, description=payment.note, amount_after=payment.amount)
+            # created_ts is set automatically on insert so backdate afterwards
+            by_date = {}
+            for result in valid:
+                if result['payment_date']:
+                    by_date.setdefault(result['payment_date'], []).append(result['payment'].id)
+            for payment_date, payment_ids in by_date.items():
+                created_ts = make_aware(datetime.combine(payment_date, datetime.min.time()))
+                self.filter(id__in=payment_ids).update(created_ts=created_ts)
+            UserBill.objects.update_cached_totals({p.bill_id for p in payments})
+        return results
+
+
 class Payment(models.Model):
+    objects = PaymentManager()
+
     created_ts = models.DateTimeField(auto_now_add=True)
     created_by = models.ForeignKey(settings.AUTH_USER_MODEL, related_name="+", null=True, blank=True, on_delete=models.CASCADE)
     bill = models.ForeignKey(UserBill, on_delete=models.CASCADE)
@@ -863,6 +1502,150 @@ class Payment(models.Model):
         return "%s: %s - $%s" % (str(self.created_ts)[:16], self.user, self.amount)
 
 
+class BillingEventManager(models.Manager):
+
+    def record(self, bill_id, action, line_item=None, payment=None, description=None, amount_before=None, amount_after=None, **kwargs):
+        ''' Record something that happened to a bill.
+        Inside a billing_journal() block the event is written with the rest at the end of the block. '''
+        defaults = getattr(_journal, 'defaults', None) or {}
+        for key, value in defaults.items():
+            kwargs.setdefault(key, value)
+        kwargs.setdefault('source', BillingEvent.SOURCE_SIGNAL)
+        if line_item is not None:
+            kwargs['line_item_id'] = line_item.pk
+            if description is None:
+                description = line_item.description
+        if payment is not None:
+            kwargs['payment_id'] = payment.pk
+        event = BillingEvent(
+            bill_id = bill_id,
+            action = action,
+            description = (description or "")[:200],
+            amount_before = amount_before,
+            amount_after = amount_after,
+            **kwargs
+        )
+        events = getattr(_journal, 'events', None)
+        if events is not None:
+            events.append(event)
+        else:
+            event.save()
+        return event
+
+    def for_bill(self, bill):
+        return self.filter(bill_id=getattr(bill, 'pk', bill)).order_by('created_ts', 'id')
+
+    def line_item_amounts(self, bill_ids):
+        ''' Replay the line item events to find what each bill should be made of: {bill_id: {line_item_id: amount}} '''
+        amounts = {}
+        query = self.filter(bill_id__in=bill_ids, line_item_id__isnull=False).order_by('created_ts', 'id')
+        for bill_id, line_item_id, action, amount_after in query.values_list('bill_id', 'line_item_id', 'action', 'amount_after'):
+            items = amounts.setdefault(bill_id, {})
+            if action == BillingEvent.REMOVED:
+                items.pop(line_item_id, None)
+            else:
+                items[line_item_id] = amount_after
+        return amounts
+
+    def verify(self, bills=None):
+        ''' Compare the bills to what the journal says they should add up to.
+
+        Only bills where the journal knows about every line item can be
+        checked.  Returns a dictionary for each bill that does not match.
+        '''
+        if bills is None:
+            bills = UserBill.objects.filter(id__in=self.values('bill_id'))
+        bills = list(bills.values_list('id', 'cached_total_amount'))
+        journal = self.line_item_amounts([b[0] for b in bills])
+        actual = {}
+        for bill_id, line_item_id, amount in BillLineItem.objects.filter(bill_id__in=[b[0] for b in bills]).values_list('bill_id', 'id', 'amount'):
+            actual.setdefault(bill_id, {})[line_item_id] = amount
+
+        mismatches = []
+        for bill_id, cached_amount in bills:
+            expected = journal.get(bill_id, {})
+            line_items = actual.get(bill_id, {})
+            if not set(line_items).issubset(expected):
+                # Line items from before the journal
+                continue
+            journal_amount = sum(expected.values())
+            actual_amount = sum(line_items.values())
+            if expected != line_items or journal_amount != cached_amount:
+                mismatches.append({
+                    'bill_id': bill_id,
+                    'journal_amount': journal_amount,
+                    'actual_amount': actual_amount,
+                    'cached_amount': cached_amount,
+                    'missing': sorted(set(expected) - set(line_items)),
+                    'changed': sorted(i for i in line_items if i in expected and expected[i] != line_items[i]),
+                })
+        return mismatches
+
+
+class BillingEvent(models.Model):
+    ''' Append only journal of everything that happens to a bill.
+
+    Bills, batches and line items come and go so nothing here is a database
+    constraint and events outlive what they point to.
+    '''
+    ADDED = "added"
+    UPDATED = "updated"
+    REMOVED = "removed"
+    RECALCULATED = "recalculated"
+    CLOSED = "closed"
+    PAYMENT = "payment"
+    PAYMENT_REMOVED = "payment_removed"
+    ACTION_CHOICES = (
+        (ADDED, "Line item added"),
+        (UPDATED, "Line item updated"),
+        (REMOVED, "Line item removed"),
+        (RECALCULATED, "Recalculated"),
+        (CLOSED, "Closed"),
+        (PAYMENT, "Payment"),
+        (PAYMENT_REMOVED, "Payment removed"),
+    )
+
+    SOURCE_BATCH = "batch"
+    SOURCE_STAFF = "staff"
+    SOURCE_SIGNAL = "signal"
+    SOURCE_CHOICES = (
+        (SOURCE_BATCH, "Billing batch"),
+        (SOURCE_STAFF, "Staff"),
+        (SOURCE_SIGNAL, "Signal"),
+    )
+
+    objects = BillingEventManager()
+    created_ts = models.DateTimeField(auto_now_add=True)
+    bill = models.ForeignKey(UserBill, related_name="billing_events", db_constraint=False, on_delete=models.DO_NOTHING)
+    batch = models.ForeignKey(BillingBatch, related_name="billing_events", null=True, blank=True, db_constraint=False, on_delete=models.DO_NOTHING)
+    created_by = models.ForeignKey(settings.AUTH_USER_MODEL, related_name="+", null=True, blank=True, db_constraint=False, on_delete=models.DO_NOTHING)
+    source = models.CharField(max_length=16, choices=SOURCE_CHOICES)
+    action = models.CharField(max_length=16, choices=ACTION_CHOICES)
+    line_item_id = models.IntegerField(blank=True, null=True)
+    payment_id = models.IntegerField(blank=True, null=True)
+    description = models.CharField(max_length=200, blank=True)
+    amount_before = models.DecimalField(max_digits=9, decimal_places=2, blank=True, null=True)
+    amount_after = models.DecimalField(max_digits=9, decimal_places=2, blank=True, null=True)
+
+    class Meta:
+        app_label = 'nadine'
+        ordering = ['created_ts', 'id']
+        indexes = [
+            models.Index(fields=['bill', 'created_ts']),
+        ]
+
+    def __str__(self):
+        return "UserBill %s %s: %s" % (self.bill_id, self.action, self.description)
+
+    def save(self, *args, **kwargs):
+        if self.pk:
+            raise Exception("BillingEvents can not be changed")
+        super().save(*args, **kwargs)
+
+    def delete(self, *args, **kwargs):
+        raise Exception("BillingEvents can not be deleted")
+
+
 class StripeBillingProfile(models.Model):
     user = models.ForeignKey(settings.AUTH_USER_MODEL, on_delete=models.CASCADE)
     customer_email = models.EmailField(help_text="Customer email address used with Stripe customer record")
@@ -872,6 +1655,382 @@ class StripeBillingProfile(models.Model):
         return "{} ({}): {}".format(self.user, self.customer_email, self.customer_id)
 
 
+def xero_date(value):
+    ''' Xero hands back datetimes for what are really dates. '''
+    if isinstance(value, datetime):
+        return value.date()
+    return value
+
+
+class XeroInvoiceManager(models.Manager):
+
+    def open(self):
+        return self.filter(status="AUTHORISED")
+
+    def open_by_username(self):
+        ''' All open invoices grouped by username, with "None" for invoices without a linked user. '''
+        invoices = {}
+        for i in self.open().select_related('user').order_by('date'):
+            username = i.user.username if i.user else "None"
+            invoices.setdefault(username, []).append(i)
+        return invoices
+
+    def update_from_xero(self, data, bill=None):
+        ''' Create or update the local copy of an invoice from the data Xero hands back. '''
+        updated_ts = data.get('UpdatedDateUTC')
+        if updated_ts and updated_ts.tzinfo is None:
+            updated_ts = make_aware(updated_ts, timezone.utc)
+        defaults = {
+            'invoice_number': data.get('InvoiceNumber'),
+            'contact_id': data['Contact']['ContactID'],
+            'status': data.get('Status', ''),
+            'date': xero_date(data.get('Date')),
+            'due_date': xero_date(data.get('DueDate')),
+            'total': data.get('Total', 0),
+            'amount_due': data.get('AmountDue', 0),
+            'amount_paid': data.get('AmountPaid', 0),
+            'updated_ts': updated_ts,
+        }
+        if bill is None:
+            bill = self.bill_for_reference(data.get('Reference'))
+        if bill:
+            defaults['bill'] = bill
+        invoice, created = self.update_or_create(invoice_id=data['InvoiceID'], defaults=defaults)
+        return invoice
+
+    def bill_for_reference(self, reference):
+        ''' The unlinked bill an invoice we pushed points back to with its "Bill %d" reference. '''
+        match = re.match(r'^Bill (\d+)$', reference or "")
+        if not match:
+            return None
+        return UserBill.objects.filter(id=int(match.group(1)), xero_invoice__isnull=True).first()
+
+    def link_users(self):
+        ''' Fill in the user of any invoice whose Xero contact has since been linked to one. '''
+        from nadine.models.profile import XeroContact
+        contacts = XeroContact.objects.filter(xero_id=OuterRef('contact_id')).values('user')[:1]
+        return self.filter(user__isnull=True).update(user=Subquery(contacts))
+
+
+class XeroInvoice(models.Model):
+    ''' Local copy of an invoice in Xero so pages never have to wait on the Xero API. '''
+    objects = XeroInvoiceManager()
+    invoice_id = models.CharField(max_length=64, unique=True)
+    invoice_number = models.CharField(max_length=64, blank=True, null=True)
+    contact_id = models.CharField(max_length=64, db_index=True)
+    user = models.ForeignKey(settings.AUTH_USER_MODEL, related_name="xero_invoices", null=True, blank=True, on_delete=models.SET_NULL)
+    bill = models.OneToOneField(UserBill, related_name="xero_invoice", null=True, blank=True, on_delete=models.SET_NULL)
+    status = models.CharField(max_length=32)
+    date = models.DateField(blank=True, null=True)
+    due_date = models.DateField(blank=True, null=True)
+    total = models.DecimalField(max_digits=9, decimal_places=2, default=0)
+    amount_due = models.DecimalField(max_digits=9, decimal_places=2, default=0)
+    amount_paid = models.DecimalField(max_digits=9, decimal_places=2, default=0)
+    updated_ts = models.DateTimeField(blank=True, null=True, help_text="When this invoice was last changed in Xero")
+    synced_ts = models.DateTimeField(auto_now=True)
+
+    def __str__(self):
+        return "%s: %s $%s (%s)" % (self.invoice_number, self.user, self.total, self.status)
+
+    @property
+    def xero_url(self):
+        return "https://go.xero.com/AccountsReceivable/View.aspx?InvoiceID=%s" % self.invoice_id
+
+
+class XeroSyncManager(models.Manager):
+
+    def last_successful(self):
+        return self.filter(completed_ts__isnull=False, error__isnull=True).order_by('created_ts').last()
+
+    def run(self, created_by=None, full=False, push_bills=False, push_since=None, api=None):
+        sync = self.create(created_by=created_by)
+        if sync.run(full=full, push_bills=push_bills, push_since=push_since, api=api):
+            return sync
+        else:
+            raise Exception(sync.error)
+
+
+class XeroSync(models.Model):
+    ''' Pulls changed contacts and invoices from Xero in to the local mirror and pushes new bills up. '''
+    objects = XeroSyncManager()
+    created_ts = models.DateTimeField(auto_now_add=True)
+    created_by = models.ForeignKey(settings.AUTH_USER_MODEL, related_name="+", null=True, blank=True, on_delete=models.CASCADE)
+    completed_ts = models.DateTimeField(blank=True, null=True)
+    since = models.DateTimeField(blank=True, null=True, help_text="Only pull what changed in Xero after this time")
+    contacts_linked = models.IntegerField(default=0)
+    invoices_updated = models.IntegerField(default=0)
+    bills_pushed = models.IntegerField(default=0)
+    error = models.TextField(blank=True, null=True)
+
+    class Meta:
+        app_label = 'nadine'
+        ordering = ['-created_ts']
+        get_latest_by = 'created_ts'
+
+    def __str__(self):
+        return 'XeroSync %s: %s' % (self.created_ts, self.successful)
+
+    @property
+    def successful(self):
+        return self.completed_ts != None and self.error == None
+
+    def run(self, full=False, push_bills=False, push_since=None, api=None):
+        ''' Run an incremental sync starting from the last successful one. '''
+        try:
+            if api is None:
+                from nadine.utils.xero_api import XeroAPI
+                api = XeroAPI()
+
+            if not full:
+                last_sync = XeroSync.objects.last_successful()
+                if last_sync:
+                    self.since = last_sync.created_ts
+
+            self.contacts_linked = self.pull_contacts(api)
+            self.invoices_updated = self.pull_invoices(api)
+            if push_bills:
+                self.push_bills(api, push_since)
+        except Exception as e:
+            self.error = str(e)
+            traceback.print_exc()
+            logger.error(self.error)
+        self.completed_ts = localtime(now())
+        self.save()
+        return self.successful
+
+    def pull_contacts(self, api):
+        ''' Link any changed Xero contacts whose account number is one of our usernames. '''
+        from nadine.models.profile import XeroContact
+        contacts = {}
+        for c in api.get_changed_contacts(self.since):
+            if c.get('AccountNumber'):
+                contacts[c['AccountNumber']] = c['ContactID']
+        linked = 0
+        users = User.objects.filter(username__in=list(contacts.keys()), xero_contact__isnull=True)
+        for user in users:
+            XeroContact.objects.create(user=user, xero_id=contacts[user.username])
+            linked += 1
+        if linked:
+            XeroInvoice.objects.link_users()
+        return linked
+
+    def pull_invoices(self, api):
+        updated = 0
+        for data in api.get_changed_invoices(self.since):
+            XeroInvoice.objects.update_from_xero(data)
+            updated += 1
+        XeroInvoice.objects.link_users()
+        return updated
+
+    def bills_to_push(self, push_since=None):
+        ''' Finished bills with something to pay that have not been sent to Xero. '''
+        today = localtime(now()).date()
+        bills = UserBill.objects.filter(
+            period_end__lt=today,
+            cached_total_amount__gt=0,
+            xero_invoice__isnull=True,
+            user__xero_contact__isnull=False,
+        )
+        if push_since:
+            bills = bills.filter(period_start__gte=push_since)
+        return bills.select_related('user__xero_contact').prefetch_related('line_items').order_by('id')
+
+    def push_bills(self, api, push_since=None):
+        bills = list(self.bills_to_push(push_since))
+        if not bills:
+            return
+        # Each batch is saved as it comes back so a later failure can't leave
+        # invoices in Xero that we don't know about and would push again
+        results = api.put_invoices([bill.xero_invoice_data() for bill in bills])
+        errors = []
+        for bill, data in zip(bills, results):
+            if data.get('ValidationErrors') or not data.get('InvoiceID'):
+                errors.append("Bill %d: %s" % (bill.id, data.get('ValidationErrors')))
+                continue
+            XeroInvoice.objects.update_from_xero(data, bill=bill)
+            self.bills_pushed += 1
+        if errors:
+            raise Exception("Xero rejected %d bills: %s" % (len(errors), "; ".join(errors)))
+
+
+class USAePayTransactionManager(models.Manager):
+
+    def for_day(self, day):
+        return self.filter(transaction_date=day).order_by('date_time')
+
+    def settled_on(self, day):
+        return self.filter(settled_date=day).order_by('date_time')
+
+    def update_from_gateway(self, t, settled_date=None):
+        ''' Create or update the local copy of a cleaned up USAePay transaction. '''
+        date_time = t['date_time']
+        if date_time.tzinfo is None:
+            date_time = make_aware(date_time)
+        defaults = {
+            'username': t['username'] or "",
+            'date_time': date_time,
+            'transaction_date': t['date_time'].date(),
+            'card_type': t['card_type'],
+            'status': t['status'] or "",
+            'transaction_type': t['transaction_type'] or "",
+            'amount': Decimal(str(t['amount'])),
+            'description': t['description'],
+            'note': t['note'],
+        }
+        if settled_date:
+            defaults['settled_date'] = settled_date
+        local_transaction, created = self.update_or_create(transaction_id=t['transaction_id'], defaults=defaults)
+        return local_transaction
+
+    def sync_day(self, day, api=None):
+        ''' Pull the transactions made and checks settled on the given day from USAePay. '''
+        if api is None:
+            from nadine.utils.payment_api import PaymentAPI
+            api = PaymentAPI()
+        if not api.enabled:
+            raise Exception("USAePay is not configured")
+        transactions = api.get_transactions(day.year, day.month, day.day)
+        settled_checks = api.get_checks_settled_by_date(day.year, day.month, day.day)
+        with transaction.atomic():
+            for t in transactions:
+                self.update_from_gateway(t)
+            for t in settled_checks:
+                self.update_from_gateway(t, settled_date=day)
+            self.link_users()
+        return len(transactions) + len(settled_checks)
+
+    def needs_sync(self, day):
+        ''' True if our copy of the given day may no longer match USAePay.
+
+        Today is always out of date.  Other days are synced again if they were
+        last synced before the day was over or still have authorized transactions
+        waiting on the batch to close, but no more than every USAEPAY_SYNC_MINUTES.
+        '''
+        if day == localtime(now()).date():
+            return True
+        on_day = self.filter(Q(transaction_date=day) | Q(settled_date=day))
+        last_synced = on_day.aggregate(last=Max('synced_ts'))['last']
+        if last_synced is None:
+            return True
+        if last_synced > now() - timedelta(minutes=getattr(settings, 'USAEPAY_SYNC_MINUTES', 5)):
+            return False
+        day_over = make_aware(datetime.combine(day + timedelta(days=1), datetime.min.time()))
+        return last_synced < day_over or on_day.filter(status="Authorized").exists()
+
+    def link_users(self):
+        users = User.objects.filter(username=OuterRef('username')).values('id')[:1]
+        return self.filter(user__isnull=True).update(user=Subquery(users))
+
+    def reconcile(self, transactions):
+        ''' Match the given transactions to outstanding bills and open Xero invoices by username and amount.
+        Everything is looked up in bulk no matter how many transactions there are. '''
+        transactions = list(transactions)
+        usernames = set(t.username for t in transactions)
+        bills = {}
+        for bill in UserBill.objects.outstanding().filter(user__username__in=usernames).select_related('user').prefetch_related('line_items').order_by('id'):
+            bills.setdefault(bill.user.username, []).append(bill)
+        invoices = {}
+        for i in XeroInvoice.objects.open().filter(user__username__in=usernames).select_related('user').order_by('date'):
+            invoices.setdefault(i.user.username, []).append(i)
+
+        for t in transactions:
+            t.outstanding_bills = bills.get(t.username, [])
+            t.bill_count = len(t.outstanding_bills)
+            # If the amount matches and there is only one, mark this bill as a match
+            t.bill_match = None
+            if t.bill_count == 1 and t.amount == t.outstanding_bills[0].amount:
+                t.bill_match = t.outstanding_bills[0]
+            # Only show the xero invoices that match this total
+            t.xero_invoices = [i for i in invoices.get(t.username, []) if i.amount_due == t.amount]
+        return transactions
+
+
+class USAePayTransaction(models.Model):
+    ''' Local copy of a USAePay transaction so the charges pages do not have to wait on the SOAP API. '''
+    objects = USAePayTransactionManager()
+    transaction_id = models.CharField(max_length=64, unique=True)
+    username = models.CharField(max_length=128, db_index=True)
+    user = models.ForeignKey(settings.AUTH_USER_MODEL, related_name="+", null=True, blank=True, on_delete=models.SET_NULL)
+    date_time = models.DateTimeField()
+    transaction_date = models.DateField(db_index=True)
+    settled_date = models.DateField(blank=True, null=True, db_index=True, help_text="When this check settled")
+    card_type = models.CharField(max_length=16)
+    status = models.CharField(max_length=32)
+    transaction_type = models.CharField(max_length=32)
+    amount = models.DecimalField(max_digits=9, decimal_places=2)
+    description = models.CharField(max_length=255, blank=True, null=True)
+    note = models.TextField(blank=True, null=True)
+    synced_ts = models.DateTimeField(auto_now=True)
+
+    def __str__(self):
+        return "%s: %s $%s (%s)" % (self.transaction_id, self.username, self.amount, self.status)
+
+
+class USAePayCustomerManager(models.Manager):
+
+    def update_from_gateway(self, username, c):
+        next_date = None
+        if c.Next:
+            next_date = datetime.strptime(str(c.Next)[:10], "%Y-%m-%d").date()
+        defaults = {
+            'username': username,
+            'enabled': bool(c.Enabled),
+            'next_date': next_date,
+            'amount': Decimal(str(c.Amount)) if c.Amount is not None else None,
+            'description': c.Description,
+        }
+        customer, created = self.update_or_create(customer_number=str(c.CustNum), defaults=defaults)
+        return customer
+
+    def sync(self, usernames=None, api=None):
+        ''' Pull the customer records of the given users, or every active member and known customer, from USAePay. '''
+        if api is None:
+            from nadine.utils.payment_api import PaymentAPI
+            api = PaymentAPI()
+        if not api.enabled:
+            raise Exception("USAePay is not configured")
+        if usernames is None:
+            usernames = set(User.helper.active_members().values_list('username', flat=True))
+            usernames.update(self.values_list('username', flat=True))
+        count = 0
+        errors = []
+        results = api.get_customers_for(usernames)
+        with transaction.atomic():
+            for username in sorted(results.keys()):
+                customers = results[username]
+                if isinstance(customers, Exception):
+                    # Leave what we have alone
+                    errors.append("%s: %s" % (username, customers))
+                    continue
+                numbers = [self.update_from_gateway(username, c).customer_number for c in customers]
+                self.filter(username=username).exclude(customer_number__in=numbers).delete()
+                count += len(numbers)
+        self.link_users()
+        if errors:
+            raise Exception("Could not pull %d customers: %s" % (len(errors), "; ".join(errors)))
+        return count
+
+    def link_users(self):
+        users = User.objects.filter(username=OuterRef('username')).values('id')[:1]
+        return self.filter(user__isnull=True).update(user=Subquery(users))
+
+
+class USAePayCustomer(models.Model):
+    ''' Local copy of a USAePay customer and their recurring billing. '''
+    objects = USAePayCustomerManager()
+    customer_number = models.CharField(max_length=64, unique=True)
+    username = models.CharField(max_length=128, db_index=True)
+    user = models.ForeignKey(settings.AUTH_USER_MODEL, related_name="+", null=True, blank=True, on_delete=models.SET_NULL)
+    enabled = models.BooleanField(default=False)
+    next_date = models.DateField(blank=True, null=True)
+    amount = models.DecimalField(max_digits=9, decimal_places=2, blank=True, null=True)
+    description = models.CharField(max_length=255, blank=True, null=True)
+    synced_ts = models.DateTimeField(auto_now=True)
+
+    def __str__(self):
+        return "%s: %s" % (self.customer_number, self.username)
+
+
 class TaxRate(models.Model):
     name = models.CharField(max_length=256, help_text="The name of the tax")
     percentage = models.DecimalField(max_digits=3, decimal_places=2, help_text="Tax percentage")
@@ -881,7 +2040,29 @@ class TaxRate(models.Model):
         return "{} ({}%)".format(self.name, self.percentage * 100)
 
 
+class LineItemTaxManager(models.Manager):
+
+    def for_bills(self, bills):
+        ''' Taxes for one bill ID, a list of bill IDs, or a UserBill queryset. '''
+        if isinstance(bills, int):
+            return self.filter(line_item__bill_id=bills)
+        if isinstance(bills, models.QuerySet):
+            bills = bills.values('id')
+        return self.filter(line_item__bill__in=bills)
+
+    def total_by_bill(self, bills):
+        ''' Total tax for each of the given bills in one grouped query: {bill_id: total} '''
+        query = self.for_bills(bills).values('line_item__bill').annotate(total=Sum('amount')).order_by()
+        return {r['line_item__bill']: r['total'] for r in query}
+
+    def total_by_bill_and_rate(self, bills):
+        ''' Tax for each bill and rate in one grouped query: {(bill_id, rate_id): total} '''
+        query = self.for_bills(bills).values('line_item__bill', 'tax_rate').annotate(total=Sum('amount')).order_by()
+        return {(r['line_item__bill'], r['tax_rate']): r['total'] for r in query}
+
+
 class LineItemTax(models.Model):
+    objects = LineItemTaxManager()
     line_item = models.ForeignKey(BillLineItem, on_delete=models.CASCADE)
     tax_rate = models.ForeignKey(TaxRate, on_delete=models.CASCADE)
     amount = models.DecimalField(max_digits=7, decimal_places=2)
@@ -0,0 +1,746 @@
+import logging
+from collections import defaultdict, deque
+from datetime import datetime, time, timedelta
+
+from django.db import connection, connections, transaction
+from django.db.models import Q
+from django.db.models.functions import Mod
+from django.utils.timezone import localtime, now, make_aware, get_current_timezone
+
+from nadine.models.billing import UserBill, BillingEvent, billing_journal, reset_billing_blocks, BillLineItem, SubscriptionLineItem, CoworkingDayLineItem, EventLineItem, LineItemTax, TaxRate, line_item_key
+from nadine.models.membership import IndividualMembership, OrganizationMembership, MembershipPeriod, ResourceSubscription, bill_period
+from nadine.models.organization import OrganizationMember
+from nadine.models.resource import Resource
+from nadine.models.usage import CoworkingDay, Event
+
+logger = logging.getLogger(__name__)
+
+
+def bulk_create_line_items(line_items):
+    ''' Insert the given unsaved line items with one query per table.
+
+    Django's bulk_create does not support multi-table inheritance so we
+    insert the BillLineItem rows first and then the child rows using the
+    primary keys we got back.
+    '''
+    if not line_items:
+        return line_items
+
+    parents = [BillLineItem(bill_id=i.bill_id, description=i.description, amount=i.amount, custom=i.custom) for i in line_items]
+    if connection.features.can_return_rows_from_bulk_insert:
+        BillLineItem.objects.bulk_create(parents)
+    else:
+        for p in parents:
+            p.save()
+
+    children = defaultdict(list)
+    for line_item, parent in zip(line_items, parents):
+        line_item.pk = parent.pk
+        line_item.id = parent.pk
+        if type(line_item) is not BillLineItem:
+            children[type(line_item)].append(line_item)
+
+    for model, objs in children.items():
+        fields = model._meta.local_concrete_fields
+        batch_size = max(connection.ops.bulk_batch_size(fields, objs), 1)
+        for i in range(0, len(objs), batch_size):
+            model._base_manager._insert(objs[i:i + batch_size], fields=fields, using=connection.alias)
+    return line_items
+
+
+class BillState(object):
+    ''' In-memory view of a UserBill and the line items on it. '''
+
+    def __init__(self, bill, order):
+        self.bill = bill
+        self.order = order
+        self.line_items = []
+        self.changed = False
+        self.period = (bill.period_start, bill.period_end)
+        self.was_open = bill.closed_ts is None
+        # Saved line items that were changed (pk -> (description, amount)) or removed
+        self.originals = {}
+        self.removed = []
+        # Running usage totals kept up to date by append() and remove()
+        self.billable_days = 0
+        self.hours_used = 0
+        self.subscription_counts = defaultdict(int)
+
+    def append(self, line_item):
+        self.line_items.append(line_item)
+        self.count_usage(line_item, 1)
+
+    def remove(self, line_item):
+        self.line_items.remove(line_item)
+        self.count_usage(line_item, -1)
+
+    def count_usage(self, line_item, sign):
+        if type(line_item) is SubscriptionLineItem:
+            self.subscription_counts[line_item.subscription_id] += sign
+        elif type(line_item) is CoworkingDayLineItem:
+            if line_item.day.billable:
+                self.billable_days += sign
+        elif type(line_item) is EventLineItem:
+            self.hours_used += sign * line_item.event.hours
+
+    @property
+    def is_open(self):
+        return self.bill.closed_ts is None
+
+    def items_of_type(self, model):
+        return [i for i in self.line_items if type(i) is model]
+
+    def subscriptions(self):
+        ''' Distinct subscriptions on this bill in the order the database would return them. '''
+        subscriptions = {}
+        for i in self.items_of_type(SubscriptionLineItem):
+            subscriptions[i.subscription.id] = i.subscription
+        return [subscriptions[k] for k in sorted(subscriptions)]
+
+    def has_subscription(self, subscription):
+        return self.subscription_counts[subscription.id] > 0
+
+    def coworking_days(self):
+        return [i.day for i in self.items_of_type(CoworkingDayLineItem)]
+
+    def events(self):
+        return [i.event for i in self.items_of_type(EventLineItem)]
+
+    def resource_allowance(self, resource):
+        return sum(s.allowance for s in self.subscriptions() if s.resource_id == resource.id)
+
+    def resource_overage_rate(self, resource):
+        for s in self.subscriptions():
+            if s.resource_id == resource.id:
+                return s.overage_rate
+        return resource.default_rate
+
+
+class BillingEngine(object):
+    ''' Set-based replacement for running BillingBatch.run_billing_for_day one day at a time.
+
+    Everything needed to bill the date range is loaded up front, the days are
+    walked in memory with the same rules as the day by day run, and the
+    resulting bills, line items and taxes are written with bulk queries.
+
+    Payers are independent of each other so the work can be split in to
+    shards.  An engine with shards > 1 only bills the payers whose user ID
+    falls in its shard.
+    '''
+
+    def __init__(self, start_date, end_date, shard=0, shards=1):
+        self.start_date = start_date
+        self.end_date = end_date
+        self.shard = shard
+        self.shards = shards
+        # Bill states in order, so they never need sorting
+        self.bill_states = []
+        # Bill states with a subscription line item by subscription ID
+        self.states_by_subscription = defaultdict(list)
+        self.batch_states = []
+        self.batch_orders = set()
+        self.new_line_items = []
+        self.updated_line_items = []
+        self.deleted_line_item_ids = set()
+        self.cleared_tax_line_item_ids = set()
+        self.changes = []
+
+    ############################################################################
+    # Loading
+    ############################################################################
+
+    def load(self):
+        ''' Pull all the data needed for the date range in a fixed number of queries. '''
+        self.day_resource = Resource.objects.day_resource
+        self.event_resource = Resource.objects.event_resource
+
+        # Tax rates by resource
+        self.tax_rates = defaultdict(list)
+        for rate in TaxRate.objects.prefetch_related('resources').order_by('id'):
+            for resource in rate.resources.all():
+                self.tax_rates[resource.id].append(rate)
+
+        # Unbilled activity up to the end of our range
+        self.unbilled_days = deque(CoworkingDay.objects.unbilled(self.end_date).select_related('user', 'paid_by').order_by('visit_date', 'id'))
+        self.unbilled_events = deque(Event.objects.unbilled(self.day_cutoff(self.end_date)).select_related('user', 'paid_by', 'room').order_by('start_ts', 'id'))
+
+        # All subscriptions from the oldest unbilled activity through the end of our range
+        earliest = self.start_date
+        for day in self.unbilled_days:
+            earliest = min(earliest, day.visit_date)
+        for event in self.unbilled_events:
+            earliest = min(earliest, event.start_ts.date())
+        subscription_query = ResourceSubscription.objects.for_period(earliest, self.end_date)
+        self.subscriptions = self.load_subscriptions(subscription_query)
+
+        # Memberships so we can calculate billing periods
+        self.individual_memberships = {}
+        for m in IndividualMembership.objects.all():
+            self.individual_memberships[m.user_id] = m
+        self.organization_memberships = {}
+        for m in OrganizationMembership.objects.all():
+            self.organization_memberships[m.organization_id] = m
+        self.organizations_by_user = defaultdict(list)
+        self.org_member_ids = defaultdict(set)
+        for user_id, org_id, org_name in OrganizationMember.objects.values_list('user_id', 'organization_id', 'organization__name'):
+            if (org_name, org_id) not in self.organizations_by_user[user_id]:
+                self.organizations_by_user[user_id].append((org_name, org_id))
+            self.org_member_ids[org_id].add(user_id)
+        for orgs in self.organizations_by_user.values():
+            orgs.sort()
+
+        # Index the subscriptions by membership and by user
+        self.subscriptions_by_membership = defaultdict(list)
+        self.subscriptions_by_user = defaultdict(list)
+        for s in self.subscriptions:
+            self.subscriptions_by_membership[s.membership_id].append(s)
+            if s.membership.is_individual:
+                self.subscriptions_by_user[s.membership.individualmembership.user_id].append(s)
+            elif s.membership.is_organization:
+                for user_id in self.org_member_ids[s.membership.organizationmembership.organization_id]:
+                    self.subscriptions_by_user[user_id].append(s)
+
+        # Users with an active individual membership today, used when pricing events
+        today = localtime(now()).date()
+        active_periods = MembershipPeriod.objects.filter(Q(end_date__isnull=True) | Q(end_date__gte=today), start_date__lte=today)
+        active_memberships = IndividualMembership.objects.filter(id__in=active_periods.values('membership_id'))
+        self.member_ids = set(active_memberships.values_list('user_id', flat=True))
+
+        # Subscriptions billed on closed bills in our range
+        self.billed_periods = defaultdict(list)
+        closed_items = SubscriptionLineItem.objects.filter(bill__closed_ts__isnull=False, bill__period_start__lte=self.end_date, bill__period_end__gte=self.start_date)
+        for subscription_id, period_start, period_end in closed_items.values_list('subscription_id', 'bill__period_start', 'bill__period_end'):
+            self.billed_periods[subscription_id].append((period_start, period_end))
+
+        # Every open bill along with its line items
+        self.open_bills = defaultdict(list)
+        states = {}
+        bill_query = UserBill.objects.open().select_related('user').order_by('id')
+        line_items = BillLineItem.objects.filter(bill__closed_ts__isnull=True)
+        if self.shards > 1:
+            bill_query = bill_query.annotate(shard=Mod('user_id', self.shards)).filter(shard=self.shard)
+            line_items = line_items.annotate(shard=Mod('bill__user_id', self.shards)).filter(shard=self.shard)
+        for bill in bill_query:
+            state = BillState(bill, bill.id)
+            states[bill.id] = state
+            self.add_bill_state(state)
+        self.next_order = max(list(states.keys()) + [0]) + 1
+        line_items = line_items.select_related(
+            'subscriptionlineitem__subscription',
+            'coworkingdaylineitem__day__user',
+            'eventlineitem__event__user',
+            'eventlineitem__event__room',
+        ).order_by('id')
+        subscriptions = {s.id: s for s in self.subscriptions}
+        missing = set()
+        open_items = []
+        for item in line_items:
+            if hasattr(item, 'subscriptionlineitem'):
+                item = item.subscriptionlineitem
+                if item.subscription_id not in subscriptions:
+                    missing.add(item.subscription_id)
+            elif hasattr(item, 'coworkingdaylineitem'):
+                item = item.coworkingdaylineitem
+            elif hasattr(item, 'eventlineitem'):
+                item = item.eventlineitem
+            open_items.append(item)
+        if missing:
+            for s in self.load_subscriptions(ResourceSubscription.objects.filter(id__in=missing)):
+                subscriptions[s.id] = s
+        for item in open_items:
+            if type(item) is SubscriptionLineItem:
+                item.subscription = subscriptions[item.subscription_id]
+            item.bill = states[item.bill_id].bill
+            states[item.bill_id].append(item)
+            self.index_line_item(states[item.bill_id], item)
+
+    def load_subscriptions(self, query):
+        query = query.select_related(
+            'resource',
+            'paid_by',
+            'membership__individualmembership__user',
+            'membership__organizationmembership__organization__lead',
+        )
+        return list(query.order_by('id'))
+
+    def add_bill_state(self, state):
+        # States are always added in order
+        self.bill_states.append(state)
+        self.open_bills[state.bill.user_id].append(state)
+
+    def index_line_item(self, state, line_item):
+        if type(line_item) is SubscriptionLineItem:
+            states = self.states_by_subscription[line_item.subscription_id]
+            if state not in states:
+                states.append(state)
+
+    def day_cutoff(self, target_date):
+        ''' The same datetime the database would compare a DateTimeField to for the given date. '''
+        return make_aware(datetime.combine(target_date, time()), get_current_timezone())
+
+    ############################################################################
+    # Lookups
+    ############################################################################
+
+    def membership_for_user(self, user):
+        ''' In-memory version of Membership.objects.for_user(). '''
+        for org_name, org_id in self.organizations_by_user.get(user.id, []):
+            org_membership = self.organization_memberships.get(org_id)
+            if org_membership:
+                return org_membership
+            break
+        return self.individual_memberships[user.id]
+
+    def get_period(self, membership, target_date):
+        ''' In-memory version of Membership.get_period(). '''
+        for s in self.subscriptions_by_membership[membership.id]:
+            if s.is_active(target_date):
+                return bill_period(membership.bill_day, target_date)
+        return (None, None)
+
+    def payer(self, user, paid_by, target_date, resource):
+        ''' In-memory version of CoworkingDay.payer and Event.payer. '''
+        if paid_by:
+            return paid_by
+        for s in self.subscriptions_by_user[user.id]:
+            if s.resource_id == resource.id and s.is_active(target_date):
+                return s.payer
+        return user
+
+    def is_billed(self, subscription, target_date):
+        ''' True if this subscription is on a bill with a period containing the given date. '''
+        for period_start, period_end in self.billed_periods[subscription.id]:
+            if period_start <= target_date and period_end >= target_date:
+                return True
+        for state in self.states_by_subscription[subscription.id]:
+            bill = state.bill
+            if bill.period_start <= target_date and bill.period_end >= target_date and state.has_subscription(subscription):
+                return True
+        return False
+
+    def in_shard(self, user):
+        ''' True if this engine is responsible for billing the given user. '''
+        return user.id % self.shards == self.shard
+
+    def is_member(self, user):
+        ''' In-memory version of user.membership.active_subscriptions().exists(). '''
+        return user.id in self.member_ids
+
+    def get_open_bill(self, user, period_start, period_end):
+        ''' In-memory version of UserBill.objects.get_open_bill(). '''
+        bills = []
+        for state in self.open_bills[user.id]:
+            if state.bill.period_start <= period_start and state.bill.period_end >= period_end:
+                bills.append(state)
+        if len(bills) > 1:
+            raise Exception("Found more than one bill (%s)!" % [s.bill for s in bills])
+        if bills:
+            return bills[0]
+        return None
+
+    def get_or_create_open_bill(self, user, period_start, period_end, check_open_bills=True):
+        ''' In-memory version of UserBill.objects.get_or_create_open_bill(). '''
+        state = self.get_open_bill(user, period_start, period_end)
+        if state:
+            return state
+
+        # If there is no bill for this specific period, find any open bill
+        if check_open_bills and self.open_bills[user.id]:
+            last_open_bill = max(self.open_bills[user.id], key=lambda s: (s.bill.due_date, s.order))
+            bill = last_open_bill.bill
+            if bill.period_start > period_start:
+                bill.period_start = period_start
+            if bill.period_end < period_end:
+                bill.period_end = period_end
+            last_open_bill.changed = True
+            return last_open_bill
+
+        # Create a new UserBill
+        bill = UserBill(
+            user = user,
+            period_start = period_start,
+            period_end = period_end,
+            due_date = period_end,
+        )
+        state = BillState(bill, self.next_order)
+        state.changed = True
+        self.next_order += 1
+        self.add_bill_state(state)
+        return state
+
+    ############################################################################
+    # Line Items
+    ############################################################################
+
+    def line_item_resource(self, line_item):
+        if type(line_item) is SubscriptionLineItem:
+            return line_item.subscription.resource
+        if type(line_item) is CoworkingDayLineItem:
+            return self.day_resource
+        return self.event_resource
+
+    def calculate_taxes(self, line_item):
+        line_item.taxes = []
+        if line_item.amount != 0:
+            for rate in self.tax_rates[self.line_item_resource(line_item).id]:
+                line_item.taxes.append(LineItemTax(tax_rate=rate, amount=line_item.calculate_tax_amount(rate)))
+
+    def add_line_item(self, state, line_item):
+        self.calculate_taxes(line_item)
+        state.append(line_item)
+        self.index_line_item(state, line_item)
+        state.changed = True
+        self.new_line_items.append(line_item)
+        return line_item
+
+    def remove_line_item(self, state, line_item):
+        state.remove(line_item)
+        state.changed = True
+        if line_item.pk:
+            self.deleted_line_item_ids.add(line_item.pk)
+            state.removed.append(line_item)
+        else:
+            self.new_line_items.remove(line_item)
+
+    def add_subscription(self, state, subscription):
+        line_item = state.bill.subscription_line_item(subscription)
+        return self.add_line_item(state, line_item)
+
+    def add_coworking_day(self, state, day):
+        resource = self.day_resource
+        allowance = state.resource_allowance(resource)
+        overage_rate = state.resource_overage_rate(resource)
+        line_item = state.bill.coworking_day_line_item(day, resource, allowance, overage_rate, state.billable_days)
+        return self.add_line_item(state, line_item)
+
+    def add_event(self, state, event):
+        resource = self.event_resource
+        is_member = self.is_member(state.bill.user)
+        allowance = state.resource_allowance(resource)
+        overage_rate = state.resource_overage_rate(resource)
+        amount = state.bill.event_charge_for_usage(event, is_member, state.hours_used, allowance, overage_rate)
+        line_item = state.bill.event_line_item(event, amount)
+        return self.add_line_item(state, line_item)
+
+    def add_to_batch(self, state):
+        if state.order not in self.batch_orders:
+            self.batch_orders.add(state.order)
+            self.batch_states.append(state)
+
+    ############################################################################
+    # Billing
+    ############################################################################
+
+    def run(self):
+        ''' Load everything and run billing for every day in our range. '''
+        self.load()
+        target_date = self.start_date
+        while target_date <= self.end_date:
+            self.run_billing_for_day(target_date)
+            target_date = target_date + timedelta(days=1)
+
+    def run_billing_for_day(self, target_date):
+        logger.debug("run_billing_for_day(%s)" % target_date)
+        to_recalculate = self.run_subscriptions(target_date)
+        self.run_usage(target_date)
+        for state in to_recalculate:
+            self.recalculate(state)
+        self.close_bills_at_end_of_period(target_date)
+
+    def run_subscriptions(self, target_date):
+        to_recalculate = []
+        for subscription in self.subscriptions:
+            if not subscription.is_active(target_date) or self.is_billed(subscription, target_date):
+                continue
+
+            if not self.in_shard(subscription.payer):
+                continue
+
+            # Look at the membership of the payer to find the bill period
+            membership = self.membership_for_user(subscription.payer)
+            period_start, period_end = self.get_period(membership, target_date)
+            if period_start is None:
+                # If we did not get a period, the payer is not active on this date
+                # Look instead at the membership for the individual
+                membership = self.membership_for_user(subscription.user)
+                period_start, period_end = self.get_period(membership, target_date)
+
+            # Find the open bill for this period and add this subscription
+            state = self.get_or_create_open_bill(subscription.payer, period_start, period_end, check_open_bills=False)
+            if not state.has_subscription(subscription):
+                self.add_subscription(state, subscription)
+                self.add_to_batch(state)
+                # If we have any activity for this resource, flag for recalculation
+                if subscription.resource_id == self.day_resource.id:
+                    activity = state.coworking_days()
+                elif subscription.resource_id == self.event_resource.id:
+                    activity = state.events()
+                else:
+                    activity = None
+                if activity and state not in to_recalculate:
+                    to_recalculate.append(state)
+        return to_recalculate
+
+    def run_usage(self, target_date):
+        # Pull and add all past unbilled CoworkingDays
+        while self.unbilled_days and self.unbilled_days[0].visit_date <= target_date:
+            day = self.unbilled_days.popleft()
+            payer = self.payer(day.user, day.paid_by, day.visit_date, self.day_resource)
+            if not self.in_shard(payer):
+                continue
+            state = self.get_or_create_open_bill(payer, day.visit_date, day.visit_date)
+            self.add_coworking_day(state, day)
+            self.add_to_batch(state)
+
+        # Pull and add all past unbilled Events
+        cutoff = self.day_cutoff(target_date)
+        while self.unbilled_events and self.unbilled_events[0].start_ts <= cutoff:
+            event = self.unbilled_events.popleft()
+            day = event.start_ts.date()
+            payer = self.payer(event.user, event.paid_by, day, self.event_resource)
+            if not self.in_shard(payer):
+                continue
+            state = self.get_or_create_open_bill(payer, day, day)
+            self.add_event(state, event)
+
+    def desired_line_items(self, state):
+        ''' In-memory version of UserBill.desired_line_items(). '''
+        bill = state.bill
+        line_items = []
+        for s in state.subscriptions():
+            line_items.append(bill.subscription_line_item(s))
+
+        resource = self.day_resource
+        allowance = state.resource_allowance(resource)
+        overage_rate = state.resource_overage_rate(resource)
+        billable_count = 0
+        for day in sorted(state.coworking_days(), key=lambda d: (d.visit_date, d.id)):
+            line_items.append(bill.coworking_day_line_item(day, resource, allowance, overage_rate, billable_count))
+            if day.billable:
+                billable_count += 1
+
+        events = sorted(state.events(), key=lambda e: (e.start_ts, e.id))
+        if events:
+            is_member = self.is_member(bill.user)
+            allowance = state.resource_allowance(self.event_resource)
+            overage_rate = state.resource_overage_rate(self.event_resource)
+            hours_used = 0
+            for event in events:
+                amount = bill.event_charge_for_usage(event, is_member, hours_used, allowance, overage_rate)
+                line_items.append(bill.event_line_item(event, amount))
+                hours_used += event.hours
+        return line_items
+
+    def recalculate(self, state):
+        ''' In-memory version of UserBill.recalculate(). '''
+        logger.info("Recalculating bill %s for %s" % (state.bill.id, state.bill.user))
+        existing = {}
+        orphans = []
+        for line_item in state.line_items:
+            if line_item.custom:
+                continue
+            if type(line_item) is BillLineItem:
+                # Not for a subscription, day or event and not added by staff
+                orphans.append(line_item)
+            else:
+                existing[line_item_key(line_item)] = line_item
+
+        for desired in self.desired_line_items(state):
+            line_item = existing.pop(line_item_key(desired), None)
+            if line_item is None:
+                self.add_line_item(state, desired)
+                self.changes.append((state, "Added %s: $%s" % (desired.description, desired.amount)))
+            elif line_item.amount != desired.amount or line_item.description != desired.description:
+                if line_item.pk:
+                    state.originals.setdefault(line_item.pk, (line_item.description, line_item.amount))
+                    self.changes.append((state, "Updated %s: $%s to %s: $%s" % (line_item.description, line_item.amount, desired.description, desired.amount)))
+                    if line_item not in self.updated_line_items:
+                        self.updated_line_items.append(line_item)
+                    if line_item.amount != desired.amount:
+                        self.cleared_tax_line_item_ids.add(line_item.pk)
+                line_item.amount = desired.amount
+                line_item.description = desired.description
+                self.calculate_taxes(line_item)
+                state.changed = True
+
+        # Anything left over no longer belongs on this bill
+        for line_item in list(existing.values()) + orphans:
+            if line_item.pk:
+                self.changes.append((state, "Removed %s: $%s" % (line_item.description, line_item.amount)))
+            self.remove_line_item(state, line_item)
+        if state.changed:
+            self.add_to_batch(state)
+
+    def close_bills_at_end_of_period(self, target_date):
+        ''' Close the open bills with subscriptions at the end of their period. '''
+        for state in self.bill_states:
+            if state.is_open and state.bill.period_end == target_date and state.subscriptions():
+                state.bill.closed_ts = localtime(now())
+                state.bill.in_progress = False
+                state.changed = True
+                self.open_bills[state.bill.user_id].remove(state)
+                self.add_to_batch(state)
+
+    ############################################################################
+    # Preview
+    ############################################################################
+
+    def preview(self):
+        ''' Describe what saving would do to the bills without writing anything.
+
+        Returns one dictionary per new, changed or closed bill.
+        '''
+        rows = []
+        for state in self.bill_states:
+            bill = state.bill
+            added = [i for i in state.line_items if i.pk is None]
+            updated = [i for i in state.line_items if i.pk in state.originals]
+            if bill.pk is None:
+                status = "new"
+            elif state.was_open and not state.is_open:
+                status = "closed"
+            elif added or updated or state.removed or state.period != (bill.period_start, bill.period_end):
+                status = "changed"
+            else:
+                continue
+
+            def original_amount(line_item):
+                if line_item.pk in state.originals:
+                    return state.originals[line_item.pk][1]
+                return line_item.amount
+
+            line_items = []
+            for i in added:
+                line_items.append({'action': "added", 'description': i.description, 'amount_before': None, 'amount_after': i.amount})
+            for i in updated:
+                description, amount = state.originals[i.pk]
+                line_items.append({'action': "changed", 'description': i.description, 'amount_before': amount, 'amount_after': i.amount})
+            for i in state.removed:
+                line_items.append({'action': "removed", 'description': i.description, 'amount_before': original_amount(i), 'amount_after': None})
+
+            amount_before = None
+            if bill.pk:
+                saved = [i for i in state.line_items if i.pk] + state.removed
+                amount_before = sum(original_amount(i) for i in saved)
+            rows.append({
+                'bill_id': bill.pk,
+                'username': bill.user.username,
+                'status': status,
+                'period_start': bill.period_start,
+                'period_end': bill.period_end,
+                'amount_before': amount_before,
+                'amount_after': sum(i.amount for i in state.line_items),
+                'line_items': line_items,
+            })
+        return rows
+
+    ############################################################################
+    # Saving
+    ############################################################################
+
+    def save(self):
+        ''' Write all the changes to the database and return the bills touched by this batch. '''
+        # Nothing gets journaled if the changes are rolled back
+        with billing_journal():
+            return self.save_changes()
+
+    def save_changes(self):
+        with transaction.atomic():
+            # Create the new bills and update the existing ones
+            new_bills = [s.bill for s in self.bill_states if s.bill.pk is None]
+            changed_bills = [s.bill for s in self.bill_states if s.changed and s.bill.pk is not None]
+            if connection.features.can_return_rows_from_bulk_insert:
+                UserBill.objects.bulk_create(new_bills)
+            else:
+                for bill in new_bills:
+                    bill.save()
+            UserBill.objects.bulk_update(changed_bills, ['period_start', 'period_end', 'due_date', 'closed_ts', 'in_progress'])
+
+            # Apply the changes from recalculating existing line items
+            if self.deleted_line_item_ids:
+                BillLineItem.objects.filter(id__in=self.deleted_line_item_ids).delete()
+            if self.cleared_tax_line_item_ids:
+                LineItemTax.objects.filter(line_item__in=self.cleared_tax_line_item_ids).delete()
+            self.updated_line_items = [i for i in self.updated_line_items if i.pk not in self.deleted_line_item_ids]
+            updated = [BillLineItem(id=i.pk, amount=i.amount, description=i.description) for i in self.updated_line_items]
+            BillLineItem.objects.bulk_update(updated, ['amount', 'description'])
+
+            # Add all the new line items and their taxes
+            for line_item in self.new_line_items:
+                line_item.bill_id = line_item.bill.pk
+            bulk_create_line_items(self.new_line_items)
+            taxes = []
+            for line_item in self.new_line_items:
+                for tax in line_item.taxes:
+                    tax.line_item_id = line_item.pk
+                    taxes.append(tax)
+            for line_item in self.updated_line_items:
+                if line_item.pk in self.cleared_tax_line_item_ids:
+                    for tax in line_item.taxes:
+                        tax.line_item_id = line_item.pk
+                        taxes.append(tax)
+            LineItemTax.objects.bulk_create(taxes)
+            self.record_events()
+
+        logger.info("Saved %d new bills, %d line items, %d taxes" % (len(new_bills), len(self.new_line_items), len(taxes)))
+        return [s.bill for s in self.batch_states]
+
+    def record_events(self):
+        ''' Journal the saved changes.  Removed line items are journaled when they are deleted. '''
+        states = {s.bill.pk: s for s in self.bill_states}
+        for line_item in self.new_line_items:
+            BillingEvent.objects.record(line_item.bill_id, BillingEvent.ADDED, line_item=line_item, amount_after=line_item.amount)
+        for line_item in self.updated_line_items:
+            state = states[line_item.bill_id]
+            description, amount = state.originals.get(line_item.pk, (None, None))
+            BillingEvent.objects.record(line_item.bill_id, BillingEvent.UPDATED, line_item=line_item, amount_before=amount, amount_after=line_item.amount)
+        for state in self.bill_states:
+            if state.was_open and not state.is_open:
+                amount = sum(i.amount for i in state.line_items)
+                BillingEvent.objects.record(state.bill.pk, BillingEvent.CLOSED, amount_after=amount)
+
+    def change_log(self):
+        ''' Describe each change made to existing line items while recalculating. '''
+        return ["UserBill %d: %s" % (state.bill.id, change) for state, change in self.changes]
+
+
+
+def run_billing_shard(start_date, end_date, shard, shards, batch_id=None):
+    ''' Run one shard of a billing batch in its own transaction.
+
+    The results are returned as plain data so this can run in a worker
+    process with the parent BillingBatch collecting the results.
+    '''
+    try:
+        engine = BillingEngine(start_date, end_date, shard=shard, shards=shards)
+        engine.run()
+        with billing_journal(source=BillingEvent.SOURCE_BATCH, batch=batch_id):
+            bills = engine.save()
+        return {
+            'shard': shard,
+            'bill_ids': [b.id for b in bills],
+            'changes': engine.change_log(),
+            'error': None,
+        }
+    except Exception as e:
+        logger.exception("Billing shard %d of %d failed" % (shard + 1, shards))
+        return {
+            'shard': shard,
+            'bill_ids': [],
+            'changes': [],
+            'error': str(e),
+        }
+
+
+def billing_shard_worker(start_date, end_date, shard, shards, batch_id=None):
+    ''' Entry point for running a billing shard in a worker process. '''
+    # Never share a database connection with another process
+    connections.close_all()
+    # Nor the billing blocks the parent was in when it forked
+    reset_billing_blocks()
+    try:
+        return run_billing_shard(start_date, end_date, shard, shards, batch_id)
+    finally:
+        connections.close_all()
+
+# Copyright 2021 Office Nomads LLC (https://officenomads.com/) Licensed under the AGPL License, Version 3.0 (the "License"); you may not use this file except in compliance with the License. You may obtain a copy of the License at https://www.gnu.org/licenses/agpl-3.0.html. Unless required by applicable law or agreed to in writing, software distributed under the License is distributed on an "AS IS" BASIS, WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the License for the specific language governing permissions and limitations under the License.
@@ -7,20 +7,22 @@ import traceback
 import operator
 import logging
 import hashlib
+import bisect
 import calendar
 from random import random
 from datetime import datetime, time, date, timedelta
 from dateutil.relativedelta import relativedelta
 from decimal import Decimal
 
-from django.db import models, IntegrityError, transaction
-from django.db.models import F, Q, Count, Sum, Value
+from django.db import models, connection, IntegrityError, transaction
+from django.db.models import F, Q, Count, Sum, Value, Func
 from django.db.models.functions import Coalesce
 from django.db.models.fields import DecimalField
 from django.contrib import admin
 from django.core.files.base import ContentFile
 from django.contrib.auth.models import User
-from django.db.models.signals import post_save
+from django.db.models.signals import post_save, post_delete
+from django.dispatch import receiver
 from django.db.models import Sum
 from django.conf import settings
 from django.utils.encoding import smart_str
@@ -34,6 +36,40 @@ from nadine.models.organization import Organization
 logger = logging.getLogger(__name__)
 
 
+def bill_period(bill_day, target_date):
+    ''' Calculate the billing period (start, end) containing target_date for the given bill_day. '''
+    # The period starts on the bill_day of the month we're operating in.
+    if target_date.day == bill_day:
+        period_start = target_date
+    else:
+        month = target_date.month
+        year = target_date.year
+        if target_date.day < bill_day:
+            # Go back one month
+            month = target_date.month - 1
+            if month == 0:
+                # In January go back one year too
+                month = 12
+                year = target_date.year - 1
+
+            # Make sure we are creating a valid date with these
+            month_start, month_end = calendar.monthrange(year, month)
+            if month_end < bill_day:
+                # We went too far, but now we know what to do
+                period_start = date(year, target_date.month, 1)
+                period_end = date(year, target_date.month, int(bill_day) - 1)
+                return (period_start, period_end)
+
+        # print("year=%d, month=%s, day=%s" % (year, month, day))
+        period_start = date(year, month, bill_day)
+
+    period_end = period_start + relativedelta(months=1)
+    if period_end.day == period_start.day:
+        period_end = period_end - timedelta(days=1)
+
+    return (period_start, period_end)
+
+
 class MemberGroups():
     ALL = "all"
     HAS_DESK = "has_desk"
@@ -120,10 +156,14 @@ class MembershipManager(models.Manager):
     def active_memberships(self, target_date=None, package_name=None):
         if not target_date:
             target_date = localtime(now()).date()
-        current = Q(subscriptions__start_date__lte=target_date)
-        unending = Q(subscriptions__end_date__isnull=True)
-        future_ending = Q(subscriptions__end_date__gte=target_date)
-        membership_query = self.filter(current & (unending | future_ending)).distinct()
+        if use_date_ranges():
+            active = ResourceSubscription.objects.active_on(target_date)
+            membership_query = self.filter(id__in=active.values('membership_id'))
+        else:
+            current = Q(subscriptions__start_date__lte=target_date)
+            unending = Q(subscriptions__end_date__isnull=True)
+            future_ending = Q(subscriptions__end_date__gte=target_date)
+            membership_query = self.filter(current & (unending | future_ending)).distinct()
         if package_name:
             membership_query = membership_query.filter(package__name=package_name)
         return membership_query
@@ -432,7 +472,9 @@ class Membership(models.Model):
         return ResourceSubscription.objects.filter(membership=self, start_date__gt=target_date)
 
     def is_active(self, target_date=None):
-        return self.subscriptions_for_day(target_date).count() > 0
+        if not target_date:
+            target_date = localtime(now()).date()
+        return MembershipPeriod.objects.active_on(self, target_date).exists()
 
     def will_be_active(self, target_date=None):
         ''' Return the date this membership will be active if there are subscriptions in the future '''
@@ -458,36 +500,7 @@ class Membership(models.Model):
         if not self.is_active(target_date):
             return (None, None)
 
-        # The period starts on the bill_day of the month we're operating in.
-        if target_date.day == self.bill_day:
-            period_start = target_date
-        else:
-            month = target_date.month
-            year = target_date.year
-            if target_date.day < self.bill_day:
-                # Go back one month
-                month = target_date.month - 1
-                if month == 0:
-                    # In January go back one year too
-                    month = 12
-                    year = target_date.year - 1
-
-                # Make sure we are creating a valid date with these
-                month_start, month_end = calendar.monthrange(year, month)
-                if month_end < self.bill_day:
-                    # We went too far, but now we know what to do
-                    period_start = date(year, target_date.month, 1)
-                    period_end = date(year, target_date.month, int(self.bill_day) - 1)
-                    return (period_start, period_end)
-
-            # print("year=%d, month=%s, day=%s" % (year, month, day))
-            period_start = date(year, month, self.bill_day)
-
-        period_end = period_start + relativedelta(months=1)
-        if period_end.day == period_start.day:
-            period_end = period_end - timedelta(days=1)
-
-        return (period_start, period_end)
+        return bill_period(self.bill_day, target_date)
 
     def is_period_boundary(self, target_date=None):
         period = self.get_period(target_date=target_date)
@@ -554,22 +567,57 @@ class OrganizationMembership(Membership):
         return '%s: %s' % (self.organization, self.subscriptions.all())
 
 
+def use_date_ranges():
+    ''' True if subscriptions should be looked up by date with the PostgreSQL daterange index. '''
+    return connection.vendor == 'postgresql' and getattr(settings, 'SUBSCRIPTION_DATE_RANGES', True)
+
+
+class ActiveRange(Func):
+    ''' The days a subscription is active as a PostgreSQL daterange.  Subscriptions that end
+    before they start are never active so they get an empty range instead of an error.
+    This has to match the expression the index was built with (see migration 0047). '''
+    template = "CASE WHEN %(end_date)s < %(start_date)s THEN 'empty'::daterange ELSE daterange(%(start_date)s, %(end_date)s, '[]') END"
+
+    def __init__(self, **extra):
+        from django.contrib.postgres.fields import DateRangeField
+        super().__init__(F('start_date'), F('end_date'), output_field=DateRangeField(), **extra)
+
+    def as_sql(self, compiler, connection, **extra_context):
+        start_sql, start_params = compiler.compile(self.source_expressions[0])
+        end_sql, end_params = compiler.compile(self.source_expressions[1])
+        sql = self.template % {'start_date': start_sql, 'end_date': end_sql}
+        return sql, (end_params + start_params + start_params + end_params)
+
+
 class SubscriptionManager(models.Manager):
 
-    def for_period(self, period_start, period_end):
-        ''' Return all active subscriptions for a given period. '''
+    def active_on(self, target_date):
+        ''' Subscriptions active on the given date. '''
+        if use_date_ranges():
+            return self.alias(active_range=ActiveRange()).filter(active_range__contains=target_date)
+        current = Q(start_date__lte=target_date)
+        unending = Q(end_date__isnull=True)
+        future_ending = Q(end_date__gte=target_date)
+        return self.filter(current & (unending | future_ending))
+
+    def overlapping(self, period_start, period_end):
+        ''' Subscriptions active on any day from period_start to period_end. '''
+        if use_date_ranges():
+            from psycopg2.extras import DateRange
+            return self.alias(active_range=ActiveRange()).filter(active_range__overlap=DateRange(period_start, period_end, '[]'))
         started = Q(start_date__lte=period_end)
         unending = Q(end_date__isnull=True)
         future_ending = Q(end_date__gte=period_start)
-        return self.filter(started).filter(unending | future_ending).distinct()
+        return self.filter(started).filter(unending | future_ending)
+
+    def for_period(self, period_start, period_end):
+        ''' Return all active subscriptions for a given period. '''
+        return self.overlapping(period_start, period_end).distinct()
 
     def active_subscriptions(self, target_date=None):
         if not target_date:
             target_date = localtime(now()).date()
-        current = Q(start_date__lte=target_date)
-        unending = Q(end_date__isnull=True)
-        future_ending = Q(end_date__gte=target_date)
-        return self.filter(current & (unending | future_ending)).distinct()
+        return self.active_on(target_date).distinct()
 
     def active_subscriptions_with_username(self, target_date=None):
         ''' Return the set of active subscriptions including the username for each subscription. '''
@@ -676,6 +724,109 @@ class ResourceSubscription(models.Model):
         return Decimal(prorate_days) / period_days
 
 
+class MembershipPeriodManager(models.Manager):
+
+    def active_on(self, membership, target_date):
+        ''' The active period containing the given date (if any). '''
+        started = Q(start_date__lte=target_date)
+        unending = Q(end_date__isnull=True)
+        future_ending = Q(end_date__gte=target_date)
+        return self.filter(membership=membership).filter(started & (unending | future_ending))
+
+    def rebuild(self, membership):
+        ''' Replace the active periods of this membership with ones calculated from the subscriptions. '''
+        membership_id = getattr(membership, 'id', membership)
+        subscriptions = ResourceSubscription.objects.filter(membership_id=membership_id)
+        ranges = subscriptions.values_list('start_date', 'end_date')
+        with transaction.atomic():
+            self.filter(membership_id=membership_id).delete()
+            periods = [MembershipPeriod(membership_id=membership_id, start_date=s, end_date=e) for s, e in merge_date_ranges(ranges)]
+            self.bulk_create(periods)
+        return periods
+
+    def rebuild_all(self):
+        ''' Rebuild the active periods of every membership and return how many were rebuilt. '''
+        membership_ids = Membership.objects.values_list('id', flat=True)
+        for membership_id in membership_ids:
+            self.rebuild(membership_id)
+        return len(membership_ids)
+
+    def index(self, memberships=None):
+        ''' Load the active periods of many memberships into a MembershipPeriodIndex. '''
+        query = self.all()
+        if memberships is not None:
+            query = query.filter(membership__in=memberships)
+        return MembershipPeriodIndex(query.values_list('membership_id', 'start_date', 'end_date'))
+
+
+class MembershipPeriod(models.Model):
+    ''' A stretch of days where a membership has at least one subscription.
+
+    These are maintained from the ResourceSubscriptions so that checking if a
+    membership is active is a single indexed range query.  Billing periods are
+    then calculated from the bill_day.
+    '''
+    objects = MembershipPeriodManager()
+
+    membership = models.ForeignKey(Membership, related_name="periods", on_delete=models.CASCADE)
+    start_date = models.DateField()
+    end_date = models.DateField(blank=True, null=True)
+
+    class Meta:
+        ordering = ['membership', 'start_date']
+        indexes = [models.Index(fields=['membership', 'start_date', 'end_date'])]
+
+    def __str__(self):
+        return "%s: %s - %s" % (self.membership_id, self.start_date, self.end_date or "")
+
+
+class MembershipPeriodIndex(object):
+    ''' In memory lookup of the active periods for a set of memberships. '''
+
+    def __init__(self, periods):
+        self.periods = {}
+        for membership_id, start_date, end_date in periods:
+            self.periods.setdefault(membership_id, []).append((start_date, end_date))
+        for ranges in self.periods.values():
+            ranges.sort()
+        self.starts = {m: [r[0] for r in ranges] for m, ranges in self.periods.items()}
+
+    def is_active(self, membership, target_date):
+        membership_id = getattr(membership, 'id', membership)
+        starts = self.starts.get(membership_id)
+        if not starts:
+            return False
+        i = bisect.bisect_right(starts, target_date) - 1
+        if i < 0:
+            return False
+        end_date = self.periods[membership_id][i][1]
+        return end_date is None or end_date >= target_date
+
+    def get_period(self, membership, target_date):
+        ''' Same as Membership.get_period() without touching the database. '''
+        if not self.is_active(membership, target_date):
+            return (None, None)
+        return bill_period(membership.bill_day, target_date)
+
+
+def merge_date_ranges(ranges):
+    ''' Merge (start_date, end_date) pairs into the fewest non overlapping ranges.
+    An end_date of None is open ended and ranges ending before they start are skipped. '''
+    merged = []
+    valid = [r for r in ranges if r[1] is None or r[1] >= r[0]]
+    for start_date, end_date in sorted(valid, key=lambda r: r[0]):
+        if merged:
+            last_start, last_end = merged[-1]
+            if last_end is None:
+                break
+            if start_date <= last_end + timedelta(days=1):
+                if end_date is None or end_date > last_end:
+                    merged[-1] = (last_start, end_date)
+                continue
+        merged.append((start_date, end_date))
+    return merged
+
+
 class SecurityDeposit(models.Model):
     user = models.ForeignKey(settings.AUTH_USER_MODEL, on_delete=models.CASCADE)
     received_date = models.DateField()
@@ -684,4 +835,22 @@ class SecurityDeposit(models.Model):
     note = models.CharField(max_length=128, blank=True, null=True)
 
 
+###############################################################################
+# Call Backs
+###############################################################################
+
+
+@receiver(post_save, sender=ResourceSubscription)
+def subscription_period_callback(sender, **kwargs):
+    if kwargs.get('raw'): return
+    subscription = kwargs['instance']
+    MembershipPeriod.objects.rebuild(subscription.membership_id)
+
+
+@receiver(post_delete, sender=ResourceSubscription)
+def subscription_period_delete_callback(sender, **kwargs):
+    subscription = kwargs['instance']
+    MembershipPeriod.objects.rebuild(subscription.membership_id)
+
+
 # Copyright 2021 Office Nomads LLC (https://officenomads.com/) Licensed under the AGPL License, Version 3.0 (the "License"); you may not use this file except in compliance with the License. You may obtain a copy of the License at https://www.gnu.org/licenses/agpl-3.0.html. Unless required by applicable law or agreed to in writing, software distributed under the License is distributed on an "AS IS" BASIS, WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the License for the specific language governing permissions and limitations under the License.
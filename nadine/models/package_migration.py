@@ -0,0 +1,183 @@
+import logging
+from datetime import timedelta
+
+from django.conf import settings
+from django.db import transaction
+from django.db.models import Q
+from django.utils.timezone import localtime, now
+
+from nadine.models.alerts import MemberAlert
+from nadine.models.billing import SubscriptionLineItem
+from nadine.models.membership import MembershipPackage, MembershipPeriod, ResourceSubscription
+from nadine.models.profile import clear_user_helper_cache
+from nadine.models.resource import Resource
+from nadine.models.stats import DailyStats
+
+logger = logging.getLogger(__name__)
+
+
+class PackageChange(object):
+    ''' The subscription changes that move one membership to the new package. '''
+
+    def __init__(self, membership, user):
+        self.membership = membership
+        self.user = user
+        # Subscriptions ended the day before the change
+        self.ending = []
+        # Subscriptions that had not started yet and are replaced
+        self.removed = []
+        # Subscriptions that had not started yet but are already on a bill
+        self.billed = []
+        # New subscriptions from the package defaults
+        self.created = []
+
+    def old_resources(self):
+        return set(s.resource_id for s in self.ending + self.removed + self.billed)
+
+    def new_resources(self):
+        return set(s.resource_id for s in self.created)
+
+    def __str__(self):
+        description = "%s: ending %d, removing %d, adding %d" % (self.user, len(self.ending), len(self.removed), len(self.created))
+        if self.billed:
+            description += ", already billed %s" % ", ".join(str(s.id) for s in self.billed)
+        return description
+
+
+class PackageMigration(object):
+    ''' Move every membership on one package to another package, or to the current
+    rates of the same package, as of a given date.
+
+    The changes are all worked out before anything is saved.  They are then
+    written with bulk queries in one transaction, and the alerts and
+    integrations run once per member instead of once per subscription.
+
+    Subscriptions starting on or after the change are deleted, which would take
+    their line items with them.  If any of them are already on a bill they are
+    listed in the plan and nothing is applied.
+    '''
+
+    def __init__(self, from_package, to_package=None, change_date=None, created_by=None):
+        self.from_name = getattr(from_package, 'name', from_package)
+        if to_package is None:
+            to_package = self.from_name
+        if not isinstance(to_package, MembershipPackage):
+            to_package = MembershipPackage.objects.get(name=to_package)
+        self.to_package = to_package
+        self.change_date = change_date or localtime(now()).date()
+        self.created_by = created_by
+        self.changes = None
+
+    def plan(self):
+        ''' Work out the changes for every membership on the old package. '''
+        if self.changes is not None:
+            return self.changes
+        defaults = list(self.to_package.defaults.all())
+        if not defaults:
+            raise Exception("Package '%s' has no subscription defaults" % self.to_package.name)
+
+        # Subscriptions from the old package that are active on or after the change
+        current = Q(end_date__isnull=True) | Q(end_date__gte=self.change_date)
+        subscriptions = ResourceSubscription.objects.filter(current, package_name=self.from_name)
+        subscriptions = subscriptions.select_related('membership__individualmembership__user', 'membership__organizationmembership__organization__lead')
+        by_membership = {}
+        upcoming = []
+        for s in subscriptions.order_by('membership_id', 'start_date'):
+            by_membership.setdefault(s.membership_id, []).append(s)
+            if s.start_date >= self.change_date:
+                upcoming.append(s.id)
+        billed = set()
+        if upcoming:
+            billed = set(SubscriptionLineItem.objects.filter(subscription__in=upcoming).values_list('subscription_id', flat=True))
+
+        self.changes = []
+        for membership_id, old in by_membership.items():
+            active = [s for s in old if s.is_active(self.change_date)]
+            if not active:
+                # Only memberships on the package when it changes are moved
+                continue
+            # Keep the end date and payer of the old subscriptions
+            end_date = None
+            if all(s.end_date for s in active):
+                end_date = max(s.end_date for s in active)
+            payers = set(s.paid_by_id for s in active)
+            paid_by_id = payers.pop() if len(payers) == 1 else None
+
+            change = PackageChange(active[0].membership, active[0].user)
+            for s in old:
+                if s.start_date < self.change_date:
+                    s.end_date = self.change_date - timedelta(days=1)
+                    change.ending.append(s)
+                elif s.id in billed:
+                    change.billed.append(s)
+                else:
+                    change.removed.append(s)
+            for default in defaults:
+                change.created.append(ResourceSubscription(
+                    created_by = self.created_by,
+                    membership_id = membership_id,
+                    package_name = self.to_package.name,
+                    resource_id = default.resource_id,
+                    allowance = default.allowance,
+                    start_date = self.change_date,
+                    end_date = end_date,
+                    monthly_rate = default.monthly_rate,
+                    overage_rate = default.overage_rate,
+                    paid_by_id = paid_by_id,
+                ))
+            self.changes.append(change)
+        return self.changes
+
+    def apply(self):
+        ''' Save all the changes and then let everyone know.  Returns the changes. '''
+        changes = self.plan()
+        if not changes:
+            return changes
+        billed = [s for c in changes for s in c.billed]
+        if billed:
+            raise Exception("Subscriptions starting on or after %s are already on bills: %s" % (self.change_date, ", ".join(str(s.id) for s in billed)))
+        ending = [s for c in changes for s in c.ending]
+        removed = [s.id for c in changes for s in c.removed]
+        created = [s for c in changes for s in c.created]
+        logger.info("Moving %d memberships from '%s' to '%s' on %s" % (len(changes), self.from_name, self.to_package.name, self.change_date))
+
+        with transaction.atomic():
+            ResourceSubscription.objects.bulk_update(ending, ['end_date'], batch_size=500)
+            if removed:
+                ResourceSubscription.objects.filter(id__in=removed).delete()
+            ResourceSubscription.objects.bulk_create(created, batch_size=500)
+
+            # Bulk queries skip the save callbacks so catch up on what they would have done
+            for change in changes:
+                MembershipPeriod.objects.rebuild(change.membership.id)
+            DailyStats.objects.mark_stale(self.change_date)
+        clear_user_helper_cache()
+
+        self.notify(changes)
+        return changes
+
+    def notify(self, changes):
+        ''' Run the alerts for each member once. '''
+        if getattr(settings, 'SUSPEND_MEMBER_ALERTS', False): return
+        users = [c.user for c in changes if c.user]
+        MemberAlert.objects.handle_change_memberships(users)
+
+        handlers = [
+            (Resource.objects.desk_resource, MemberAlert.objects.handle_new_desk, MemberAlert.objects.handle_ending_desk),
+            (Resource.objects.key_resource, MemberAlert.objects.handle_new_key, MemberAlert.objects.handle_ending_key),
+            (Resource.objects.mail_resource, MemberAlert.objects.handle_new_mail, MemberAlert.objects.handle_ending_mail),
+        ]
+        for change in changes:
+            if not change.user:
+                continue
+            old_resources = change.old_resources()
+            new_resources = change.new_resources()
+            for resource, handle_new, handle_ending in handlers:
+                if resource.id in new_resources and resource.id not in old_resources:
+                    handle_new(change.user)
+                elif resource.id in old_resources and resource.id not in new_resources:
+                    if not change.membership.has_resource(resource, self.change_date):
+                        handle_ending(change.user, self.change_date - timedelta(days=1))
+
+
+# Copyright 2021 Office Nomads LLC (https://officenomads.com/) Licensed under the AGPL License, Version 3.0 (the "License"); you may not use this file except in compliance with the License. You may obtain a copy of the License at https://www.gnu.org/licenses/agpl-3.0.html. Unless required by applicable law or agreed to in writing, software distributed under the License is distributed on an "AS IS" BASIS, WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the License for the specific language governing permissions and limitations under the License.
@@ -0,0 +1,250 @@
+import logging
+from datetime import datetime, timedelta
+
+from django.db import models
+from django.db.models import Q
+from django.db.models.signals import pre_save, post_save, post_delete
+from django.dispatch import receiver
+from django.apps import apps
+from django.conf import settings
+from django.contrib.auth.models import User
+from django.utils.timezone import localtime, now, make_aware
+
+from nadine.models.usage import CoworkingDay
+
+logger = logging.getLogger(__name__)
+
+
+def session_gap():
+    ''' How long someone can go unseen before the next sighting starts a new session. '''
+    return timedelta(minutes=getattr(settings, 'PRESENCE_SESSION_GAP', 30))
+
+
+class PresenceSessionManager(models.Manager):
+
+    ############################################################################
+    # Recording
+    ############################################################################
+
+    def record(self, user_id, source, timestamp):
+        ''' Add a sighting to the session it belongs to or start a new one. '''
+        day = localtime(timestamp).date()
+        gap = session_gap()
+        session = self.filter(user_id=user_id, source=source, day=day, start_ts__lte=timestamp + gap, end_ts__gte=timestamp - gap).first()
+        if session:
+            start_ts = min(session.start_ts, timestamp)
+            end_ts = max(session.end_ts, timestamp)
+            if (start_ts, end_ts) != (session.start_ts, session.end_ts):
+                self.filter(pk=session.pk).update(start_ts=start_ts, end_ts=end_ts)
+            return session
+        return self.create(user_id=user_id, source=source, day=day, start_ts=timestamp, end_ts=timestamp)
+
+    def sessions_from(self, source, sightings):
+        ''' Build sessions from (user_id, timestamp) sightings sorted by user and time. '''
+        gap = session_gap()
+        session = None
+        for user_id, timestamp in sightings:
+            day = localtime(timestamp).date()
+            if session and session.user_id == user_id and session.day == day and timestamp - session.end_ts <= gap:
+                session.end_ts = timestamp
+                continue
+            if session:
+                yield session
+            session = PresenceSession(user_id=user_id, source=source, day=day, start_ts=timestamp, end_ts=timestamp)
+        if session:
+            yield session
+
+    def rebuild(self, start_date, end_date, users=None, sources=None):
+        ''' Recreate the sessions for these days from the arp logs, door events and coworking days. '''
+        if sources is None:
+            sources = [s for s, d in PresenceSession.SOURCE_CHOICES]
+        start = make_aware(datetime.combine(start_date, datetime.min.time()))
+        end = make_aware(datetime.combine(end_date + timedelta(days=1), datetime.min.time()))
+        user_ids = [getattr(u, 'pk', u) for u in users] if users is not None else None
+
+        old = self.filter(day__range=(start_date, end_date), source__in=sources)
+        if user_ids is not None:
+            old = old.filter(user_id__in=user_ids)
+        old.delete()
+
+        sessions = []
+        if PresenceSession.ARP in sources and apps.is_installed('arpwatch'):
+            ArpLog = apps.get_model('arpwatch', 'ArpLog')
+            query = ArpLog.objects.filter(runtime__gte=start, runtime__lt=end, device__ignore=False, device__user__isnull=False)
+            if user_ids is not None:
+                query = query.filter(device__user__in=user_ids)
+            sightings = query.values_list('device__user', 'runtime').order_by('device__user', 'runtime').iterator()
+            sessions.extend(self.sessions_from(PresenceSession.ARP, sightings))
+        if PresenceSession.DOOR in sources and apps.is_installed('doors.keymaster'):
+            DoorEvent = apps.get_model('keymaster', 'DoorEvent')
+            query = DoorEvent.objects.filter(timestamp__gte=start, timestamp__lt=end, user__isnull=False)
+            if user_ids is not None:
+                query = query.filter(user__in=user_ids)
+            sightings = query.values_list('user', 'timestamp').order_by('user', 'timestamp').iterator()
+            sessions.extend(self.sessions_from(PresenceSession.DOOR, sightings))
+        if PresenceSession.COWORKING in sources:
+            query = CoworkingDay.objects.filter(visit_date__range=(start_date, end_date))
+            if user_ids is not None:
+                query = query.filter(user__in=user_ids)
+            for day in query.iterator():
+                sessions.append(coworking_session(day))
+        self.bulk_create(sessions, batch_size=500)
+        return len(sessions)
+
+    def refresh_coworking(self, user_id, day):
+        ''' Match the coworking session for this user and day to their CoworkingDay. '''
+        self.filter(user_id=user_id, source=PresenceSession.COWORKING, day=day).delete()
+        coworking_day = CoworkingDay.objects.filter(user_id=user_id, visit_date=day).first()
+        if coworking_day:
+            coworking_session(coworking_day).save()
+
+    ############################################################################
+    # Queries
+    ############################################################################
+
+    def here_now(self):
+        ''' Users seen in the last PRESENCE_SESSION_GAP minutes. '''
+        right_now = now()
+        sessions = self.filter(end_ts__gte=right_now - session_gap(), start_ts__lte=right_now)
+        return User.objects.filter(id__in=sessions.values('user'))
+
+    def here_on(self, target_date):
+        ''' Users who were on the network, signed in, or came through a door on this day.
+        Door events only count for active members. '''
+        active_door = Q(source=PresenceSession.DOOR, user__in=User.helper.active_members())
+        sessions = self.filter(day=target_date).filter(~Q(source=PresenceSession.DOOR) | active_door)
+        return User.objects.filter(id__in=sessions.values('user'))
+
+    def first_seen(self, user):
+        session = self.filter(user=user).order_by('start_ts').first()
+        return session.start_ts if session else None
+
+    def last_seen(self, user):
+        session = self.filter(user=user).order_by('-end_ts').first()
+        return session.end_ts if session else None
+
+    def history(self, user, start_date=None, end_date=None):
+        sessions = self.filter(user=user)
+        if start_date:
+            sessions = sessions.filter(day__gte=start_date)
+        if end_date:
+            sessions = sessions.filter(day__lte=end_date)
+        return sessions.order_by('-start_ts')
+
+
+class PresenceSession(models.Model):
+    ''' A stretch of time someone was seen in the space by one source. '''
+    ARP = "arp"
+    DOOR = "door"
+    COWORKING = "coworking"
+    SOURCE_CHOICES = (
+        (ARP, "Network"),
+        (DOOR, "Door"),
+        (COWORKING, "Signed In"),
+    )
+
+    objects = PresenceSessionManager()
+    user = models.ForeignKey(settings.AUTH_USER_MODEL, related_name="presence_sessions", on_delete=models.CASCADE)
+    source = models.CharField(max_length=16, choices=SOURCE_CHOICES)
+    day = models.DateField()
+    start_ts = models.DateTimeField()
+    end_ts = models.DateTimeField()
+
+    class Meta:
+        app_label = 'nadine'
+        ordering = ['start_ts']
+        indexes = [
+            models.Index(fields=['day', 'source', 'user']),
+            models.Index(fields=['user', 'start_ts']),
+            models.Index(fields=['user', 'end_ts']),
+            models.Index(fields=['end_ts']),
+        ]
+
+    def __str__(self):
+        return '%s: %s from %s to %s' % (self.user, self.source, self.start_ts, self.end_ts)
+
+    @property
+    def duration(self):
+        return self.end_ts - self.start_ts
+
+
+def coworking_session(coworking_day):
+    ''' A session for the time someone signed in, or the start of the day if it was entered later. '''
+    timestamp = coworking_day.created_ts
+    if not timestamp or localtime(timestamp).date() != coworking_day.visit_date:
+        timestamp = make_aware(datetime.combine(coworking_day.visit_date, datetime.min.time()))
+    return PresenceSession(user_id=coworking_day.user_id, source=PresenceSession.COWORKING, day=coworking_day.visit_date, start_ts=timestamp, end_ts=timestamp)
+
+
+###############################################################################
+# Call Backs
+###############################################################################
+
+
+@receiver(post_save, sender='arpwatch.ArpLog')
+def arp_log_presence_callback(sender, **kwargs):
+    if kwargs.get('raw') or not kwargs.get('created'): return
+    log = kwargs['instance']
+    device = log.device
+    if device.user_id and not device.ignore:
+        PresenceSession.objects.record(device.user_id, PresenceSession.ARP, log.runtime)
+
+
+@receiver(pre_save, sender='arpwatch.UserDevice')
+def device_presence_callback(sender, **kwargs):
+    if kwargs.get('raw'): return
+    device = kwargs['instance']
+    if not device.pk:
+        return
+    old = sender.objects.filter(pk=device.pk).values_list('user_id', 'ignore').first()
+    if old and old != (device.user_id, device.ignore):
+        # Today's network sessions follow the device to its new owner
+        device._presence_users = [u for u in (old[0], device.user_id) if u]
+
+
+@receiver(post_save, sender='arpwatch.UserDevice')
+def device_presence_save_callback(sender, **kwargs):
+    device = kwargs['instance']
+    users = getattr(device, '_presence_users', None)
+    if users:
+        today = localtime(now()).date()
+        PresenceSession.objects.rebuild(today, today, users=users, sources=[PresenceSession.ARP])
+        device._presence_users = None
+
+
+@receiver(post_save, sender='keymaster.DoorEvent')
+def door_event_presence_callback(sender, **kwargs):
+    if kwargs.get('raw') or not kwargs.get('created'): return
+    event = kwargs['instance']
+    if event.user_id:
+        PresenceSession.objects.record(event.user_id, PresenceSession.DOOR, event.timestamp)
+
+
+@receiver(pre_save, sender=CoworkingDay)
+def coworking_day_presence_pre_save_callback(sender, **kwargs):
+    if kwargs.get('raw'): return
+    day = kwargs['instance']
+    if day.pk:
+        old = CoworkingDay.objects.filter(pk=day.pk).values_list('user_id', 'visit_date').first()
+        if old and old != (day.user_id, day.visit_date):
+            day._presence_old = old
+
+
+@receiver(post_save, sender=CoworkingDay)
+def coworking_day_presence_callback(sender, **kwargs):
+    if kwargs.get('raw'): return
+    day = kwargs['instance']
+    old = getattr(day, '_presence_old', None)
+    if old:
+        PresenceSession.objects.refresh_coworking(old[0], old[1])
+        day._presence_old = None
+    PresenceSession.objects.refresh_coworking(day.user_id, day.visit_date)
+
+
+@receiver(post_delete, sender=CoworkingDay)
+def coworking_day_presence_delete_callback(sender, **kwargs):
+    day = kwargs['instance']
+    PresenceSession.objects.refresh_coworking(day.user_id, day.visit_date)
+
+
+# Copyright 2021 Office Nomads LLC (https://officenomads.com/) Licensed under the AGPL License, Version 3.0 (the "License"); you may not use this file except in compliance with the License. You may obtain a copy of the License at https://www.gnu.org/licenses/agpl-3.0.html. Unless required by applicable law or agreed to in writing, software distributed under the License is distributed on an "AS IS" BASIS, WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the License for the specific language governing permissions and limitations under the License.
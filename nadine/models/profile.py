@@ -3,6 +3,10 @@ import uuid
 import random, string
 import logging
 import hashlib
+import threading
+
+from contextlib import contextmanager
+from functools import wraps
 
 from datetime import datetime, time, date, timedelta
 from dateutil.relativedelta import relativedelta
@@ -25,7 +29,7 @@ from taggit.models import TaggedItemBase
 # imports for signals
 import django.dispatch
 from django.dispatch import receiver
-from django.db.models.signals import pre_save, post_save
+from django.db.models.signals import pre_save, post_save, post_delete
 from PIL import Image
 
 from nadine.settings import TIME_ZONE
@@ -35,6 +39,7 @@ from nadine.models.core import GENDER_CHOICES, HowHeard, Industry, Neighborhood,
 from nadine.models.membership import Membership, IndividualMembership, ResourceSubscription, SecurityDeposit
 from nadine.models.resource import Resource
 from nadine.models.usage import CoworkingDay
+from nadine.models.presence import PresenceSession
 from nadine.models.organization import Organization
 from nadine import email
 
@@ -57,6 +62,62 @@ def user_file_upload_path(instance, filename):
     return filename
 
 
+# What User.helper has returned for the request each thread is working on
+_helper_cache = threading.local()
+
+
+@contextmanager
+def user_helper_cache(enabled=True):
+    ''' Remember what User.helper returns for the rest of this block.
+
+    Calls with the same method and arguments get back the same result so a
+    queryset that has already been evaluated is not queried again.  Nested
+    blocks share the outer cache.  Use enabled=False for code that writes
+    and then needs to read its own changes.
+    '''
+    results = getattr(_helper_cache, 'results', None)
+    if not enabled:
+        _helper_cache.results = None
+        try:
+            yield None
+        finally:
+            _helper_cache.results = results
+        return
+    if results is not None:
+        yield results
+        return
+    _helper_cache.results = {}
+    try:
+        yield _helper_cache.results
+    finally:
+        _helper_cache.results = None
+
+
+def clear_user_helper_cache():
+    results = getattr(_helper_cache, 'results', None)
+    if results:
+        results.clear()
+
+
+def memoized_helper(method):
+    ''' Cache the results of a UserQueryHelper method inside a user_helper_cache block. '''
+    @wraps(method)
+    def wrapper(self, *args, **kwargs):
+        results = getattr(_helper_cache, 'results', None)
+        if results is None:
+            return method(self, *args, **kwargs)
+        key = (method.__name__, args, tuple(sorted(kwargs.items())))
+        try:
+            if key in results:
+                return results[key]
+        except TypeError:
+            # Arguments we can't hash are never cached
+            return method(self, *args, **kwargs)
+        results[key] = method(self, *args, **kwargs)
+        return results[key]
+    return wrapper
+
+
 ###############################################################################
 # Models and Managers
 ###############################################################################
@@ -64,20 +125,24 @@ def user_file_upload_path(instance, filename):
 
 class UserQueryHelper():
 
+    @memoized_helper
     def active_individual_members(self, target_date=None):
         individual_memberships = Membership.objects.active_individual_memberships(target_date)
         return User.objects.filter(id__in=individual_memberships.values('individualmembership__user'))
 
+    @memoized_helper
     def active_organization_members(self, target_date=None):
         organization_memberships = Membership.objects.active_organization_memberships(target_date)
         return User.objects.filter(id__in=organization_memberships.values('organizationmembership__organization__organizationmember__user'))
 
+    @memoized_helper
     def active_members(self, target_date=None):
         individual_members = self.active_individual_members(target_date)
         organization_members = self.active_organization_members(target_date)
         combined_query = individual_members | organization_members
         return combined_query.distinct()
 
+    @memoized_helper
     def payers(self, target_date=None):
         ''' Return a set of Users that are paying for the active memberships '''
         # I tried to make this method as easy to read as possible. -- JLS
@@ -100,54 +165,64 @@ class UserQueryHelper():
         combined_set = (individual_payers | organization_leads | other_payers)
         return User.objects.filter(id__in=combined_set).distinct()
 
+    @memoized_helper
     def invalid_billing(self):
         return self.payers().filter(profile__valid_billing=False)
 
+    @memoized_helper
     def here_today(self, target_date=None):
         if not target_date:
             target_date = localtime(now()).date()
 
-        # The members who are on the network
-        from arpwatch.arp import users_for_day_query
-        arp_members_query = users_for_day_query(day=target_date).distinct()
-
-        # The members who have signed in
-        daily_members_query = User.objects.filter(id__in=CoworkingDay.objects.filter(visit_date=target_date).values('user__id')).distinct()
-
-        # The members that have accessed a door
-        door_query = DoorEvent.objects.users_for_day(target_date)
-        door_members_query = User.helper.active_members().filter(id__in=door_query.values('user__id'))
-
-        combined_query = arp_members_query | daily_members_query | door_members_query
-        return combined_query.distinct()
+        return PresenceSession.objects.here_on(target_date)
 
+    @memoized_helper
     def not_signed_in(self, target_date=None):
         if not target_date:
             target_date = localtime(now()).date()
+        return list(self.iter_not_signed_in(target_date, target_date))
 
-        signed_in = []
-        for l in CoworkingDay.objects.filter(visit_date=target_date):
-            signed_in.append(l.user)
-
-        not_signed_in = []
-        for u in self.here_today(target_date):
-            if not u in signed_in and not u.membership.has_desk(target_date):
-                not_signed_in.append({'user':u, 'day':target_date})
-
-        return not_signed_in
-
+    @memoized_helper
     def not_signed_in_since(self, target_date=None):
         if not target_date:
             target_date = localtime(now()).date()
-        not_signed_in = []
-
-        d = localtime(now()).date()
-        while target_date <= d:
-            not_signed_in.extend(self.not_signed_in(d))
-            d = d - timedelta(days=1)
-
-        return not_signed_in
-
+        return list(self.iter_not_signed_in(target_date, localtime(now()).date()))
+
+    def iter_not_signed_in(self, start_date, end_date, chunk_size=1000):
+        ''' Yield {'user', 'day'} for everyone who was on the network or came through a door
+        without signing in and without a desk, newest day first.
+
+        Who was here, who signed in, and who had a desk are each one query for
+        the whole range so the number of queries does not grow with the days.
+        Users are loaded chunk_size at a time as the rows are yielded.
+        '''
+        # Who was on the network or came through a door each day
+        sessions = PresenceSession.objects.filter(day__range=(start_date, end_date))
+        arp = Q(source=PresenceSession.ARP)
+        door = Q(source=PresenceSession.DOOR, user__in=self.active_members())
+        here = set(sessions.filter(arp | door).values_list('user', 'day').distinct().order_by().iterator())
+
+        # Less the ones that signed in
+        signed_in = CoworkingDay.objects.filter(visit_date__range=(start_date, end_date))
+        here.difference_update(signed_in.values_list('user', 'visit_date').order_by().iterator())
+
+        # And the ones with a desk that day
+        desks = {}
+        desk_query = ResourceSubscription.objects.overlapping(start_date, end_date).filter(resource=Resource.objects.desk_resource)
+        for user_id, desk_start, desk_end in desk_query.values_list('membership__individualmembership__user', 'start_date', 'end_date'):
+            desks.setdefault(user_id, []).append((desk_start, desk_end))
+
+        def has_desk(user_id, day):
+            return any(s <= day and (e is None or e >= day) for s, e in desks.get(user_id, []))
+
+        rows = sorted(((day, user_id) for user_id, day in here if not has_desk(user_id, day)), key=lambda r: (-r[0].toordinal(), r[1]))
+        for i in range(0, len(rows), chunk_size):
+            chunk = rows[i:i + chunk_size]
+            users = User.objects.in_bulk({user_id for day, user_id in chunk})
+            for day, user_id in chunk:
+                yield {'user': users[user_id], 'day': day}
+
+    @memoized_helper
     def exiting_members(self, target_date=None):
         if target_date == None:
             target_date = localtime(now())
@@ -158,9 +233,11 @@ class UserQueryHelper():
         tomorrow_memberships = self.active_members(target_date + timedelta(days=1))
         return today_memberships.exclude(id__in=tomorrow_memberships.values('id'))
 
+    @memoized_helper
     def active_member_emails(self):
         return EmailAddress.objects.filter(user__in=self.active_members()).values_list('email', flat=True)
 
+    @memoized_helper
     def expired_slack_users(self):
         expired_users = []
         active_emails = self.active_member_emails()
@@ -176,54 +253,66 @@ class UserQueryHelper():
         three_months_ago = localtime(now()) - relativedelta(months=3)
         return three_months_ago
 
+    @memoized_helper
     def stale_members(self):
         smd = self.stale_member_date()
         recently_used = Q(id__in=CoworkingDay.objects.filter(visit_date__gte=smd).values('user').distinct())
         has_desk = Q(id__in=self.members_with_desks().values('id'))
         return self.active_members().exclude(has_desk).exclude(recently_used).order_by('first_name')
 
+    @memoized_helper
     def missing_member_agreement(self):
         active_agmts = FileUpload.objects.filter(document_type=FileUpload.MEMBER_AGMT, user__in=self.active_members()).distinct()
         users_with_agmts = active_agmts.values('user')
         return self.active_members().exclude(id__in=users_with_agmts).order_by('first_name')
 
+    @memoized_helper
     def missing_key_agreement(self):
         active_agmts = FileUpload.objects.filter(document_type=FileUpload.KEY_AGMT, user__in=self.active_members()).distinct()
         users_with_agmts = active_agmts.values('user')
         return self.members_with_keys().exclude(id__in=users_with_agmts).order_by('first_name')
 
+    @memoized_helper
     def missing_photo(self):
         return self.active_members().filter(profile__photo="").order_by('first_name')
 
+    @memoized_helper
     def members_by_package(self, package_name, target_date=None):
         active_subscriptions = ResourceSubscription.objects.active_subscriptions_with_username(target_date).filter(package_name=package_name)
         return User.objects.filter(username__in=active_subscriptions.values('username'))
 
+    @memoized_helper
     def members_by_resource(self, resource, target_date=None):
         active_subscriptions = ResourceSubscription.objects.active_subscriptions_with_username(target_date).filter(resource=resource)
         return User.objects.filter(username__in=active_subscriptions.values('username'))
 
+    @memoized_helper
     def members_with_desks(self, target_date=None):
         ''' Return a set of users with an active 'desk' subscription. '''
         return self.members_by_resource(Resource.objects.desk_resource, target_date).order_by('first_name')
 
+    @memoized_helper
     def members_with_keys(self, target_date=None):
         ''' Return a set of users with an active 'key' subscription. '''
         return self.members_by_resource(Resource.objects.key_resource, target_date).order_by('first_name')
 
+    @memoized_helper
     def members_with_mail(self, target_date=None):
         ''' Return a set of users with an active 'mail' subscription. '''
         return self.members_by_resource(Resource.objects.mail_resource, target_date).order_by('first_name')
 
+    @memoized_helper
     def members_by_neighborhood(self, hood, active_only=True):
         if active_only:
             return self.active_members().filter(profile__neighborhood=hood)
         else:
             return User.objects.filter(profile__neighborhood=hood)
 
+    @memoized_helper
     def members_with_tag(self, tag):
         return self.active_members().filter(profile__tags__name__in=[tag])
 
+    @memoized_helper
     def managers(self, include_future=False):
         ''' Return the users with active or future subscriptions of type TEAM_MEMBERSHIP_PACKAGE '''
         if hasattr(settings, 'TEAM_MEMBERSHIP_PACKAGE'):
@@ -356,9 +445,8 @@ class UserProfile(models.Model):
         return total
 
     def open_xero_invoices(self):
-        from nadine.utils.xero_api import XeroAPI
-        xero_api = XeroAPI()
-        return xero_api.get_open_invoices(self.user)
+        from nadine.models.billing import XeroInvoice
+        return XeroInvoice.objects.open().filter(user=self.user)
 
     def pay_bills_form(self):
         from nadine.forms import PaymentForm
@@ -581,7 +669,7 @@ class UserProfile(models.Model):
     def has_new_card(self):
         # Check for a new card.  WARNING: kinda expensive
         try:
-            api = PaymentAPI
+            api = PaymentAPI()
             return api.has_new_card(self.user.username)
         except Exception:
             pass
@@ -927,4 +1015,23 @@ def emergency_callback_save_callback(sender, **kwargs):
     contact.last_updated = localtime(now())
 
 
+# Saving or deleting any of these can change what User.helper returns
+HELPER_CACHE_MODELS = (
+    'auth.User', 'nadine.UserProfile', 'nadine.EmailAddress', 'nadine.FileUpload', 'nadine.CoworkingDay',
+    'nadine.Membership', 'nadine.IndividualMembership', 'nadine.OrganizationMembership', 'nadine.ResourceSubscription',
+    'nadine.Organization', 'nadine.OrganizationMember', 'keymaster.DoorEvent', 'arpwatch.ArpLog', 'arpwatch.UserDevice',
+)
+
+
+def helper_cache_callback(sender, **kwargs):
+    if getattr(_helper_cache, 'results', None):
+        clear_user_helper_cache()
+
+
+# Only listen to these models so saving anything else stays as cheap as it was
+for label in HELPER_CACHE_MODELS:
+    post_save.connect(helper_cache_callback, sender=label)
+    post_delete.connect(helper_cache_callback, sender=label)
+
+
 # Copyright 2021 Office Nomads LLC (https://officenomads.com/) Licensed under the AGPL License, Version 3.0 (the "License"); you may not use this file except in compliance with the License. You may obtain a copy of the License at https://www.gnu.org/licenses/agpl-3.0.html. Unless required by applicable law or agreed to in writing, software distributed under the License is distributed on an "AS IS" BASIS, WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the License for the specific language governing permissions and limitations under the License.
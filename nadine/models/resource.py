@@ -6,6 +6,9 @@ from datetime import datetime, timedelta, date
 from abc import ABCMeta, abstractmethod
 
 from django.db import models
+from django.db.models.signals import post_save, post_delete
+from django.dispatch import receiver
+from django.core.cache import caches
 from django.conf import settings
 from django.db.models import Q, F
 from django.contrib.auth.models import User
@@ -19,6 +22,8 @@ from nadine.models.usage import Event
 
 logger = logging.getLogger(__name__)
 
+RESOURCE_CACHE_PREFIX = "nadine.resource."
+
 
 def room_img_upload_to(instance, filename):
     # rename file to a unique string
@@ -176,15 +181,46 @@ class ResourceManager(models.Manager):
     MAIL_KEY = "mail"
     DESK_KEY = "desk"
     EVENT_KEY = "event"
+    KEYS = [DAY_KEY, KEY_KEY, MAIL_KEY, DESK_KEY, EVENT_KEY]
+
+    # Resources by key for this process.  Cleared when any Resource changes.
+    _key_cache = {}
+
+    def shared_cache(self):
+        ''' The cache shared by all workers if RESOURCE_CACHE names one in CACHES. '''
+        alias = getattr(settings, 'RESOURCE_CACHE', None)
+        if alias:
+            return caches[alias]
+        return None
 
     def resource_by_key(self, key):
+        shared = self.shared_cache()
+        if shared is not None:
+            resource = shared.get(RESOURCE_CACHE_PREFIX + key)
+        else:
+            resource = self._key_cache.get(key)
+        if resource is not None:
+            return resource
+
         # print("pulling '%s' resource" % key)
-        resource_search = Resource.objects.filter(key=key)
-        if resource_search.count() == 0:
+        resource_search = list(Resource.objects.filter(key=key)[:2])
+        if len(resource_search) == 0:
             raise Exception("Could not find '%s' resource" % key)
-        if resource_search.count() > 1:
+        if len(resource_search) > 1:
             raise Exception("Multiple '%s' resources found" % key)
-        return resource_search.first()
+        resource = resource_search[0]
+        if shared is not None:
+            shared.set(RESOURCE_CACHE_PREFIX + key, resource)
+        else:
+            self._key_cache[key] = resource
+        return resource
+
+    def clear_cache(self, *keys):
+        ''' Forget every cached resource, here and in the shared cache. '''
+        self._key_cache.clear()
+        shared = self.shared_cache()
+        if shared is not None:
+            shared.delete_many([RESOURCE_CACHE_PREFIX + k for k in set(self.KEYS).union(k for k in keys if k)])
 
     @property
     def day_resource(self):
@@ -217,5 +253,22 @@ class Resource(models.Model):
         return self.name
 
 
+###############################################################################
+# Call Backs
+###############################################################################
+
+
+@receiver(post_save, sender=Resource)
+def resource_save_callback(sender, **kwargs):
+    resource = kwargs['instance']
+    Resource.objects.clear_cache(resource.key)
+
+
+@receiver(post_delete, sender=Resource)
+def resource_delete_callback(sender, **kwargs):
+    resource = kwargs['instance']
+    Resource.objects.clear_cache(resource.key)
+
+
 # Copyright 2021 Office Nomads LLC (https://officenomads.com/) Licensed under the AGPL License, Version 3.0 (the "License"); you may not use this file except in compliance with the License. You may obtain a copy of the License at https://www.gnu.org/licenses/agpl-3.0.html. Unless required by applicable law or agreed to in writing, software distributed under the License is distributed on an "AS IS" BASIS, WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the License for the specific language governing permissions and limitations under the License.
 
@@ -0,0 +1,261 @@
+import logging
+from datetime import datetime, timedelta
+
+from django.db import models
+from django.db.models import Count, Min
+from django.db.models.functions import TruncDate
+from django.db.models.signals import pre_save, post_save, post_delete
+from django.dispatch import receiver
+from django.apps import apps
+from django.conf import settings
+from django.utils.timezone import localtime, now, make_aware
+
+from nadine.models.membership import ResourceSubscription
+from nadine.models.organization import OrganizationMember
+from nadine.models.resource import Resource
+from nadine.models.timeline import MembershipTimeline
+from nadine.models.usage import CoworkingDay
+
+logger = logging.getLogger(__name__)
+
+
+STATS_FIELDS = ['memberships', 'members_by_package', 'desks', 'monthly_revenue', 'started', 'ended',
+    'coworking_days', 'billed_days', 'trial_days', 'waived_days', 'door_users', 'arp_users', 'arp_devices', 'stale']
+
+
+def date_ranges(days):
+    ''' Group the given days in to (start, end) runs of consecutive days. '''
+    ranges = []
+    for day in sorted(set(days)):
+        if ranges and ranges[-1][1] + timedelta(days=1) == day:
+            ranges[-1][1] = day
+        else:
+            ranges.append([day, day])
+    return [tuple(r) for r in ranges]
+
+
+class DailyStatsManager(models.Manager):
+
+    def first_day(self):
+        ''' The first day there is anything to count. '''
+        days = [
+            ResourceSubscription.objects.aggregate(day=Min('start_date'))['day'],
+            CoworkingDay.objects.aggregate(day=Min('visit_date'))['day'],
+        ]
+        days = [d for d in days if d]
+        return min(days) if days else None
+
+    def mark_stale(self, start_date, end_date=None):
+        ''' Flag the rollups for these days to be recalculated.  No end date means every day after start_date. '''
+        query = self.filter(day__gte=start_date)
+        if end_date:
+            query = query.filter(day__lte=end_date)
+        return query.update(stale=True)
+
+    def refresh(self, start_date, end_date):
+        ''' Recalculate and save the rollup for every day from start_date to end_date. '''
+        logger.info("Refreshing daily stats from %s to %s" % (start_date, end_date))
+        timeline = MembershipTimeline(start_date, end_date)
+        memberships = timeline.active_memberships()
+        by_package = timeline.members_by_package()
+        desks = timeline.resource_subscriptions(Resource.objects.desk_resource)
+        revenue = timeline.monthly_revenue()
+        started, ended = timeline.starts_and_ends()
+
+        coworking = {}
+        coworking_query = CoworkingDay.objects.filter(visit_date__range=(start_date, end_date))
+        for day, payment, count in coworking_query.values_list('visit_date', 'payment').annotate(count=Count('id')).order_by():
+            coworking.setdefault(day, {})[payment] = count
+        presence = self.presence(start_date, end_date)
+
+        rows = []
+        for i, day in enumerate(timeline.days()):
+            days = coworking.get(day, {})
+            door_users, arp_users, arp_devices = presence.get(day, (0, 0, 0))
+            rows.append(DailyStats(
+                day = day,
+                memberships = memberships[i],
+                members_by_package = {p: counts[i] for p, counts in by_package.items() if p and counts[i]},
+                desks = desks[i],
+                monthly_revenue = revenue[i],
+                started = timeline.count_between(started, day, day),
+                ended = timeline.count_between(ended, day, day),
+                coworking_days = sum(days.values()),
+                billed_days = days.get('Bill', 0),
+                trial_days = days.get('Trial', 0),
+                waived_days = days.get('Waive', 0),
+                door_users = door_users,
+                arp_users = arp_users,
+                arp_devices = arp_devices,
+                stale = False,
+            ))
+        self.bulk_create(rows, batch_size=500, update_conflicts=True, unique_fields=['day'], update_fields=STATS_FIELDS)
+        return rows
+
+    def presence(self, start_date, end_date):
+        ''' Count who came through the doors and who was on the network each day: {day: (door_users, arp_users, arp_devices)} '''
+        start = make_aware(datetime.combine(start_date, datetime.min.time()))
+        end = make_aware(datetime.combine(end_date + timedelta(days=1), datetime.min.time()))
+        door_users = {}
+        if apps.is_installed('doors.keymaster'):
+            DoorEvent = apps.get_model('keymaster', 'DoorEvent')
+            query = DoorEvent.objects.filter(timestamp__gte=start, timestamp__lt=end, user__isnull=False)
+            for row in query.annotate(day=TruncDate('timestamp')).values('day').annotate(users=Count('user', distinct=True)).order_by():
+                door_users[row['day']] = row['users']
+        arp = {}
+        if apps.is_installed('arpwatch'):
+            ArpLog = apps.get_model('arpwatch', 'ArpLog')
+            query = ArpLog.objects.filter(runtime__gte=start, runtime__lt=end, device__ignore=False)
+            for row in query.annotate(day=TruncDate('runtime')).values('day').annotate(users=Count('device__user', distinct=True), devices=Count('device', distinct=True)).order_by():
+                arp[row['day']] = (row['users'], row['devices'])
+        presence = {}
+        for day in set(door_users) | set(arp):
+            presence[day] = (door_users.get(day, 0), ) + arp.get(day, (0, 0))
+        return presence
+
+    def days_to_refresh(self, start_date, end_date):
+        ''' Days in this range that are stale or have not been counted.  Today and later are always recounted. '''
+        have = set(self.filter(day__range=(start_date, end_date), stale=False).values_list('day', flat=True))
+        today = localtime(now()).date()
+        days = []
+        day = start_date
+        while day <= end_date:
+            if day not in have or day >= today:
+                days.append(day)
+            day = day + timedelta(days=1)
+        return days
+
+    def refresh_stale(self, start_date=None, end_date=None):
+        ''' Recalculate only the days that need it.  Returns the number of days recalculated. '''
+        if start_date is None:
+            start_date = self.first_day()
+            if start_date is None:
+                return 0
+        if end_date is None:
+            end_date = localtime(now()).date()
+        days = self.days_to_refresh(start_date, end_date)
+        # Everything counted between yesterday and now
+        recent = getattr(settings, 'DAILY_STATS_RECENT_DAYS', 2)
+        for i in range(recent):
+            day = end_date - timedelta(days=i)
+            if day >= start_date:
+                days.append(day)
+        for range_start, range_end in date_ranges(days):
+            self.refresh(range_start, range_end)
+        return len(set(days))
+
+    def for_range(self, start_date, end_date):
+        ''' The rollup for every day in this range, in order.
+
+        Only today is recalculated, and no more than every DAILY_STATS_TODAY_MINUTES.
+        Keeping the rest up to date is left to the stats_refresh and stats_backfill
+        commands so pages never have to wait on them.  Days that have not been
+        counted yet come back as unsaved rows of zeros.
+        '''
+        today = localtime(now()).date()
+        if start_date <= today <= end_date:
+            minutes = getattr(settings, 'DAILY_STATS_TODAY_MINUTES', 10)
+            fresh = self.filter(day=today, stale=False, updated_ts__gte=now() - timedelta(minutes=minutes))
+            if not fresh.exists():
+                self.refresh(today, today)
+        stats = {d.day: d for d in self.filter(day__range=(start_date, end_date))}
+        rows = []
+        day = start_date
+        while day <= end_date:
+            rows.append(stats.get(day) or DailyStats(day=day))
+            day = day + timedelta(days=1)
+        return rows
+
+
+class DailyStats(models.Model):
+    ''' Membership, activity, and presence numbers rolled up for one day. '''
+    objects = DailyStatsManager()
+    day = models.DateField(unique=True)
+    memberships = models.IntegerField(default=0)
+    members_by_package = models.JSONField(default=dict, blank=True)
+    desks = models.IntegerField(default=0)
+    monthly_revenue = models.DecimalField(decimal_places=2, max_digits=11, default=0)
+    started = models.IntegerField(default=0, help_text="Subscriptions started on this day")
+    ended = models.IntegerField(default=0, help_text="Subscriptions ended on this day")
+    coworking_days = models.IntegerField(default=0)
+    billed_days = models.IntegerField(default=0)
+    trial_days = models.IntegerField(default=0)
+    waived_days = models.IntegerField(default=0)
+    door_users = models.IntegerField(default=0)
+    arp_users = models.IntegerField(default=0)
+    arp_devices = models.IntegerField(default=0)
+    stale = models.BooleanField(default=False)
+    updated_ts = models.DateTimeField(auto_now=True)
+
+    class Meta:
+        app_label = 'nadine'
+        ordering = ['day']
+        verbose_name_plural = "Daily stats"
+
+    def __str__(self):
+        return "DailyStats %s: %d memberships" % (self.day, self.memberships)
+
+    @property
+    def visits(self):
+        ''' Coworking days from before payment types were tracked. '''
+        return self.coworking_days - self.billed_days - self.trial_days - self.waived_days
+
+    def package_members(self, package_name):
+        return self.members_by_package.get(package_name, 0)
+
+
+###############################################################################
+# Call Backs
+###############################################################################
+
+
+@receiver(post_save, sender=CoworkingDay)
+def coworking_day_stats_callback(sender, **kwargs):
+    if kwargs.get('raw'): return
+    day = kwargs['instance']
+    DailyStats.objects.mark_stale(day.visit_date, day.visit_date)
+
+
+@receiver(post_delete, sender=CoworkingDay)
+def coworking_day_stats_delete_callback(sender, **kwargs):
+    day = kwargs['instance']
+    DailyStats.objects.mark_stale(day.visit_date, day.visit_date)
+
+
+@receiver(pre_save, sender=ResourceSubscription)
+def subscription_stats_pre_save_callback(sender, **kwargs):
+    if kwargs.get('raw'): return
+    subscription = kwargs['instance']
+    if subscription.pk:
+        # The days this subscription used to cover change too
+        old = ResourceSubscription.objects.filter(pk=subscription.pk).values_list('start_date', 'end_date').first()
+        if old and old != (subscription.start_date, subscription.end_date):
+            DailyStats.objects.mark_stale(old[0], old[1])
+
+
+@receiver(post_save, sender=ResourceSubscription)
+def subscription_stats_callback(sender, **kwargs):
+    if kwargs.get('raw'): return
+    subscription = kwargs['instance']
+    DailyStats.objects.mark_stale(subscription.start_date, subscription.end_date)
+
+
+@receiver(post_delete, sender=ResourceSubscription)
+def subscription_stats_delete_callback(sender, **kwargs):
+    subscription = kwargs['instance']
+    DailyStats.objects.mark_stale(subscription.start_date, subscription.end_date)
+
+
+@receiver(post_save, sender=OrganizationMember)
+@receiver(post_delete, sender=OrganizationMember)
+def organization_member_stats_callback(sender, **kwargs):
+    if kwargs.get('raw'): return
+    member = kwargs['instance']
+    # Organization members count towards every day of the organization's subscriptions
+    subscriptions = ResourceSubscription.objects.filter(membership__organizationmembership__organization_id=member.organization_id)
+    start_date = subscriptions.aggregate(day=Min('start_date'))['day']
+    if start_date:
+        DailyStats.objects.mark_stale(start_date)
+
+
+# Copyright 2021 Office Nomads LLC (https://officenomads.com/) Licensed under the AGPL License, Version 3.0 (the "License"); you may not use this file except in compliance with the License. You may obtain a copy of the License at https://www.gnu.org/licenses/agpl-3.0.html. Unless required by applicable law or agreed to in writing, software distributed under the License is distributed on an "AS IS" BASIS, WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the License for the specific language governing permissions and limitations under the License.
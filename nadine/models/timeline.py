@@ -0,0 +1,186 @@
+import logging
+from array import array
+from datetime import timedelta
+from decimal import Decimal
+
+from nadine.models.membership import IndividualMembership, OrganizationMembership, ResourceSubscription
+from nadine.models.organization import OrganizationMember
+
+logger = logging.getLogger(__name__)
+
+
+class MembershipTimeline(object):
+    ''' Day by day membership numbers for a range of dates.
+
+    All the subscriptions that overlap the range are loaded once and each
+    question is answered by sweeping over their start and end dates.  Every
+    series is an array with one value for each day from start_date to
+    end_date (inclusive) so the numbers for any day or month are a slice
+    away.  Money is kept in cents until it is handed back as a Decimal.
+    '''
+
+    def __init__(self, start_date, end_date):
+        if end_date < start_date:
+            raise Exception("End date (%s) is before start date (%s)" % (end_date, start_date))
+        self.start_date = start_date
+        self.end_date = end_date
+        self.length = (end_date - start_date).days + 1
+        self.subscriptions = None
+        self.cache = {}
+
+    ############################################################################
+    # Loading
+    ############################################################################
+
+    def load(self):
+        ''' Pull the subscriptions and who they are for with a fixed number of queries. '''
+        if self.subscriptions is not None:
+            return self
+        overlapping = ResourceSubscription.objects.overlapping(self.start_date, self.end_date)
+        self.subscriptions = list(overlapping.values_list('membership_id', 'package_name', 'start_date', 'end_date', 'monthly_rate', 'resource_id'))
+
+        # The users each membership counts towards
+        self.membership_users = {}
+        for membership_id, user_id in IndividualMembership.objects.values_list('id', 'user_id'):
+            self.membership_users[membership_id] = [user_id]
+        organizations = dict(OrganizationMembership.objects.values_list('organization_id', 'id'))
+        for organization_id, user_id in OrganizationMember.objects.filter(organization_id__in=organizations.keys()).values_list('organization_id', 'user_id'):
+            self.membership_users.setdefault(organizations[organization_id], []).append(user_id)
+        logger.debug("Loaded %d subscriptions" % len(self.subscriptions))
+        return self
+
+    ############################################################################
+    # Sweep Line
+    ############################################################################
+
+    def index(self, day):
+        ''' Position of the given day in each series. '''
+        return (day - self.start_date).days
+
+    def days(self):
+        return [self.start_date + timedelta(days=i) for i in range(self.length)]
+
+    def sweep(self, intervals, typecode='l'):
+        ''' Add up (start, end, value) intervals in to one value per day.
+
+        Each interval adds its value where it starts and takes it away the
+        day after it ends so a running total gives the value for every day.
+        '''
+        changes = array(typecode, bytes(array(typecode).itemsize * (self.length + 1)))
+        for start, end, value in intervals:
+            if start > self.end_date or (end is not None and (end < self.start_date or end < start)):
+                continue
+            changes[max(self.index(start), 0)] += value
+            if end is not None and end < self.end_date:
+                changes[self.index(end) + 1] -= value
+        totals = array(typecode, bytes(array(typecode).itemsize * self.length))
+        running = 0
+        for i in range(self.length):
+            running += changes[i]
+            totals[i] = running
+        return totals
+
+    def distinct_intervals(self, keyed_intervals):
+        ''' Merge overlapping (key, start, end) intervals so each key counts once a day. '''
+        by_key = {}
+        for key, start, end in keyed_intervals:
+            if end is None or end >= start:
+                by_key.setdefault(key, []).append((start, end))
+        for key, intervals in by_key.items():
+            intervals.sort(key=lambda i: i[0])
+            current_start, current_end = intervals[0]
+            for start, end in intervals[1:]:
+                if current_end is None or start <= current_end + timedelta(days=1):
+                    if current_end is not None and (end is None or end > current_end):
+                        current_end = end
+                else:
+                    yield (current_start, current_end, 1)
+                    current_start, current_end = start, end
+            yield (current_start, current_end, 1)
+
+    def cached(self, key, build):
+        if key not in self.cache:
+            self.load()
+            self.cache[key] = build()
+        return self.cache[key]
+
+    ############################################################################
+    # Series
+    ############################################################################
+
+    def active_memberships(self):
+        ''' Number of memberships with an active subscription on each day. '''
+        def build():
+            intervals = ((m, s, e) for m, p, s, e, r, res in self.subscriptions)
+            return self.sweep(self.distinct_intervals(intervals))
+        return self.cached('active_memberships', build)
+
+    def members_by_package(self):
+        ''' Number of users with an active subscription from each package on each day: {package_name: series} '''
+        def build():
+            by_package = {}
+            for membership_id, package_name, start, end, rate, resource_id in self.subscriptions:
+                for user_id in self.membership_users.get(membership_id, []):
+                    by_package.setdefault(package_name, []).append((user_id, start, end))
+            return {p: self.sweep(self.distinct_intervals(i)) for p, i in by_package.items()}
+        return self.cached('members_by_package', build)
+
+    def package_members(self, package_name):
+        return self.members_by_package().get(package_name) or self.sweep([])
+
+    def resource_subscriptions(self, resource):
+        ''' Number of active subscriptions for the given resource on each day. '''
+        resource_id = getattr(resource, 'id', resource)
+        def build():
+            return self.sweep((s, e, 1) for m, p, s, e, r, res in self.subscriptions if res == resource_id)
+        return self.cached(('resource_subscriptions', resource_id), build)
+
+    def monthly_revenue(self):
+        ''' Sum of the monthly rates of the subscriptions active on each day. '''
+        def build():
+            intervals = ((s, e, int(r * 100)) for m, p, s, e, r, res in self.subscriptions)
+            return [Decimal(cents) / 100 for cents in self.sweep(intervals, typecode='q')]
+        return self.cached('monthly_revenue', build)
+
+    def starts_and_ends(self):
+        ''' Running count of subscriptions started and ended up to each day. '''
+        def build():
+            started = self.sweep((s, None, 1) for m, p, s, e, r, res in self.subscriptions if s >= self.start_date)
+            ended = self.sweep((e, None, 1) for m, p, s, e, r, res in self.subscriptions if e is not None and e <= self.end_date)
+            return started, ended
+        return self.cached('starts_and_ends', build)
+
+    ############################################################################
+    # Ranges
+    ############################################################################
+
+    def slice(self, series, start=None, end=None):
+        ''' The part of a series from start to end (inclusive). '''
+        start_index = self.index(start) if start else 0
+        end_index = self.index(end) if end else self.length - 1
+        return series[max(start_index, 0):min(end_index, self.length - 1) + 1]
+
+    def summary(self, series, start=None, end=None):
+        ''' (min, max, avg) of a series for the given days. '''
+        values = self.slice(series, start, end)
+        if not values:
+            return (0, 0, 0)
+        return (min(values), max(values), round(sum(values) / len(values), 2))
+
+    def count_between(self, running, start, end):
+        ''' How much a running count grew from start to end (inclusive). '''
+        end_index = min(self.index(end), self.length - 1)
+        start_index = self.index(start) - 1
+        before = running[start_index] if start_index >= 0 else 0
+        return running[end_index] - before
+
+    def started(self, start, end):
+        ''' Number of subscriptions that started between these days. '''
+        return self.count_between(self.starts_and_ends()[0], start, end)
+
+    def ended(self, start, end):
+        ''' Number of subscriptions that ended between these days. '''
+        return self.count_between(self.starts_and_ends()[1], start, end)
+
+
+# Copyright 2021 Office Nomads LLC (https://officenomads.com/) Licensed under the AGPL License, Version 3.0 (the "License"); you may not use this file except in compliance with the License. You may obtain a copy of the License at https://www.gnu.org/licenses/agpl-3.0.html. Unless required by applicable law or agreed to in writing, software distributed under the License is distributed on an "AS IS" BASIS, WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the License for the specific language governing permissions and limitations under the License.
@@ -85,6 +85,7 @@ MIDDLEWARE = (
     'django.contrib.sessions.middleware.SessionMiddleware',
     'django.middleware.csrf.CsrfViewMiddleware',
     'django.contrib.auth.middleware.AuthenticationMiddleware',
+    'nadine.middleware.UserHelperCacheMiddleware',
     'django.contrib.messages.middleware.MessageMiddleware',
     'django.middleware.clickjacking.XFrameOptionsMiddleware',
     # 'debug_toolbar.middleware.DebugToolbarMiddleware',
@@ -312,6 +313,11 @@ CRONJOBS = [
     ('0 1 * * *', 'django.core.management.call_command', ['backup_create']),
     # Billing Tasks at 8:00 PM
     ('0 20 * * *', 'django.core.management.call_command', ['billing_batch_run']),
+    # Keep our copy of USAePay and Xero up to date
+    #('30 23 * * *', 'django.core.management.call_command', ['usaepay_sync']),
+    #('*/15 * * * *', 'django.core.management.call_command', ['xero_sync']),
+    # Roll up the daily stats at 2:00 AM
+    ('0 2 * * *', 'django.core.management.call_command', ['stats_refresh']),
     # Other Tasks
     ('30 8 * * *', 'django.core.management.call_command', ['announce_special_days']),
 ]
@@ -7,7 +7,8 @@ from django.conf import settings
 
 from nadine import email
 from nadine.models import Payment, BillLineItem
-from nadine.models.alerts import sign_in, new_membership, ending_membership, change_membership
+from nadine.models.billing import BillingEvent, defer_bill_totals
+from nadine.models.alerts import sign_in, new_membership, ending_membership, change_membership, change_memberships
 from nadine.models.usage import CoworkingDay
 from nadine.utils.payment_api import PaymentAPI
 from nadine.utils.slack_api import SlackAPI
@@ -87,12 +88,25 @@ def disable_billing(sender, **kwargs):
         payment_api.disable_recurring(user.username)
 
 
+@receiver(change_memberships)
+def disable_billing_for_many(sender, **kwargs):
+    # Same as above for a bulk change but with one pass through the payment API
+    users = kwargs['users']
+    payment_api = PaymentAPI()
+    if payment_api.enabled and users:
+        payment_api.disable_recurring_for([u.username for u in users])
+
+
 @receiver(post_save, sender=BillLineItem)
 def lineitem_post_save(**kwargs):
     """
     Update cached totals on UserBill.
     """
     lineitem = kwargs['instance']
+    if kwargs['created']:
+        BillingEvent.objects.record(lineitem.bill_id, BillingEvent.ADDED, line_item=lineitem, amount_after=lineitem.amount)
+    if defer_bill_totals(lineitem.bill_id):
+        return
     bill = lineitem.bill
     bill.update_cached_totals()
 
@@ -103,6 +117,9 @@ def lineitem_post_delete(**kwargs):
     Update cached totals on UserBill.
     """
     lineitem = kwargs['instance']
+    BillingEvent.objects.record(lineitem.bill_id, BillingEvent.REMOVED, line_item=lineitem, amount_before=lineitem.amount)
+    if defer_bill_totals(lineitem.bill_id):
+        return
     try:
         bill = lineitem.bill
         bill.update_cached_totals()
@@ -116,6 +133,10 @@ def payment_post_save(**kwargs):
     Update cached totals on UserBill.
     """
     payment = kwargs['instance']
+    if kwargs['created']:
+        BillingEvent.objects.record(payment.bill_id, BillingEvent.PAYMENT, payment=payment, description=payment.note, amount_after=payment.amount)
+    if defer_bill_totals(payment.bill_id):
+        return
     bill = payment.bill
     bill.update_cached_totals()
 
@@ -126,6 +147,9 @@ def payment_post_delete(**kwargs):
     Update cached totals on UserBill.
     """
     payment = kwargs['instance']
+    BillingEvent.objects.record(payment.bill_id, BillingEvent.PAYMENT_REMOVED, payment=payment, description=payment.note, amount_before=payment.amount)
+    if defer_bill_totals(payment.bill_id):
+        return
     bill = payment.bill
     bill.update_cached_totals()
 
@@ -20,7 +20,7 @@ class LoopCommaNode(template.Node):
         try:
             month_history = self.month_history_var.resolve(context)
             datum_type = self.type_var.resolve(context)
-            return month_history.data[datum_type]
+            return str(month_history.data[datum_type])
         except template.VariableDoesNotExist:
             print('does not exist')
             return ''
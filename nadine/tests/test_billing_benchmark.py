@@ -0,0 +1,42 @@
+from datetime import date
+
+from django.test import TestCase, override_settings
+from django.db import connection
+from django.test.utils import CaptureQueriesContext
+
+from nadine.models.billing import BillingBatch, UserBill
+from nadine.utils.benchmark import SyntheticDataset, BillingBenchmark
+
+
+@override_settings(SUSPEND_MEMBER_ALERTS=True)
+class BillingBenchmarkTestCase(TestCase):
+
+    def test_synthetic_dataset(self):
+        dataset = SyntheticDataset(members=6, organizations=1, months=2, end_date=date(2020, 3, 1)).generate()
+        self.assertEqual(9, len(dataset.users))
+        self.assertTrue(dataset.users[0].coworkingday_set.exists() or dataset.users[1].coworkingday_set.exists())
+
+    def test_benchmark_results(self):
+        dataset = SyntheticDataset(members=6, organizations=1, months=2, end_date=date(2020, 3, 1)).generate()
+        results = BillingBenchmark(dataset, bulk=True, recalculate=2).run()
+        self.assertEqual(5, len(results))
+        for result in results:
+            self.assertTrue(result.seconds >= 0)
+            self.assertTrue(result.queries > 0)
+        self.assertTrue(UserBill.objects.count() > 0)
+
+    def test_bulk_billing_queries_do_not_grow_with_members(self):
+        def billing_queries(prefix, members):
+            dataset = SyntheticDataset(members=members, organizations=0, months=1, end_date=date(2020, 3, 1), prefix=prefix)
+            dataset.generate()
+            with CaptureQueriesContext(connection) as queries:
+                BillingBatch.objects.run(start_date=dataset.start_date, end_date=dataset.end_date, bulk=True)
+            # Separate the runs so they each start from scratch
+            UserBill.objects.all().delete()
+            # The billing journal is written in one bulk insert which the
+            # database may split in to chunks so it is left out
+            return len([q for q in queries.captured_queries if 'INSERT INTO "nadine_billingevent"' not in q['sql']])
+
+        small = billing_queries("small", 5)
+        large = billing_queries("large", 20)
+        self.assertEqual(small, large)
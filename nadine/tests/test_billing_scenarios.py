@@ -4,11 +4,13 @@ from decimal import Decimal
 from dateutil.relativedelta import relativedelta
 from django.urls import reverse
 
-from django.test import TestCase, override_settings
+from django.db import connection
+from django.test import TestCase, TransactionTestCase, override_settings
 from django.utils.timezone import localtime, now
 from django.contrib.auth.models import User
 
-from nadine.models.billing import BillingBatch, UserBill, Payment
+from nadine.models.billing import BillingBatch, BillingEvent, BillLineItem, UserBill, Payment
+from nadine.models.billing_engine import BillingEngine
 from nadine.models.membership import MembershipPackage, SubscriptionDefault
 from nadine.models.membership import Membership, ResourceSubscription
 from nadine.models.organization import Organization
@@ -201,6 +203,75 @@ class BillingTestCase(TestCase):
         self.assertTrue(days[date(2010, 6, 24)] in june_20_bill.coworking_days())
         self.assertTrue(june_20_bill.is_closed)
 
+    def test_preview_matches_run(self):
+        # Same setup as test_drop_in_on_billing_date_is_associated_with_correct_bill
+        user = User.objects.create(username='member_eight', first_name='Member', last_name='Eight')
+        membership = Membership.objects.for_user(user)
+        membership.bill_day = 20
+        membership.save()
+        membership.set_to_package(self.pt5Package, start_date=date(2010, 5, 20), end_date=date(2010, 6, 19))
+        membership.set_to_package(self.basicPackage, start_date=date(2010, 6, 20))
+        for day in range(11, 25):
+            CoworkingDay.objects.create(user=user, visit_date=date(2010, 6, day), payment='Bill')
+
+        # The preview saves nothing
+        preview = BillingBatch.objects.preview(start_date=date(2010, 5, 20), end_date=date(2010, 7, 20))
+        self.assertEqual(0, UserBill.objects.count())
+        self.assertEqual(3, len(preview))
+        self.assertEqual(['new', 'new', 'new'], [b['status'] for b in preview])
+
+        # Running the batch produces the same bills
+        batch = BillingBatch.objects.run(start_date=date(2010, 5, 20), end_date=date(2010, 7, 20))
+        self.assertTrue(batch.successful)
+        for row in preview:
+            bill = user.bills.get(period_start=row['period_start'])
+            self.assertEqual(bill.period_end, row['period_end'])
+            self.assertEqual(bill.amount, row['amount_after'])
+            self.assertEqual(bill.line_items.count(), len(row['line_items']))
+
+        # Nothing left to do
+        self.assertEqual([], BillingBatch.objects.preview(start_date=date(2010, 7, 20), end_date=date(2010, 7, 20)))
+
+    def test_billing_journal(self):
+        user = User.objects.create(username='member_journal', first_name='Member', last_name='Journal')
+        membership = Membership.objects.for_user(user)
+        membership.bill_day = 20
+        membership.save()
+        membership.set_to_package(self.basicPackage, start_date=date(2010, 5, 20))
+        for day in range(1, 6):
+            CoworkingDay.objects.create(user=user, visit_date=date(2010, 6, day), payment='Bill')
+
+        batch = BillingBatch.objects.run(start_date=date(2010, 5, 20), end_date=date(2010, 6, 10))
+        self.assertTrue(batch.successful)
+        bill = user.bills.get(period_start=date(2010, 5, 20))
+        events = BillingEvent.objects.for_bill(bill)
+        self.assertEqual(6, events.filter(action=BillingEvent.ADDED).count())
+        self.assertEqual({batch.id}, {e.batch_id for e in events})
+        self.assertEqual({BillingEvent.SOURCE_BATCH}, {e.source for e in events})
+        self.assertEqual([], BillingEvent.objects.verify())
+
+        # Waiving a day reprices the rest
+        day = CoworkingDay.objects.get(user=user, visit_date=date(2010, 6, 1))
+        day.mark_waived()
+        bill.recalculate()
+        recalculated = BillingEvent.objects.for_bill(bill).filter(action=BillingEvent.RECALCULATED).last()
+        self.assertEqual(Decimal(80), recalculated.amount_before)
+        self.assertEqual(Decimal(65), recalculated.amount_after)
+        self.assertEqual(BillingEvent.SOURCE_SIGNAL, recalculated.source)
+        self.assertEqual([], BillingEvent.objects.verify())
+
+        # The journal notices when a bill is changed behind its back
+        line_item = bill.line_items.filter(amount__gt=0).first()
+        bill.line_items.filter(id=line_item.id).update(amount=1)
+        mismatches = BillingEvent.objects.verify()
+        self.assertEqual([bill.id], [m['bill_id'] for m in mismatches])
+        self.assertEqual([line_item.id], mismatches[0]['changed'])
+
+        payment = Payment.objects.create(bill=bill, user=user, amount=10)
+        self.assertTrue(BillingEvent.objects.filter(bill=bill, action=BillingEvent.PAYMENT, payment_id=payment.id).exists())
+        with self.assertRaises(Exception):
+            recalculated.delete()
+
     def test_guest_membership_bills(self):
         # User 6 & 7 = PT-5 starting 1/1/2008
         # User 7 guest of User 6
@@ -971,5 +1042,85 @@ class BillingTestCase(TestCase):
     #     self.assertEqual(1, user_bill.line_items.all().count())
 
 
+@override_settings(SUSPEND_MEMBER_ALERTS=True, BILLING_BATCH_BULK=True)
+class BulkBillingTestCase(BillingTestCase):
+    ''' Run all the same billing scenarios through the bulk billing engine. '''
+
+    def test_recalculate_matches_bill(self):
+        bills = []
+        for i in range(2):
+            user = User.objects.create(username='member_recalc_%d' % i, first_name='Member', last_name='Recalc')
+            membership = Membership.objects.for_user(user)
+            membership.bill_day = 20
+            membership.save()
+            membership.set_to_package(self.basicPackage, start_date=date(2010, 5, 20))
+            for day in range(1, 6):
+                CoworkingDay.objects.create(user=user, visit_date=date(2010, 6, day), payment='Bill')
+            bills.append(user)
+        BillingBatch.objects.run(start_date=date(2010, 5, 20), end_date=date(2010, 6, 10))
+
+        # A line item left behind by something that no longer exists, a custom one, and a changed day
+        bills = [user.bills.get(period_start=date(2010, 5, 20)) for user in bills]
+        for bill in bills:
+            BillLineItem.objects.create(bill=bill, description="Left behind", amount=13)
+            BillLineItem.objects.create(bill=bill, description="Custom", amount=7, custom=True)
+            CoworkingDay.objects.filter(user=bill.user, visit_date=date(2010, 6, 1)).update(payment='Waive')
+
+        # One bill is recalculated on its own and the other by the engine
+        bills[0].recalculate()
+        engine = BillingEngine(date(2010, 6, 10), date(2010, 6, 10))
+        engine.load()
+        engine.recalculate([s for s in engine.bill_states if s.bill.pk == bills[1].pk][0])
+        UserBill.objects.update_cached_totals([b.id for b in engine.save()])
+
+        def line_items(bill):
+            return sorted((i.amount, i.custom) for i in bill.line_items.all())
+        for bill in bills:
+            bill.refresh_from_db()
+        self.assertEqual(line_items(bills[0]), line_items(bills[1]))
+        self.assertEqual(bills[0].cached_total_amount, bills[1].cached_total_amount)
+        self.assertFalse(bills[1].line_items.filter(description="Left behind").exists())
+
+
+@override_settings(SUSPEND_MEMBER_ALERTS=True, BILLING_BATCH_SHARDS=3, BILLING_BATCH_PARALLEL=False)
+class ShardedBillingTestCase(BillingTestCase):
+    ''' Run all the same billing scenarios with the payers split in to shards. '''
+    pass
+
+
+@override_settings(SUSPEND_MEMBER_ALERTS=True, BILLING_BATCH_SHARDS=2, BILLING_BATCH_PARALLEL=True)
+class ParallelBillingTestCase(TransactionTestCase):
+    ''' Run the shards in worker processes.  They have to see the test data so this can't be in a transaction. '''
+    serialized_rollback = True
+
+    def setUp(self):
+        if connection.vendor == 'sqlite' and connection.is_in_memory_db():
+            self.skipTest("Worker processes can not connect to an in-memory database")
+
+    def test_billing_journal(self):
+        package = MembershipPackage.objects.create(name="Basic")
+        SubscriptionDefault.objects.create(package=package, resource=Resource.objects.day_resource, monthly_rate=50, allowance=3, overage_rate=15)
+        users = []
+        for i in range(4):
+            user = User.objects.create(username='member_%d' % i, first_name='Member', last_name=str(i))
+            membership = Membership.objects.for_user(user)
+            membership.bill_day = 20
+            membership.save()
+            membership.set_to_package(package, start_date=date(2010, 5, 20))
+            for day in range(1, 6):
+                CoworkingDay.objects.create(user=user, visit_date=date(2010, 6, day), payment='Bill')
+            users.append(user)
+
+        batch = BillingBatch.objects.run(start_date=date(2010, 5, 20), end_date=date(2010, 6, 10))
+        self.assertTrue(batch.successful)
+        for user in users:
+            bill = user.bills.get(period_start=date(2010, 5, 20))
+            self.assertEqual(Decimal(80), bill.amount)
+            events = BillingEvent.objects.for_bill(bill)
+            self.assertEqual(6, events.filter(action=BillingEvent.ADDED).count())
+            self.assertEqual({batch.id}, {e.batch_id for e in events})
+        self.assertEqual([], BillingEvent.objects.verify())
+
+
 # Copyright 2021 Office Nomads LLC (https://officenomads.com/) Licensed under the AGPL License, Version 3.0 (the "License"); you may not use this file except in compliance with the License. You may obtain a copy of the License at https://www.gnu.org/licenses/agpl-3.0.html. Unless required by applicable law or agreed to in writing, software distributed under the License is distributed on an "AS IS" BASIS, WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the License for the specific language governing permissions and limitations under the License.
 
@@ -639,5 +639,94 @@ class SubscriptionTestCase(TestCase):
         self.assertTrue(subscription in ResourceSubscription.objects.unbilled(tomorrow))
 
 
+@override_settings(SUSPEND_MEMBER_ALERTS=True)
+class MembershipPeriodTestCase(TestCase):
+
+    def setUp(self):
+        self.user = User.objects.create(username='period_user', first_name='Period', last_name='User')
+        self.membership = self.user.membership
+        self.membership.bill_day = 1
+        self.membership.save()
+
+    def add_subscription(self, start, end=None):
+        return ResourceSubscription.objects.create(
+            resource = Resource.objects.day_resource,
+            membership = self.membership,
+            start_date = start,
+            end_date = end,
+            monthly_rate = 100.00,
+            overage_rate = 0,
+        )
+
+    def test_merge_date_ranges(self):
+        ranges = [
+            (date(2017, 3, 1), date(2017, 3, 31)),
+            (date(2017, 1, 1), date(2017, 1, 31)),
+            (date(2017, 2, 1), date(2017, 2, 10)),
+            (date(2017, 5, 1), date(2017, 4, 1)),
+            (date(2017, 6, 1), None),
+            (date(2017, 7, 1), date(2017, 7, 31)),
+        ]
+        self.assertEqual([
+            (date(2017, 1, 1), date(2017, 2, 10)),
+            (date(2017, 3, 1), date(2017, 3, 31)),
+            (date(2017, 6, 1), None),
+        ], merge_date_ranges(ranges))
+
+    def test_periods_follow_subscriptions(self):
+        self.assertEqual(0, self.membership.periods.count())
+        s1 = self.add_subscription(date(2017, 1, 1), date(2017, 1, 31))
+        s2 = self.add_subscription(date(2017, 2, 1), date(2017, 3, 15))
+        self.assertEqual([(date(2017, 1, 1), date(2017, 3, 15))], list(self.membership.periods.values_list('start_date', 'end_date')))
+
+        s1.end_date = date(2017, 1, 20)
+        s1.save()
+        self.assertEqual(2, self.membership.periods.count())
+        self.assertFalse(self.membership.is_active(date(2017, 1, 25)))
+        self.assertEqual((date(2017, 3, 1), date(2017, 3, 31)), self.membership.get_period(date(2017, 3, 15)))
+        self.assertEqual((None, None), self.membership.get_period(date(2017, 3, 16)))
+
+        s2.delete()
+        self.assertEqual([(date(2017, 1, 1), date(2017, 1, 20))], list(self.membership.periods.values_list('start_date', 'end_date')))
+
+    def test_get_period_single_query(self):
+        self.add_subscription(date(2017, 1, 1))
+        with self.assertNumQueries(1):
+            self.assertEqual((date(2017, 6, 1), date(2017, 6, 30)), self.membership.get_period(date(2017, 6, 10)))
+
+    def test_period_index(self):
+        self.add_subscription(date(2017, 1, 1), date(2017, 1, 31))
+        self.add_subscription(date(2017, 6, 1))
+        index = MembershipPeriod.objects.index([self.membership])
+        with self.assertNumQueries(0):
+            self.assertEqual((None, None), index.get_period(self.membership, date(2016, 12, 31)))
+            self.assertEqual((date(2017, 1, 1), date(2017, 1, 31)), index.get_period(self.membership, date(2017, 1, 31)))
+            self.assertEqual((None, None), index.get_period(self.membership, date(2017, 3, 1)))
+            self.assertEqual((date(2018, 2, 1), date(2018, 2, 28)), index.get_period(self.membership, date(2018, 2, 5)))
+            self.assertFalse(index.is_active(0, date(2017, 1, 1)))
+        for d in [date(2016, 12, 31), date(2017, 1, 15), date(2017, 2, 1), date(2017, 6, 1)]:
+            self.assertEqual(self.membership.get_period(d), index.get_period(self.membership, d))
+
+    def test_subscriptions_by_date(self):
+        s1 = self.add_subscription(date(2017, 1, 1), date(2017, 1, 31))
+        s2 = self.add_subscription(date(2017, 3, 1))
+        s3 = self.add_subscription(date(2017, 5, 1), date(2017, 4, 1))
+        subscriptions = ResourceSubscription.objects
+        self.assertEqual([s1], list(subscriptions.active_on(date(2017, 1, 31))))
+        self.assertEqual([], list(subscriptions.active_on(date(2017, 2, 1))))
+        self.assertEqual([s2], list(subscriptions.active_on(date(2017, 4, 15))))
+        self.assertEqual([s1, s2], list(subscriptions.overlapping(date(2017, 1, 31), date(2017, 3, 1)).order_by('start_date')))
+        self.assertEqual([], list(subscriptions.overlapping(date(2017, 2, 1), date(2017, 2, 28))))
+        # The range index is only used on PostgreSQL
+        self.assertFalse(use_date_ranges())
+
+    def test_rebuild(self):
+        self.add_subscription(date(2017, 1, 1), date(2017, 1, 31))
+        MembershipPeriod.objects.all().delete()
+        self.assertFalse(self.membership.is_active(date(2017, 1, 15)))
+        MembershipPeriod.objects.rebuild_all()
+        self.assertTrue(self.membership.is_active(date(2017, 1, 15)))
+
+
 # Copyright 2021 Office Nomads LLC (https://officenomads.com/) Licensed under the AGPL License, Version 3.0 (the "License"); you may not use this file except in compliance with the License. You may obtain a copy of the License at https://www.gnu.org/licenses/agpl-3.0.html. Unless required by applicable law or agreed to in writing, software distributed under the License is distributed on an "AS IS" BASIS, WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the License for the specific language governing permissions and limitations under the License.
 
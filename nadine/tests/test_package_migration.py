@@ -0,0 +1,105 @@
+from datetime import date, timedelta
+
+from django.test import TestCase, override_settings
+from django.contrib.auth.models import User
+from django.core.management import call_command
+
+from nadine.models.alerts import MemberAlert, change_membership, change_memberships
+from nadine.models.billing import UserBill
+from nadine.models.membership import MembershipPackage, SubscriptionDefault, ResourceSubscription
+from nadine.models.package_migration import PackageMigration
+from nadine.models.resource import Resource
+from nadine.models.stats import DailyStats
+
+
+@override_settings(SUSPEND_MEMBER_ALERTS=True)
+class PackageMigrationTestCase(TestCase):
+
+    def setUp(self):
+        self.basic = MembershipPackage.objects.create(name="Basic")
+        self.basic_days = SubscriptionDefault.objects.create(package=self.basic, resource=Resource.objects.day_resource, monthly_rate=50, allowance=3, overage_rate=20)
+        self.resident = MembershipPackage.objects.create(name="Resident")
+        SubscriptionDefault.objects.create(package=self.resident, resource=Resource.objects.day_resource, monthly_rate=0, allowance=5, overage_rate=20)
+        SubscriptionDefault.objects.create(package=self.resident, resource=Resource.objects.desk_resource, monthly_rate=475, allowance=1, overage_rate=0)
+
+        self.change_date = date(2020, 3, 1)
+        self.user1 = User.objects.create(username='member_one', first_name='Member', last_name='One')
+        self.user1.membership.set_to_package(self.basic, start_date=date(2020, 1, 1))
+        self.user2 = User.objects.create(username='member_two', first_name='Member', last_name='Two')
+        self.user2.membership.set_to_package(self.basic, start_date=date(2020, 1, 15), end_date=date(2020, 5, 31), paid_by=self.user1)
+        # Ended before the change and starting after it
+        self.user3 = User.objects.create(username='member_three', first_name='Member', last_name='Three')
+        self.user3.membership.set_to_package(self.basic, start_date=date(2019, 1, 1), end_date=date(2020, 2, 1))
+        self.user4 = User.objects.create(username='member_four', first_name='Member', last_name='Four')
+        self.user4.membership.set_to_package(self.basic, start_date=date(2020, 4, 1))
+
+    def test_reprice(self):
+        self.basic_days.monthly_rate = 60
+        self.basic_days.save()
+        changes = PackageMigration("Basic", change_date=self.change_date).apply()
+        self.assertEqual(set([self.user1, self.user2]), set(c.user for c in changes))
+
+        day_before = self.change_date - timedelta(days=1)
+        self.assertEqual(50, self.user1.membership.active_subscriptions(day_before).get().monthly_rate)
+        new = self.user1.membership.active_subscriptions(self.change_date).get()
+        self.assertEqual((60, None, None), (new.monthly_rate, new.end_date, new.paid_by))
+        new = self.user2.membership.active_subscriptions(self.change_date).get()
+        self.assertEqual((60, date(2020, 5, 31), self.user1), (new.monthly_rate, new.end_date, new.paid_by))
+        self.assertEqual([(date(2020, 1, 15), date(2020, 5, 31))], list(self.user2.membership.periods.values_list('start_date', 'end_date')))
+
+        # Everyone else is left alone
+        self.assertEqual(1, self.user3.membership.subscriptions.count())
+        self.assertEqual(50, self.user4.membership.subscriptions.get().monthly_rate)
+
+    def test_change_package(self):
+        DailyStats.objects.refresh(self.change_date, self.change_date)
+        migration = PackageMigration(self.basic, self.resident, self.change_date)
+        # Defaults, subscriptions, and which upcoming subscriptions are billed
+        with self.assertNumQueries(3):
+            self.assertEqual(2, len(migration.plan()))
+        migration.apply()
+        self.assertEqual("Resident", self.user1.membership.package_name(self.change_date))
+        self.assertTrue(self.user1.membership.has_desk(self.change_date))
+        self.assertFalse(self.user1.membership.has_desk(self.change_date - timedelta(days=1)))
+        self.assertTrue(DailyStats.objects.get(day=self.change_date).stale)
+
+    def test_billed_subscriptions_are_kept(self):
+        # A backdated change over a subscription that is already on a bill
+        future = ResourceSubscription.objects.create(membership=self.user1.membership, resource=Resource.objects.desk_resource, start_date=date(2020, 3, 15), monthly_rate=100, allowance=1, overage_rate=0, package_name="Basic")
+        bill = UserBill.objects.create_for_day(self.user1, date(2020, 3, 15))
+        bill.add_subscription(future)
+
+        migration = PackageMigration(self.basic, self.resident, self.change_date)
+        change = [c for c in migration.plan() if c.user == self.user1][0]
+        self.assertEqual([future], change.billed)
+        self.assertIn("already billed %d" % future.id, str(change))
+        with self.assertRaises(Exception):
+            migration.apply()
+        self.assertEqual(1, bill.line_items.count())
+        self.assertEqual(0, ResourceSubscription.objects.filter(package_name="Resident").count())
+
+    @override_settings(SUSPEND_MEMBER_ALERTS=False)
+    def test_alerts(self):
+        changed = []
+        def record(sender, **kwargs):
+            changed.append(kwargs.get('users') or kwargs.get('user'))
+        change_membership.connect(record)
+        change_memberships.connect(record)
+        try:
+            PackageMigration(self.basic, self.resident, self.change_date).apply()
+        finally:
+            change_membership.disconnect(record)
+            change_memberships.disconnect(record)
+        # One pass for everyone instead of one per subscription
+        self.assertEqual(1, len(changed))
+        self.assertEqual(set([self.user1, self.user2]), set(changed[0]))
+        self.assertTrue(MemberAlert.ASSIGN_CABINET in self.user1.profile.alerts_by_key(include_resolved=False))
+
+    def test_command(self):
+        call_command('migrate_package', 'Basic', to='Resident', date='2020-03-01', **{'dry-run': True})
+        self.assertEqual(0, ResourceSubscription.objects.filter(package_name="Resident").count())
+        call_command('migrate_package', 'Basic', to='Resident', date='2020-03-01')
+        self.assertEqual(4, ResourceSubscription.objects.filter(package_name="Resident").count())
+
+
+# Copyright 2021 Office Nomads LLC (https://officenomads.com/) Licensed under the AGPL License, Version 3.0 (the "License"); you may not use this file except in compliance with the License. You may obtain a copy of the License at https://www.gnu.org/licenses/agpl-3.0.html. Unless required by applicable law or agreed to in writing, software distributed under the License is distributed on an "AS IS" BASIS, WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the License for the specific language governing permissions and limitations under the License.
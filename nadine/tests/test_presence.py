@@ -0,0 +1,98 @@
+from datetime import date, datetime, timedelta
+from importlib import import_module
+
+from django.apps import apps
+from django.test import TestCase, override_settings
+from django.contrib.auth.models import User
+from django.core.management import call_command
+from django.utils.timezone import make_aware, localtime, now
+
+from arpwatch.models import UserDevice, ArpLog
+from doors.keymaster.models import Keymaster, Door, DoorEvent
+from nadine.models.membership import MembershipPackage, SubscriptionDefault
+from nadine.models.presence import PresenceSession
+from nadine.models.resource import Resource
+from nadine.models.usage import CoworkingDay
+
+
+@override_settings(SUSPEND_MEMBER_ALERTS=True)
+class PresenceSessionTestCase(TestCase):
+
+    def setUp(self):
+        package = MembershipPackage.objects.create(name="Basic")
+        SubscriptionDefault.objects.create(package=package, resource=Resource.objects.day_resource, monthly_rate=50, allowance=3, overage_rate=20)
+        self.member = User.objects.create(username='member_one', first_name='Member', last_name='One')
+        self.member.membership.set_to_package(package, start_date=date(2017, 1, 1))
+        self.former = User.objects.create(username='member_two', first_name='Member', last_name='Two')
+        self.device = UserDevice.objects.create(user=self.member, mac_address="00:11:22:33:44:55")
+        keymaster = Keymaster.objects.create(description="Front", gatekeeper_ip="127.0.0.1", encryption_key="key")
+        self.door = Door.objects.create(name="Front", door_type="hid", keymaster=keymaster, username="u", password="p", ip_address="127.0.0.2")
+        self.day = date(2020, 2, 3)
+
+    def at(self, hour, minute=0, day=None):
+        return make_aware(datetime.combine(day or self.day, datetime.min.time()) + timedelta(hours=hour, minutes=minute))
+
+    def test_arp_sessions(self):
+        for minute in [0, 10, 35, 50]:
+            ArpLog.objects.create(runtime=self.at(9, minute), device=self.device, ip_address="127.0.0.3")
+        ArpLog.objects.create(runtime=self.at(14), device=self.device, ip_address="127.0.0.3")
+        sessions = PresenceSession.objects.history(self.member).order_by('start_ts')
+        self.assertEqual([(self.at(9), self.at(9, 50)), (self.at(14), self.at(14))], [(s.start_ts, s.end_ts) for s in sessions])
+
+        # Rebuilding from the logs gives the same sessions
+        PresenceSession.objects.rebuild(self.day, self.day)
+        self.assertEqual([(self.at(9), self.at(9, 50)), (self.at(14), self.at(14))], [(s.start_ts, s.end_ts) for s in sessions.all()])
+        self.assertEqual(self.at(9), PresenceSession.objects.first_seen(self.member))
+        self.assertEqual(self.at(14), PresenceSession.objects.last_seen(self.member))
+
+        # Ignored devices don't count
+        self.device.ignore = True
+        self.device.save()
+        ArpLog.objects.create(runtime=self.at(16), device=self.device, ip_address="127.0.0.3")
+        self.assertEqual(self.at(14), PresenceSession.objects.last_seen(self.member))
+
+    def test_device_changes_hands(self):
+        device = UserDevice.objects.create(mac_address="00:11:22:33:44:66")
+        ArpLog.objects.create(runtime=localtime(now()), device=device, ip_address="127.0.0.4")
+        self.assertFalse(self.former in PresenceSession.objects.here_now())
+        device.user = self.former
+        device.save()
+        self.assertTrue(self.former in PresenceSession.objects.here_now())
+        self.assertTrue(self.former in User.helper.here_today())
+
+    def test_here_on(self):
+        DoorEvent.objects.create(timestamp=self.at(10), door=self.door, user=self.member, event_description="Access granted")
+        DoorEvent.objects.create(timestamp=self.at(10), door=self.door, user=self.former, event_description="Access granted")
+        self.assertEqual([self.member], list(PresenceSession.objects.here_on(self.day)))
+
+        # Signing in counts for anyone and follows the coworking day around
+        coworking_day = CoworkingDay.objects.create(user=self.former, visit_date=self.day, payment='Bill')
+        self.assertEqual(2, PresenceSession.objects.here_on(self.day).count())
+        coworking_day.visit_date = self.day + timedelta(days=1)
+        coworking_day.save()
+        self.assertFalse(self.former in PresenceSession.objects.here_on(self.day))
+        self.assertTrue(self.former in PresenceSession.objects.here_on(self.day + timedelta(days=1)))
+        coworking_day.delete()
+        self.assertEqual(0, PresenceSession.objects.filter(source=PresenceSession.COWORKING).count())
+
+    def test_rebuild_command(self):
+        DoorEvent.objects.create(timestamp=self.at(10), door=self.door, user=self.member, event_description="Access granted")
+        CoworkingDay.objects.create(user=self.member, visit_date=self.day, payment='Bill')
+        PresenceSession.objects.all().delete()
+        call_command('presence_rebuild', start='2020-02-01', end='2020-02-05', chunk_days=2)
+        self.assertEqual(set([PresenceSession.DOOR, PresenceSession.COWORKING]), set(PresenceSession.objects.values_list('source', flat=True)))
+
+    def test_fill_migration(self):
+        ArpLog.objects.create(runtime=self.at(9), device=self.device, ip_address="127.0.0.3")
+        ArpLog.objects.create(runtime=self.at(9, 20), device=self.device, ip_address="127.0.0.3")
+        DoorEvent.objects.create(timestamp=self.at(10), door=self.door, user=self.member, event_description="Access granted")
+        CoworkingDay.objects.create(user=self.former, visit_date=self.day, payment='Bill')
+        expected = sorted(PresenceSession.objects.values_list('user', 'source', 'day', 'start_ts', 'end_ts'))
+        PresenceSession.objects.all().delete()
+
+        # Upgrading fills the table from what is already there
+        import_module('nadine.migrations.0049_fill_presence_sessions').forward(apps, None)
+        self.assertEqual(expected, sorted(PresenceSession.objects.values_list('user', 'source', 'day', 'start_ts', 'end_ts')))
+
+
+# Copyright 2021 Office Nomads LLC (https://officenomads.com/) Licensed under the AGPL License, Version 3.0 (the "License"); you may not use this file except in compliance with the License. You may obtain a copy of the License at https://www.gnu.org/licenses/agpl-3.0.html. Unless required by applicable law or agreed to in writing, software distributed under the License is distributed on an "AS IS" BASIS, WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the License for the specific language governing permissions and limitations under the License.
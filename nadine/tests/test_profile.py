@@ -5,8 +5,12 @@ from django.test import TestCase, override_settings
 from django.core import management
 from django.contrib.auth.models import User
 from django.conf import settings
+from django.urls import reverse
 from django.utils import timezone
+from django.utils.timezone import localtime, now, make_aware
 from nadine.models import *
+from arpwatch.models import UserDevice, ArpLog
+from doors.keymaster.models import Keymaster, Door, DoorEvent
 
 
 @override_settings(SUSPEND_MEMBER_ALERTS=True)
@@ -196,6 +200,65 @@ class ProfileTestCase(TestCase):
         self.assertFalse(self.user1.profile in UserProfile.objects.filter(tags__name__in=['knitting']))
         self.assertFalse(self.user3.profile in UserProfile.objects.filter(tags__name__in=['books']))
 
+    def test_not_signed_in(self):
+        keymaster = Keymaster.objects.create(description="Front", gatekeeper_ip="127.0.0.1", encryption_key="key")
+        door = Door.objects.create(name="Front", door_type="hid", keymaster=keymaster, username="u", password="p", ip_address="127.0.0.2")
+        today = localtime(now()).date()
+        yesterday = today - timedelta(days=1)
+        def visit(day, hour=10):
+            return make_aware(datetime.combine(day, datetime.min.time()) + timedelta(hours=hour))
+        # User1 has a desk and user3 is not a member
+        for user in [self.user1, self.user2, self.user3]:
+            DoorEvent.objects.create(timestamp=visit(today), door=door, user=user, event_description="Access granted")
+        # The network counts everyone
+        for user in [self.user2, self.user4]:
+            device = UserDevice.objects.create(user=user, mac_address="00:11:22:33:44:0%d" % user.id)
+            ArpLog.objects.create(runtime=visit(yesterday), device=device, ip_address="127.0.0.3")
+            ArpLog.objects.create(runtime=visit(yesterday, 12), device=device, ip_address="127.0.0.3")
+            ArpLog.objects.create(runtime=visit(today - timedelta(days=2)), device=device, ip_address="127.0.0.3")
+        # Signed in days are fine
+        CoworkingDay.objects.create(user=self.user2, visit_date=today - timedelta(days=2), payment='Bill')
+        CoworkingDay.objects.create(user=self.user4, visit_date=today - timedelta(days=2), payment='Bill')
+
+        self.assertEqual([(today, self.user2)], [(r['day'], r['user']) for r in User.helper.not_signed_in()])
+        rows = User.helper.not_signed_in_since(today - timedelta(days=2))
+        self.assertEqual([(today, self.user2), (yesterday, self.user2), (yesterday, self.user4)], [(r['day'], r['user']) for r in rows])
+
+        # The same queries no matter how far back we look
+        with self.assertNumQueries(4):
+            list(User.helper.iter_not_signed_in(today - timedelta(days=2), today))
+        with self.assertNumQueries(4):
+            list(User.helper.iter_not_signed_in(today - timedelta(days=60), today, chunk_size=10))
+
+    def test_helper_cache(self):
+        # Outside of a cache block every call runs again
+        self.assertIsNot(User.helper.active_members(), User.helper.active_members())
+        with user_helper_cache():
+            active_members = User.helper.active_members()
+            self.assertEqual(3, len(active_members))
+            with self.assertNumQueries(0):
+                self.assertIs(active_members, User.helper.active_members())
+                self.assertTrue(self.user1 in User.helper.active_members())
+            self.assertIsNot(active_members, User.helper.active_members(date(2009, 6, 1)))
+
+            # Saving something unrelated keeps what we have
+            self.basicPackage.save()
+            self.assertIs(active_members, User.helper.active_members())
+
+            # Changes to memberships start over
+            self.user2.membership.end_all(date(2009, 12, 31))
+            self.assertEqual(2, User.helper.active_members().count())
+            self.user3.membership.set_to_package(self.basicPackage, start_date=date(2009, 1, 1))
+            with user_helper_cache(enabled=False):
+                self.assertIsNot(User.helper.active_members(), User.helper.active_members())
+        self.assertEqual(3, User.helper.active_members().count())
+
+    def test_helper_cache_middleware(self):
+        staff = User.objects.create(username='staff_member', is_staff=True)
+        self.client.force_login(staff)
+        self.assertEqual(200, self.client.get(reverse('staff:tasks:todo')).status_code)
+        self.assertEqual(200, self.client.get(reverse('staff:members:members')).status_code)
+
 
 # Copyright 2021 Office Nomads LLC (https://officenomads.com/) Licensed under the AGPL License, Version 3.0 (the "License"); you may not use this file except in compliance with the License. You may obtain a copy of the License at https://www.gnu.org/licenses/agpl-3.0.html. Unless required by applicable law or agreed to in writing, software distributed under the License is distributed on an "AS IS" BASIS, WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the License for the specific language governing permissions and limitations under the License.
 
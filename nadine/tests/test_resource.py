@@ -0,0 +1,50 @@
+from django.test import TestCase, override_settings
+from django.core.cache import caches
+
+from nadine.models.resource import Resource
+
+
+class ResourceTestCase(TestCase):
+
+    def setUp(self):
+        Resource.objects.clear_cache()
+
+    def tearDown(self):
+        # Changes made here are rolled back without any signals
+        Resource.objects.clear_cache()
+
+    def test_resource_by_key_cached(self):
+        with self.assertNumQueries(1):
+            day = Resource.objects.day_resource
+        with self.assertNumQueries(0):
+            self.assertEqual(day, Resource.objects.day_resource)
+        self.assertEqual(Resource.objects.DAY_KEY, day.key)
+
+    def test_save_clears_cache(self):
+        day = Resource.objects.day_resource
+        Resource.objects.filter(id=day.id).update(default_rate=99)
+        self.assertNotEqual(99, Resource.objects.day_resource.default_rate)
+        day.default_rate = 45
+        day.save()
+        with self.assertNumQueries(1):
+            self.assertEqual(45, Resource.objects.day_resource.default_rate)
+
+    def test_missing_resource(self):
+        Resource.objects.filter(key=Resource.objects.MAIL_KEY).delete()
+        with self.assertRaises(Exception):
+            Resource.objects.mail_resource
+
+    @override_settings(RESOURCE_CACHE='default')
+    def test_shared_cache(self):
+        shared = caches['default']
+        day = Resource.objects.day_resource
+        self.assertEqual(day, shared.get("nadine.resource.day"))
+        # Another worker only needs the shared cache
+        Resource.objects._key_cache.clear()
+        with self.assertNumQueries(0):
+            self.assertEqual(day, Resource.objects.day_resource)
+        day.save()
+        self.assertIsNone(shared.get("nadine.resource.day"))
+
+
+# Copyright 2021 Office Nomads LLC (https://officenomads.com/) Licensed under the AGPL License, Version 3.0 (the "License"); you may not use this file except in compliance with the License. You may obtain a copy of the License at https://www.gnu.org/licenses/agpl-3.0.html. Unless required by applicable law or agreed to in writing, software distributed under the License is distributed on an "AS IS" BASIS, WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the License for the specific language governing permissions and limitations under the License.
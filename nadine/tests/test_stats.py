@@ -0,0 +1,97 @@
+from datetime import date, datetime, timedelta
+
+from django.test import TestCase, override_settings
+from django.contrib.auth.models import User
+from django.core.management import call_command
+from django.utils.timezone import make_aware, localtime, now
+
+from arpwatch.models import UserDevice, ArpLog
+from doors.keymaster.models import Keymaster, Door, DoorEvent
+from nadine.models.membership import Membership, ResourceSubscription
+from nadine.models.stats import DailyStats, date_ranges
+from nadine.models.usage import CoworkingDay
+from nadine.utils.benchmark import SyntheticDataset
+
+
+@override_settings(SUSPEND_MEMBER_ALERTS=True)
+class DailyStatsTestCase(TestCase):
+
+    def setUp(self):
+        self.dataset = SyntheticDataset(members=6, organizations=1, months=2, end_date=date(2020, 3, 1)).generate()
+        self.start_date = date(2020, 1, 1)
+        self.end_date = date(2020, 2, 29)
+
+    def test_refresh(self):
+        user = self.dataset.users[0]
+        keymaster = Keymaster.objects.create(description="Front", gatekeeper_ip="127.0.0.1", encryption_key="key")
+        door = Door.objects.create(name="Front", door_type="hid", keymaster=keymaster, username="u", password="p", ip_address="127.0.0.2")
+        visit = make_aware(datetime(2020, 2, 3, 10, 0))
+        DoorEvent.objects.create(timestamp=visit, door=door, user=user, event_description="Access granted")
+        DoorEvent.objects.create(timestamp=visit + timedelta(hours=2), door=door, user=user, event_description="Access granted")
+        device = UserDevice.objects.create(user=user, mac_address="00:11:22:33:44:55")
+        ArpLog.objects.create(runtime=visit, device=device, ip_address="127.0.0.3")
+
+        DailyStats.objects.refresh(self.start_date, self.end_date)
+        self.assertEqual(60, DailyStats.objects.count())
+        for day in [self.start_date, date(2020, 2, 3), self.end_date]:
+            stats = DailyStats.objects.get(day=day)
+            self.assertEqual(Membership.objects.active_memberships(day).count(), stats.memberships)
+            self.assertEqual(CoworkingDay.objects.filter(visit_date=day).count(), stats.coworking_days)
+            for package in self.dataset.packages:
+                self.assertEqual(User.helper.members_by_package(package.name, day).count(), stats.package_members(package.name))
+        stats = DailyStats.objects.get(day=date(2020, 2, 3))
+        self.assertEqual((1, 1, 1), (stats.door_users, stats.arp_users, stats.arp_devices))
+
+    def test_incremental(self):
+        DailyStats.objects.refresh(self.start_date, self.end_date)
+        self.assertEqual(0, DailyStats.objects.filter(stale=True).count())
+
+        # Changes flag only the days they touch
+        user = self.dataset.users[0]
+        CoworkingDay.objects.filter(user=user).delete()
+        CoworkingDay.objects.create(user=user, visit_date=date(2020, 2, 10), payment='Bill')
+        subscription = ResourceSubscription.objects.filter(end_date__isnull=True).first()
+        subscription.end_date = date(2020, 2, 20)
+        subscription.save()
+        stale = list(DailyStats.objects.filter(stale=True).values_list('day', flat=True))
+        self.assertTrue(date(2020, 2, 10) in stale)
+        self.assertTrue(date(2020, 2, 21) in stale)
+        self.assertEqual(DailyStats.objects.filter(day__gt=date(2020, 2, 20)).count(), DailyStats.objects.filter(day__gt=date(2020, 2, 20), stale=True).count())
+
+        DailyStats.objects.refresh_stale(self.start_date, self.end_date)
+        self.assertEqual(0, DailyStats.objects.filter(stale=True).count())
+        stats = DailyStats.objects.get(day=date(2020, 2, 21))
+        self.assertEqual(Membership.objects.active_memberships(stats.day).count(), stats.memberships)
+
+    def test_for_range(self):
+        DailyStats.objects.refresh(self.start_date, date(2020, 1, 31))
+        DailyStats.objects.mark_stale(date(2020, 1, 10), date(2020, 1, 10))
+
+        # Reading a past range never calculates anything
+        with self.assertNumQueries(1):
+            stats = DailyStats.objects.for_range(self.start_date, self.end_date)
+        self.assertEqual(60, len(stats))
+        self.assertEqual(date(2020, 1, 10), stats[9].day)
+        self.assertTrue(stats[9].stale)
+        # Days that have not been counted are empty
+        self.assertEqual((date(2020, 2, 1), None, 0), (stats[31].day, stats[31].pk, stats[31].memberships))
+        self.assertEqual(31, DailyStats.objects.count())
+
+        # Today is counted and then left alone for a while
+        today = localtime(now()).date()
+        self.assertTrue(DailyStats.objects.for_range(today, today)[0].pk)
+        with self.assertNumQueries(2):
+            DailyStats.objects.for_range(today - timedelta(days=1), today)
+
+    def test_commands(self):
+        call_command('stats_backfill', start='2020-01-01', end='2020-01-10', chunk_days=3)
+        self.assertEqual(10, DailyStats.objects.count())
+        call_command('stats_refresh')
+        self.assertTrue(DailyStats.objects.filter(day=localtime(now()).date()).exists())
+
+    def test_date_ranges(self):
+        days = [date(2020, 1, 3), date(2020, 1, 1), date(2020, 1, 2), date(2020, 1, 5), date(2020, 1, 5)]
+        self.assertEqual([(date(2020, 1, 1), date(2020, 1, 3)), (date(2020, 1, 5), date(2020, 1, 5))], date_ranges(days))
+
+
+# Copyright 2021 Office Nomads LLC (https://officenomads.com/) Licensed under the AGPL License, Version 3.0 (the "License"); you may not use this file except in compliance with the License. You may obtain a copy of the License at https://www.gnu.org/licenses/agpl-3.0.html. Unless required by applicable law or agreed to in writing, software distributed under the License is distributed on an "AS IS" BASIS, WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the License for the specific language governing permissions and limitations under the License.
@@ -1,4 +1,3 @@
-import unittest
 from django.test import TestCase, override_settings
 
 from django.contrib.auth.models import User
@@ -69,9 +68,56 @@ class TaxLineItemTestCase(TestCase):
         taxes = self.bill.total_tax_applied_by_rate()
         self.assertEqual(len(taxes), 2, "One total per applied tax rate")
 
-    @unittest.skip("Not implemented")
     def test_userbill_calculate_taxes(self):
-        self.fail()
+        """
+        UserBill.calculate_taxes returns the taxes for every line item on the
+        bill, including event line items.
+        """
+        create(a_subscriptionlineitem(
+            self.bill, self.membership,
+            resource=Resource.objects.key_resource, amount=100
+        ))
+        create(a_coworkingdaylineitem(self.bill, self.user, amount=50))
+        create(an_eventlineitem(
+            self.bill, self.user,
+            start_ts=today, end_ts=today + one_hour, amount=200
+        ))
+        # Key has GST and PST, day and event have GST
+        self.assertEqual(len(self.bill.calculate_taxes()), 4)
+
+    def test_userbill_total_tax_applied_by_rate_single_query(self):
+        """
+        The per rate breakdown is one grouped query no matter how many line
+        items or rates there are.
+        """
+        for amount in [10, 20, 30]:
+            line_item = create(a_subscriptionlineitem(
+                self.bill, self.membership,
+                resource=Resource.objects.key_resource, amount=amount
+            ))
+            self.bill.add_lineitem_taxes(line_item.calculate_taxes())
+        with self.assertNumQueries(2):
+            taxes = dict(self.bill.total_tax_applied_by_rate())
+        self.assertEqual(taxes[self.gst], 60 * self.gst.percentage)
+        self.assertEqual(taxes[self.pst], 60 * self.pst.percentage)
+
+    def test_lineitemtax_total_by_bill(self):
+        """
+        Tax totals for many bills come back from one grouped query.
+        """
+        other_bill = UserBill.objects.create_for_day(self.user, today)
+        for bill, amount in [(self.bill, 100), (other_bill, 10)]:
+            line_item = create(a_subscriptionlineitem(
+                bill, self.membership,
+                resource=Resource.objects.key_resource, amount=amount
+            ))
+            bill.add_lineitem_taxes(line_item.calculate_taxes())
+        with self.assertNumQueries(1):
+            totals = LineItemTax.objects.total_by_bill(UserBill.objects.all())
+        self.assertEqual(totals[self.bill.id], self.bill.total_tax_applied())
+        self.assertEqual(totals[other_bill.id], 10 * (self.gst.percentage + self.pst.percentage))
+        by_rate = LineItemTax.objects.total_by_bill_and_rate([self.bill.id, other_bill.id])
+        self.assertEqual(by_rate[(other_bill.id, self.pst.id)], 10 * self.pst.percentage)
 
     def test_userbill_add_lineitem_taxes(self):
         """
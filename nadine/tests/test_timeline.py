@@ -0,0 +1,69 @@
+from datetime import date, timedelta
+
+from django.test import TestCase, override_settings
+from django.contrib.auth.models import User
+from django.urls import reverse
+
+from nadine.models.membership import Membership, ResourceSubscription
+from nadine.models.timeline import MembershipTimeline
+from nadine.utils.benchmark import SyntheticDataset
+
+
+@override_settings(SUSPEND_MEMBER_ALERTS=True)
+class MembershipTimelineTestCase(TestCase):
+
+    def setUp(self):
+        self.dataset = SyntheticDataset(members=8, organizations=2, months=3, end_date=date(2020, 4, 1)).generate()
+        # Some memberships end part way through
+        for subscription in ResourceSubscription.objects.filter(start_date__lt=date(2020, 2, 1))[:5]:
+            subscription.end_date = date(2020, 2, 14)
+            subscription.save()
+        self.start_date = date(2020, 1, 15)
+        self.end_date = date(2020, 3, 15)
+
+    def test_matches_queries(self):
+        timeline = MembershipTimeline(self.start_date, self.end_date)
+        with self.assertNumQueries(4):
+            active_memberships = timeline.active_memberships()
+            by_package = timeline.members_by_package()
+            revenue = timeline.monthly_revenue()
+        self.assertEqual(self.end_date, timeline.days()[-1])
+        for day in [self.start_date, date(2020, 2, 14), date(2020, 2, 15), self.end_date]:
+            i = timeline.index(day)
+            self.assertEqual(Membership.objects.active_memberships(day).count(), active_memberships[i])
+            for package in self.dataset.packages:
+                self.assertEqual(User.helper.members_by_package(package.name, day).count(), timeline.package_members(package.name)[i])
+            active = ResourceSubscription.objects.active_subscriptions(day)
+            self.assertEqual(sum(s.monthly_rate for s in active), revenue[i])
+
+        start, end = date(2020, 2, 1), date(2020, 2, 29)
+        self.assertEqual(Membership.objects.date_range(start, end, action='started').count(), timeline.started(start, end))
+        self.assertEqual(Membership.objects.date_range(start, end, action='ended').count(), timeline.ended(start, end))
+        low, high, avg = timeline.summary(active_memberships, start, end)
+        self.assertTrue(low < high)
+
+    def test_sweep(self):
+        timeline = MembershipTimeline(date(2020, 1, 1), date(2020, 1, 10))
+        intervals = [
+            (date(2019, 12, 1), None, 1),
+            (date(2020, 1, 3), date(2020, 1, 4), 2),
+            (date(2020, 1, 10), date(2020, 2, 1), 4),
+            (date(2020, 2, 1), None, 8),
+        ]
+        self.assertEqual([1, 1, 3, 3, 1, 1, 1, 1, 1, 5], list(timeline.sweep(intervals)))
+        overlapping = [("a", date(2020, 1, 1), date(2020, 1, 5)), ("a", date(2020, 1, 3), None), ("b", date(2020, 1, 2), date(2020, 1, 2))]
+        self.assertEqual([1, 2, 1, 1, 1, 1, 1, 1, 1, 1], list(timeline.sweep(timeline.distinct_intervals(overlapping))))
+
+    def test_stats_views(self):
+        staff = User.objects.create(username='staff_member', is_staff=True)
+        self.client.force_login(staff)
+        for graph in ["members", "income"]:
+            response = self.client.post(reverse('staff:stats:graph'), {'graph': graph, 'start': '2020-01-15', 'end': '2020-03-15'})
+            self.assertEqual(200, response.status_code)
+        self.assertEqual(200, self.client.get(reverse('staff:stats:history')).status_code)
+        self.assertEqual(200, self.client.get(reverse('staff:stats:daily')).status_code)
+        self.assertEqual(200, self.client.get(reverse('staff:activity:graph')).status_code)
+        self.assertEqual(200, self.client.post(reverse('staff:stats:memberships'), {'start_date': '01-2020'}).status_code)
+
+
+# Copyright 2021 Office Nomads LLC (https://officenomads.com/) Licensed under the AGPL License, Version 3.0 (the "License"); you may not use this file except in compliance with the License. You may obtain a copy of the License at https://www.gnu.org/licenses/agpl-3.0.html. Unless required by applicable law or agreed to in writing, software distributed under the License is distributed on an "AS IS" BASIS, WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the License for the specific language governing permissions and limitations under the License.
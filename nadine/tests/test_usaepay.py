@@ -0,0 +1,225 @@
+import os
+import tempfile
+from datetime import datetime, timedelta
+from decimal import Decimal
+
+from django.test import TestCase, override_settings
+from django.urls import reverse
+from django.utils.timezone import localtime, now
+from django.contrib.auth.models import User
+
+from nadine.models.billing import UserBill, BillLineItem, XeroInvoice, USAePayTransaction, USAePayCustomer
+from nadine.utils import payment_api
+from nadine.utils.payment_api import PaymentAPI, get_soap_client
+
+
+today = localtime(now()).date()
+
+WSDL = """<?xml version="1.0"?>
+<definitions name="Test" targetNamespace="urn:test" xmlns:tns="urn:test" xmlns:soap="http://schemas.xmlsoap.org/wsdl/soap/" xmlns:xsd="http://www.w3.org/2001/XMLSchema" xmlns="http://schemas.xmlsoap.org/wsdl/">
+  <message name="pingRequest"><part name="value" type="xsd:string"/></message>
+  <message name="pingResponse"><part name="value" type="xsd:string"/></message>
+  <portType name="TestPort"><operation name="ping"><input message="tns:pingRequest"/><output message="tns:pingResponse"/></operation></portType>
+  <binding name="TestBinding" type="tns:TestPort">
+    <soap:binding style="rpc" transport="http://schemas.xmlsoap.org/soap/http"/>
+    <operation name="ping"><soap:operation soapAction="ping"/><input><soap:body use="literal" namespace="urn:test"/></input><output><soap:body use="literal" namespace="urn:test"/></output></operation>
+  </binding>
+  <service name="TestService"><port name="TestPort" binding="tns:TestBinding"><soap:address location="http://localhost/soap"/></port></service>
+</definitions>
+"""
+
+
+class FakeSoapObject(object):
+    ''' Behaves like the objects suds hands back from the USAePay SOAP API. '''
+
+    def __init__(self, **kwargs):
+        self.__dict__.update(kwargs)
+
+    def __contains__(self, name):
+        return name in self.__dict__
+
+
+def soap_transaction(ref_num, username, amount, day, status="Authorized", card_type="V", transaction_type="Sale"):
+    card = FakeSoapObject(CardType=card_type) if card_type != "ACH" else None
+    return FakeSoapObject(
+        CustomerID=username,
+        CreditCardData=card,
+        Status=status,
+        TransactionType=transaction_type,
+        Details=FakeSoapObject(Amount=amount, Description="Payment from %s" % username),
+        DateTime="%s 12:00:00" % day.isoformat(),
+        Response=FakeSoapObject(RefNum=ref_num, Error=None),
+    )
+
+
+class FakeEntryPoint(object):
+    ''' Stands in for USAEPAY_SOAP_API with canned transactions and customers. '''
+
+    def __init__(self, transactions=None, settled_checks=None, customers=None):
+        self.transactions = transactions or {}
+        self.settled_checks = settled_checks or {}
+        self.customers = customers or {}
+        self.calls = []
+
+    def getTransactions(self, year, month, day):
+        self.calls.append('getTransactions')
+        return self.transactions.get((year, month, day))
+
+    def getSettledCheckTransactions(self, year, month, day):
+        self.calls.append('getSettledCheckTransactions')
+        return self.settled_checks.get((year, month, day))
+
+    def getAllCustomers(self, username):
+        self.calls.append('getAllCustomers')
+        customers = self.customers.get(username)
+        if isinstance(customers, Exception):
+            raise customers
+        return customers
+
+    def updateCustomer(self, customer):
+        self.calls.append('updateCustomer')
+
+
+@override_settings(SUSPEND_MEMBER_ALERTS=True)
+class USAePayTestCase(TestCase):
+
+    def setUp(self):
+        self.user1 = User.objects.create(username='member_one', first_name='Member', last_name='One')
+        self.user2 = User.objects.create(username='member_two', first_name='Member', last_name='Two')
+        self.key = (today.year, today.month, today.day)
+
+    def create_bill(self, user, amount):
+        bill = UserBill.objects.create(user=user, period_start=today, period_end=today, due_date=today)
+        BillLineItem.objects.create(bill=bill, description="Desk", amount=amount)
+        return bill
+
+    def test_sync_day(self):
+        entry_point = FakeEntryPoint(
+            transactions={self.key: [soap_transaction(1, "member_one", 100.0, today), soap_transaction(2, "nobody", 50.0, today, card_type="ACH")]},
+            settled_checks={self.key: [soap_transaction(3, "member_two", 75.0, today - timedelta(days=4), status="Settled", card_type="ACH")]},
+        )
+        api = PaymentAPI(entry_point=entry_point)
+        self.assertEqual(3, USAePayTransaction.objects.sync_day(today, api))
+        self.assertEqual(2, USAePayTransaction.objects.for_day(today).count())
+        self.assertEqual(1, USAePayTransaction.objects.settled_on(today).count())
+        t = USAePayTransaction.objects.get(transaction_id="1")
+        self.assertEqual(self.user1, t.user)
+        self.assertEqual(Decimal("100.00"), t.amount)
+        self.assertEqual("V", t.card_type)
+        self.assertEqual(None, USAePayTransaction.objects.get(transaction_id="2").user)
+
+        # Syncing again updates what we have
+        entry_point.transactions[self.key][0] = soap_transaction(1, "member_one", 100.0, today, status="Settled")
+        USAePayTransaction.objects.sync_day(today, api)
+        self.assertEqual(3, USAePayTransaction.objects.count())
+        self.assertEqual("Settled", USAePayTransaction.objects.get(transaction_id="1").status)
+
+    def test_needs_sync(self):
+        yesterday = today - timedelta(days=1)
+        self.assertTrue(USAePayTransaction.objects.needs_sync(yesterday))
+        entry_point = FakeEntryPoint(transactions={
+            self.key: [soap_transaction(1, "member_one", 100.0, today)],
+            (yesterday.year, yesterday.month, yesterday.day): [soap_transaction(2, "member_one", 100.0, yesterday)],
+        })
+        api = PaymentAPI(entry_point=entry_point)
+        USAePayTransaction.objects.sync_day(today, api)
+        USAePayTransaction.objects.sync_day(yesterday, api)
+        # Today is always synced, other days not right after a sync
+        self.assertTrue(USAePayTransaction.objects.needs_sync(today))
+        self.assertFalse(USAePayTransaction.objects.needs_sync(yesterday))
+
+        # A while later yesterday is still waiting on its batch to close
+        USAePayTransaction.objects.filter(transaction_id="2").update(synced_ts=now() - timedelta(hours=1))
+        self.assertTrue(USAePayTransaction.objects.needs_sync(yesterday))
+        USAePayTransaction.objects.filter(transaction_id="2").update(status="Settled")
+        self.assertFalse(USAePayTransaction.objects.needs_sync(yesterday))
+
+    def test_reconcile(self):
+        bill = self.create_bill(self.user1, 100)
+        self.create_bill(self.user2, 100)
+        self.create_bill(self.user2, 50)
+        UserBill.objects.update_cached_totals()
+        # Neighbouring invoices that do not match
+        for i, amount in enumerate([30, 40, 100]):
+            XeroInvoice.objects.create(invoice_id=str(i), invoice_number="INV-%d" % i, contact_id="c", user=self.user1, status="AUTHORISED", amount_due=amount)
+        entry_point = FakeEntryPoint(transactions={self.key: [
+            soap_transaction(1, "member_one", 100.0, today),
+            soap_transaction(2, "member_two", 100.0, today),
+        ]})
+        USAePayTransaction.objects.sync_day(today, PaymentAPI(entry_point=entry_point))
+
+        with self.assertNumQueries(4):
+            transactions = USAePayTransaction.objects.reconcile(USAePayTransaction.objects.for_day(today))
+        t1, t2 = transactions
+        self.assertEqual(bill, t1.bill_match)
+        self.assertEqual(["INV-2"], [i.invoice_number for i in t1.xero_invoices])
+        self.assertEqual(None, t2.bill_match)
+        self.assertEqual(2, t2.bill_count)
+        self.assertEqual([], t2.xero_invoices)
+
+    def test_sync_customers(self):
+        USAePayCustomer.objects.create(customer_number="9", username="member_two", enabled=True)
+        customers = {'member_one': [FakeSoapObject(CustNum=1, Enabled=True, Next="2021-02-01T00:00:00", Amount=100.0, Description="Monthly")]}
+        entry_point = FakeEntryPoint(customers=customers)
+        self.assertEqual(1, USAePayCustomer.objects.sync(usernames=['member_one', 'member_two'], api=PaymentAPI(entry_point=entry_point)))
+        customer = USAePayCustomer.objects.get(username="member_one")
+        self.assertEqual(self.user1, customer.user)
+        self.assertEqual(datetime(2021, 2, 1).date(), customer.next_date)
+        # Customers that are gone from USAePay are removed
+        self.assertFalse(USAePayCustomer.objects.filter(username="member_two").exists())
+
+    def test_map_users(self):
+        customers = {
+            'member_one': [FakeSoapObject(CustNum=1, Enabled=True, Next=None, Amount=None, Description=None)],
+            'member_two': Exception("Connection reset"),
+        }
+        api = PaymentAPI(entry_point=FakeEntryPoint(customers=customers))
+        results = api.get_customers_for(['member_one', 'member_two', 'nobody'])
+        self.assertEqual(1, len(results['member_one']))
+        self.assertTrue(isinstance(results['member_two'], Exception))
+        self.assertEqual([], results['nobody'])
+
+        api.disable_recurring_for(['member_one'])
+        self.assertFalse(customers['member_one'][0].Enabled)
+
+        # What we already have is kept when a lookup fails
+        USAePayCustomer.objects.create(customer_number="9", username="member_two", enabled=True)
+        with self.assertRaises(Exception):
+            USAePayCustomer.objects.sync(usernames=['member_one', 'member_two'], api=api)
+        self.assertTrue(USAePayCustomer.objects.filter(username="member_two").exists())
+        self.assertTrue(USAePayCustomer.objects.filter(username="member_one").exists())
+
+    def test_soap_client_pool(self):
+        with tempfile.TemporaryDirectory() as directory:
+            wsdl = os.path.join(directory, "test.wsdl")
+            with open(wsdl, "w") as f:
+                f.write(WSDL)
+            url = "file://" + wsdl
+            cache = os.path.join(directory, "cache")
+            with self.settings(USA_EPAY_WSDL_CACHE_DIR=cache):
+                client = get_soap_client(url)
+                self.assertTrue(client is get_soap_client(url))
+                # Other threads get their own client from the cache on disk
+                other = payment_api.get_executor().submit(get_soap_client, url).result()
+                self.assertFalse(client is other)
+                self.assertTrue(len(os.listdir(cache)) > 0)
+            payment_api._soap_clients.clients.pop(url)
+
+    def test_reconcile_view(self):
+        staff = User.objects.create(username='staff_member', is_staff=True)
+        bill = self.create_bill(self.user1, 100)
+        UserBill.objects.update_cached_totals()
+        entry_point = FakeEntryPoint(transactions={self.key: [soap_transaction(1, "member_one", 100.0, today)]})
+        USAePayTransaction.objects.sync_day(today, PaymentAPI(entry_point=entry_point))
+
+        self.client.force_login(staff)
+        url = reverse('staff:billing:reconcile', kwargs={'year': today.year, 'month': today.month, 'day': today.day})
+        response = self.client.get(url)
+        self.assertEqual(200, response.status_code)
+        data = response.json()
+        self.assertEqual(1, len(data['transactions']))
+        self.assertEqual(bill.id, data['transactions'][0]['bill_match'])
+        self.assertEqual([bill.id], data['transactions'][0]['outstanding_bills'])
+
+
+# Copyright 2021 Office Nomads LLC (https://officenomads.com/) Licensed under the AGPL License, Version 3.0 (the "License"); you may not use this file except in compliance with the License. You may obtain a copy of the License at https://www.gnu.org/licenses/agpl-3.0.html. Unless required by applicable law or agreed to in writing, software distributed under the License is distributed on an "AS IS" BASIS, WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the License for the specific language governing permissions and limitations under the License.
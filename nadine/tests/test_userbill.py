@@ -1,20 +1,23 @@
-import traceback, logging
+import traceback, logging, csv, gzip
 from datetime import datetime, timedelta, date
 from dateutil.relativedelta import relativedelta
 from decimal import Decimal
 
 from django.urls import reverse
+from django.db import connection
 from django.test import TestCase, override_settings
+from django.test.utils import CaptureQueriesContext
 from django.utils import timezone
 from django.utils.timezone import localtime, now
 from django.contrib.auth.models import User
 
-from nadine.models.billing import UserBill, BillLineItem, Payment
+from nadine.models.billing import UserBill, BillUsage, BillLineItem, BillingEvent, Payment, PaymentMethod, billing_journal, deferred_bill_totals, read_payment_rows
 from nadine.models.membership import MembershipPackage, SubscriptionDefault
 from nadine.models.membership import Membership, ResourceSubscription
 from nadine.models.organization import Organization
 from nadine.models.resource import Resource, Room
 from nadine.models.usage import CoworkingDay, Event
+from nadine.utils.billing_export import export_rows, export_stream
 
 
 today = localtime(now()).date()
@@ -105,6 +108,173 @@ class UserBillTestCase(TestCase):
         self.assertEqual(9, bill.total_owed)
         self.assertTrue(bill in UserBill.objects.outstanding())
 
+    def test_outstanding_report(self):
+        def subscription(user, rate):
+            return ResourceSubscription.objects.create(
+                membership = user.membership,
+                resource = Resource.objects.day_resource,
+                start_date = two_months_ago,
+                monthly_rate = Decimal(rate),
+                overage_rate = 0,
+            )
+        def monthly_bill(user):
+            return UserBill.objects.create(user=user, period_start=today, period_end=one_month_from_now - timedelta(days=1), due_date=today)
+        users = [User.objects.create(username='report_%d' % i) for i in range(5)]
+
+        # Subscription not paid yet with a coworking day
+        due = monthly_bill(users[0])
+        due.add_subscription(subscription(users[0], 100))
+        due.add_coworking_day(CoworkingDay.objects.create(user=users[0], visit_date=today, payment="Bill"))
+        # Drop in with no subscriptions
+        dropin = UserBill.objects.create_for_day(users[1], today)
+        BillLineItem.objects.create(bill=dropin, amount=20)
+        # Subscription paid but something else is owed
+        other = monthly_bill(users[2])
+        other.add_subscription(subscription(users[2], 100))
+        BillLineItem.objects.create(bill=other, amount=30)
+        Payment.objects.create(bill=other, user=users[2], amount=100)
+        # Closed with money owed
+        closed = UserBill.objects.create_for_day(users[3], today)
+        BillLineItem.objects.create(bill=closed, amount=15)
+        closed.close()
+        # Someone is working on this one
+        in_progress = UserBill.objects.create_for_day(users[4], today)
+        BillLineItem.objects.create(bill=in_progress, amount=25)
+        in_progress.in_progress = True
+        in_progress.save()
+
+        UserBill.objects.update_cached_totals()
+
+        with self.assertNumQueries(1):
+            report = UserBill.objects.outstanding_report()
+        self.assertEqual([due], report['subscriptions']['bills'])
+        self.assertEqual([dropin], report['dropin']['bills'])
+        self.assertEqual([other], report['other']['bills'])
+        self.assertEqual([closed], report['closed']['bills'])
+        self.assertEqual([in_progress], report['in_progress']['bills'])
+        self.assertEqual(5, report['bill_count'])
+        self.assertEqual(sum(b.total for b in [due, dropin, other, closed, in_progress]), report['bill_total'])
+        self.assertEqual(30, report['other']['total'] - other.total_paid)
+
+        # The annotations match the properties they replace
+        for category in ['subscriptions', 'dropin', 'other']:
+            bill = report[category]['bills'][0]
+            self.assertEqual(bill.subscriptions().count(), bill.subscription_count)
+            self.assertEqual(bill.monthly_rate, bill.report_monthly_rate)
+            self.assertEqual(bill.overage_amount or 0, bill.report_overage)
+            self.assertEqual(bill.coworking_day_count, bill.report_day_count)
+            self.assertEqual(bill.coworking_day_billable_count, bill.report_billable_day_count)
+            self.assertEqual(bill.total, bill.bill_total)
+
+    def test_record_payments(self):
+        bill1 = UserBill.objects.create_for_day(self.user1, today)
+        BillLineItem.objects.create(bill=bill1, amount=100)
+        user2 = User.objects.create(username='member_two', first_name='Member', last_name='Two')
+        bill2 = UserBill.objects.create_for_day(user2, today)
+        BillLineItem.objects.create(bill=bill2, amount=50)
+        method = PaymentMethod.objects.create(name="ACH")
+        Payment.objects.create(bill=bill2, user=user2, amount=10, external_id="ach-1")
+
+        rows = read_payment_rows("\n".join([
+            "bill,amount,method,external_id,payment_date",
+            "%d,60,ach,ach-2,2017-06-01" % bill1.id,
+            "%d,40.00,%d,ach-3," % (bill1.id, method.id),
+            "%d,1,,ach-4," % bill1.id,
+            "%d,20,,ach-1," % bill2.id,
+            "%d,20,Bitcoin,," % bill2.id,
+            "0,20,,,",
+            "%d,-5,,," % bill2.id,
+        ]), "csv")
+        results = Payment.objects.record_payments(rows, created_by=self.user1)
+        self.assertEqual(7, len(results))
+        self.assertEqual([False, False, True, True, True, True, True], ['error' in r for r in results])
+        self.assertIn("exceeds amount owed $0.00", results[2]['error'])
+        self.assertIn("already recorded", results[3]['error'])
+        self.assertIn("Unknown payment method", results[4]['error'])
+
+        bill1.refresh_from_db()
+        self.assertEqual(100, bill1.cached_total_paid)
+        self.assertEqual(0, bill1.cached_total_owed)
+        payment = Payment.objects.get(external_id="ach-2")
+        self.assertEqual(method, payment.method)
+        self.assertEqual(self.user1, payment.created_by)
+        self.assertEqual(date(2017, 6, 1), localtime(payment.created_ts).date())
+        self.assertEqual(payment.id, results[0]['payment'].id)
+
+        # The same file again only finds duplicates
+        results = Payment.objects.record_payments(rows)
+        self.assertTrue(all('error' in r for r in results))
+
+    def test_read_payment_rows(self):
+        rows = read_payment_rows('[{"bill": 1, "amount": "10.00"}]', "json")
+        self.assertEqual([{'bill': 1, 'amount': '10.00'}], rows)
+        rows = read_payment_rows("bill, amount\n1, 10.00\n", "csv")
+        self.assertEqual([{'bill': '1', 'amount': '10.00'}], rows)
+        with self.assertRaises(Exception):
+            read_payment_rows('{"bill": 1}', "json")
+
+    def test_validate_bad_payment_rows(self):
+        bill = UserBill.objects.create_for_day(self.user1, today)
+        BillLineItem.objects.create(bill=bill, amount=100)
+        rows = read_payment_rows('[1, "bill", {"bill": %d, "amount": "NaN"}, {"bill": %d, "amount": 10}]' % (bill.id, bill.id), "json")
+        results = Payment.objects.validate_payments(rows)
+        self.assertEqual([True, True, True, False], ['error' in r for r in results])
+        self.assertIn("Invalid amount", results[2]['error'])
+
+    def test_deferred_bill_totals(self):
+        bill = UserBill.objects.create_for_day(self.user1, today)
+        with deferred_bill_totals() as bill_ids:
+            BillLineItem.objects.create(bill=bill, amount=10)
+            Payment.objects.create(bill=bill, user=self.user1, amount=4)
+            self.assertEqual({bill.id}, bill_ids)
+            # Nothing has been cached yet
+            self.assertFalse(bill in UserBill.objects.outstanding())
+        bill.refresh_from_db()
+        self.assertEqual(10, bill.cached_total_amount)
+        self.assertEqual(4, bill.cached_total_paid)
+        self.assertEqual(6, bill.cached_total_owed)
+        self.assertTrue(bill in UserBill.objects.outstanding())
+
+    def test_billing_journal_exception(self):
+        bill = UserBill.objects.create_for_day(self.user1, today)
+        BillingEvent.objects.all().delete()
+        with self.assertRaisesMessage(Exception, "Something broke"):
+            with billing_journal():
+                BillingEvent.objects.record(bill.id, BillingEvent.CLOSED)
+                raise Exception("Something broke")
+        self.assertFalse(BillingEvent.objects.exists())
+
+        # Only the inner block that failed is thrown away
+        with billing_journal():
+            BillingEvent.objects.record(bill.id, BillingEvent.CLOSED)
+            try:
+                with billing_journal():
+                    BillingEvent.objects.record(bill.id, BillingEvent.RECALCULATED)
+                    raise Exception("Something broke")
+            except Exception:
+                pass
+        self.assertEqual([BillingEvent.CLOSED], list(BillingEvent.objects.values_list('action', flat=True)))
+
+    def test_close_inside_deferred_bill_totals(self):
+        bill = UserBill.objects.create_for_day(self.user1, today)
+        with deferred_bill_totals():
+            BillLineItem.objects.create(bill=bill, amount=10)
+            bill.close()
+        # The event has the amount from the line items, not the stale cache
+        event = BillingEvent.objects.get(bill=bill, action=BillingEvent.CLOSED)
+        self.assertEqual(10, event.amount_after)
+
+    def test_update_cached_totals(self):
+        bill = UserBill.objects.create_for_day(self.user1, today)
+        BillLineItem.objects.create(bill=bill, amount=10)
+        Payment.objects.create(bill=bill, user=self.user1, amount=1)
+        UserBill.objects.filter(id=bill.id).update(cached_total_amount=0, cached_total_paid=0, cached_total_owed=0)
+        self.assertEqual(1, UserBill.objects.update_cached_totals([bill.id]))
+        bill.refresh_from_db()
+        self.assertEqual(bill.amount, bill.cached_total_amount)
+        self.assertEqual(bill.total_paid, bill.cached_total_paid)
+        self.assertEqual(bill.total_owed, bill.cached_total_owed)
+
     def test_open_and_closed(self):
         bill = UserBill.objects.create_for_day(self.user1, today)
         self.assertTrue(bill in UserBill.objects.open())
@@ -152,6 +322,81 @@ class UserBillTestCase(TestCase):
         self.assertEqual(2, bill.event_hours_used)
         self.assertTrue(1 == bill.event_count)
 
+    def test_add_events_with_usage(self):
+        ResourceSubscription.objects.create(
+            membership = self.user1.membership,
+            resource = Resource.objects.event_resource,
+            start_date = two_months_ago,
+            allowance = 3,
+            monthly_rate = Decimal(0),
+            overage_rate = 20,
+        )
+        bill = UserBill.objects.create_for_day(self.user1, today)
+        start = localtime(now()).replace(hour=9, minute=0, second=0, microsecond=0)
+        usage = BillUsage(bill)
+        query_counts = []
+        for i in range(6):
+            event = Event.objects.create(
+                user = self.user1,
+                room = self.test_room,
+                start_ts = start + timedelta(minutes=10*i),
+                end_ts = start + timedelta(minutes=10*i, hours=1),
+            )
+            with CaptureQueriesContext(connection) as queries:
+                bill.add_event(event, usage)
+            query_counts.append(len(queries))
+        self.assertEqual(6, usage.hours_used)
+        # After the counters are loaded each event costs the same
+        self.assertEqual(1, len(set(query_counts[1:])))
+        self.assertLess(query_counts[1], query_counts[0])
+        # The running totals price events the same as starting from scratch
+        self.assertEqual([], bill.recalculate())
+
+    def test_with_details(self):
+        def make_bill(user):
+            subscription = ResourceSubscription.objects.create(
+                membership = user.membership,
+                resource = Resource.objects.day_resource,
+                start_date = two_months_ago,
+                allowance = 1,
+                monthly_rate = Decimal(100.00),
+                overage_rate = 20,
+            )
+            bill = UserBill.objects.create_for_day(user, today)
+            bill.add_subscription(subscription)
+            bill.add_coworking_day(CoworkingDay.objects.create(user=user, visit_date=today, payment="Bill"))
+            bill.add_coworking_day(CoworkingDay.objects.create(user=user, visit_date=yesterday, payment="Waive"))
+            bill.add_event(Event.objects.create(user=user, room=self.test_room, start_ts=localtime(now()), end_ts=localtime(now()) + timedelta(hours=1)))
+            Payment.objects.create(bill=bill, user=user, amount=5)
+            return bill
+        bills = [make_bill(self.user1)]
+        bills += [make_bill(User.objects.create(username='details_%d' % i)) for i in range(3)]
+
+        def details(bill):
+            return (
+                bill.amount, bill.tax_amount, bill.total_paid, bill.monthly_rate,
+                [s.id for s in bill.subscriptions_list()], [d.id for d in bill.coworking_days_list()], [e.id for e in bill.events_list()],
+                bill.coworking_day_count, bill.coworking_day_billable_count, bill.event_count,
+                bill.resource_allowance(Resource.objects.day_resource), bill.event_hour_overage_rate,
+            )
+        expected = [details(b) for b in UserBill.objects.filter(id__in=[b.id for b in bills]).order_by('id')]
+        Resource.objects.day_resource
+        Resource.objects.event_resource
+        # user, line items with their subscriptions/days/events, taxes and payments
+        with self.assertNumQueries(4):
+            prefetched = list(UserBill.objects.with_details().filter(id__in=[b.id for b in bills]).order_by('id'))
+            self.assertEqual(expected, [details(b) for b in prefetched])
+
+        # The QuerySet methods still hand back QuerySets
+        bill = prefetched[0]
+        self.assertEqual(1, bill.subscriptions().filter(resource=Resource.objects.day_resource).count())
+        self.assertEqual(2, len(bill.desired_line_items()) - bill.coworking_day_count)
+
+        # Recalculating drops anything prefetched
+        BillLineItem.objects.create(bill=bill, amount=7, custom=True)
+        self.assertEqual([], bill.recalculate())
+        self.assertEqual(expected[0][0] + 7, bill.amount)
+
     def test_monthly_rate(self):
         bill = UserBill.objects.create_for_day(self.user1, today)
         self.assertEqual(0, bill.resource_allowance(Resource.objects.day_resource))
@@ -223,6 +468,53 @@ class UserBillTestCase(TestCase):
         bill.recalculate()
         self.assertEqual(bill.amount, subscription.monthly_rate)
 
+    def test_recalculate_incremental(self):
+        user = User.objects.create(username='test_user', first_name='Test', last_name='User')
+        membership = Membership.objects.for_user(user)
+        bill = UserBill.objects.create(user=user, period_start=one_month_ago, period_end=today, due_date=today)
+        day1 = CoworkingDay.objects.create(user=user, visit_date=yesterday - timedelta(days=1), payment='Bill')
+        day2 = CoworkingDay.objects.create(user=user, visit_date=yesterday, payment='Bill')
+        bill.add_coworking_day(day1)
+        bill.add_coworking_day(day2)
+        custom = BillLineItem.objects.create(bill=bill, description="Custom", amount=5, custom=True)
+
+        # Nothing changed so nothing is written
+        line_item_ids = set(bill.line_items.values_list('id', flat=True))
+        self.assertEqual([], bill.recalculate())
+        self.assertEqual(line_item_ids, set(bill.line_items.values_list('id', flat=True)))
+
+        # A subscription with an allowance of one only changes the first day
+        subscription = ResourceSubscription.objects.create(membership=membership, resource=Resource.objects.day_resource, allowance=1, start_date=one_month_ago, end_date=one_month_from_now, monthly_rate=Decimal(50.00), overage_rate=Decimal(20.00))
+        bill.add_subscription(subscription)
+        line_item_ids = set(bill.line_items.values_list('id', flat=True))
+        changes = bill.recalculate()
+        self.assertEqual(2, len(changes))
+        self.assertEqual(line_item_ids, set(bill.line_items.values_list('id', flat=True)))
+        self.assertEqual(0, bill.line_items.get(coworkingdaylineitem__day=day1).amount)
+        self.assertEqual(20, bill.line_items.get(coworkingdaylineitem__day=day2).amount)
+        self.assertEqual(subscription.monthly_rate + 20 + custom.amount, bill.amount)
+        self.assertEqual(bill.amount, bill.cached_total_amount)
+
+    def test_export_billing(self):
+        bill = UserBill.objects.create_for_day(self.user1, today)
+        day = CoworkingDay.objects.create(user=self.user1, visit_date=today, payment='Bill')
+        bill.add_coworking_day(day)
+        BillLineItem.objects.create(bill=bill, description="Custom", amount=10, custom=True)
+        Payment.objects.create(bill=bill, user=self.user1, amount=10)
+
+        rows = list(export_rows('line_items', yesterday, tomorrow, columns=['bill_id', 'type', 'amount']))
+        self.assertEqual(['bill_id', 'type', 'amount'], rows[0])
+        self.assertEqual(3, len(rows))
+        self.assertEqual(set(['coworking_day', 'other']), set(r[1] for r in rows[1:]))
+        # Nothing outside of the date range
+        self.assertEqual(1, len(list(export_rows('bills', tomorrow, tomorrow))))
+        with self.assertRaises(Exception):
+            export_stream('bills', yesterday, tomorrow, columns=['bogus'])
+
+        data = b"".join(export_stream('payments', yesterday, tomorrow, columns=['bill_id', 'amount'], gzip=True))
+        rows = list(csv.reader(gzip.decompress(data).decode('utf-8').splitlines()))
+        self.assertEqual([['bill_id', 'amount'], [str(bill.id), '10.00']], rows)
+
     def test_combine(self):
         user = User.objects.create(username='test_user', first_name='Test', last_name='User')
         membership = Membership.objects.for_user(user)
@@ -0,0 +1,165 @@
+from datetime import datetime, timedelta
+from decimal import Decimal
+
+from django.test import TestCase, override_settings
+from django.utils.timezone import localtime, now
+from django.contrib.auth.models import User
+
+from xero.exceptions import XeroRateLimitExceeded
+
+from nadine.models.billing import UserBill, BillLineItem, XeroInvoice, XeroSync
+from nadine.models.profile import XeroContact
+from nadine.utils.xero_api import XeroAPI, XERO_PAGE_SIZE
+
+
+today = localtime(now()).date()
+
+
+class FakeResponse(object):
+    text = "Rate limit exceeded"
+    headers = {'Retry-After': '0'}
+
+
+class FakeManager(object):
+    ''' Stands in for a pyxero manager, handing back canned records one page at a time. '''
+
+    def __init__(self, records, rate_limited=0, failing_puts=None):
+        self.records = records
+        self.rate_limited = rate_limited
+        self.failing_puts = failing_puts or []
+        self.calls = []
+        self.saved = []
+
+    def filter(self, page=1, **kwargs):
+        self.calls.append(dict(kwargs, page=page))
+        if self.rate_limited:
+            self.rate_limited -= 1
+            raise XeroRateLimitExceeded(FakeResponse(), {})
+        start = (page - 1) * XERO_PAGE_SIZE
+        return self.records[start:start + XERO_PAGE_SIZE]
+
+    def put(self, data, summarize_errors=True):
+        if len(self.saved) in self.failing_puts:
+            raise Exception("Xero fell over")
+        self.saved.append(data)
+        return [dict(d, InvoiceID="pushed-%s" % d['Reference'], InvoiceNumber=d['Reference'], Total=0, AmountDue=0, AmountPaid=0) for d in data]
+
+
+class FakeXero(object):
+
+    def __init__(self, contacts, invoices, rate_limited=0, failing_puts=None):
+        self.contacts = FakeManager(contacts)
+        self.invoices = FakeManager(invoices, rate_limited, failing_puts)
+
+
+def invoice_data(i, contact_id, status="AUTHORISED", amount=100):
+    return {
+        'InvoiceID': "invoice-%d" % i,
+        'InvoiceNumber': "INV-%d" % i,
+        'Contact': {'ContactID': contact_id},
+        'Status': status,
+        'Date': datetime(2021, 1, 1),
+        'DueDate': datetime(2021, 1, 15),
+        'Total': Decimal(amount),
+        'AmountDue': Decimal(amount),
+        'AmountPaid': Decimal(0),
+        'UpdatedDateUTC': datetime(2021, 1, 2, 12, 0),
+    }
+
+
+@override_settings(SUSPEND_MEMBER_ALERTS=True, XERO_BATCH_SIZE=2)
+class XeroSyncTestCase(TestCase):
+
+    def setUp(self):
+        self.user1 = User.objects.create(username='member_one', first_name='Member', last_name='One')
+        self.user2 = User.objects.create(username='member_two', first_name='Member', last_name='Two')
+        XeroContact.objects.create(user=self.user1, xero_id="contact-1")
+
+    def test_pull(self):
+        contacts = [{'ContactID': "contact-2", 'AccountNumber': "member_two"}, {'ContactID': "contact-3"}]
+        invoices = [invoice_data(i, "contact-%d" % (i % 3 + 1)) for i in range(XERO_PAGE_SIZE + 5)]
+        invoices[0]['Status'] = "PAID"
+        xero = FakeXero(contacts, invoices, rate_limited=1)
+        sync = XeroSync.objects.run(api=XeroAPI(xero=xero))
+        self.assertTrue(sync.successful)
+        self.assertEqual(1, sync.contacts_linked)
+        self.assertEqual(len(invoices), sync.invoices_updated)
+        self.assertEqual(XeroContact.objects.get(user=self.user2).xero_id, "contact-2")
+
+        # Rate limited once then two pages
+        self.assertEqual(3, len(xero.invoices.calls))
+        self.assertEqual(len(invoices), XeroInvoice.objects.count())
+        self.assertEqual(35, XeroInvoice.objects.filter(user__isnull=True).count())
+        by_username = XeroInvoice.objects.open_by_username()
+        self.assertEqual(34, len(by_username['member_one']))
+        self.assertEqual(35, len(by_username['member_two']))
+        self.assertEqual(35, len(by_username['None']))
+        self.assertEqual(34, self.user1.profile.open_xero_invoices().count())
+
+        # The next sync only asks for what changed since this one
+        xero = FakeXero([], [invoice_data(1, "contact-1", status="PAID")])
+        next_sync = XeroSync.objects.run(api=XeroAPI(xero=xero))
+        self.assertEqual(sync.created_ts, next_sync.since)
+        self.assertEqual(sync.created_ts, xero.invoices.calls[0]['since'])
+        self.assertEqual("PAID", XeroInvoice.objects.get(invoice_id="invoice-1").status)
+
+    def test_push_bills(self):
+        last_month = today - timedelta(days=40)
+        bills = []
+        for user in [self.user1, self.user1, self.user1, self.user2]:
+            bill = UserBill.objects.create(user=user, period_start=last_month, period_end=last_month + timedelta(days=29), due_date=last_month + timedelta(days=29))
+            BillLineItem.objects.create(bill=bill, description="Desk", amount=100)
+            bills.append(bill)
+        # Nothing to pay on this one
+        UserBill.objects.create(user=self.user1, period_start=last_month, period_end=last_month, due_date=last_month)
+
+        xero = FakeXero([], [])
+        sync = XeroSync.objects.run(push_bills=True, api=XeroAPI(xero=xero))
+        self.assertTrue(sync.successful)
+        # The member without a Xero contact is left alone
+        self.assertEqual(3, sync.bills_pushed)
+        self.assertEqual([2, 1], [len(b) for b in xero.invoices.saved])
+        self.assertEqual("contact-1", xero.invoices.saved[0][0]['Contact']['ContactID'])
+        self.assertEqual(Decimal(100), xero.invoices.saved[0][0]['LineItems'][0]['UnitAmount'])
+        self.assertEqual(bills[0], XeroInvoice.objects.get(invoice_id="pushed-Bill %d" % bills[0].id).bill)
+
+        # Bills are only pushed once
+        sync = XeroSync.objects.run(push_bills=True, api=XeroAPI(xero=xero))
+        self.assertEqual(0, sync.bills_pushed)
+
+    def test_push_bills_partial_failure(self):
+        last_month = today - timedelta(days=40)
+        bills = []
+        for i in range(3):
+            bill = UserBill.objects.create(user=self.user1, period_start=last_month, period_end=last_month + timedelta(days=29), due_date=last_month + timedelta(days=29))
+            BillLineItem.objects.create(bill=bill, description="Desk", amount=100)
+            bills.append(bill)
+
+        # The second batch fails but the first one is already in Xero
+        xero = FakeXero([], [], failing_puts=[1])
+        with self.assertRaises(Exception):
+            XeroSync.objects.run(push_bills=True, api=XeroAPI(xero=xero))
+        self.assertEqual(2, XeroInvoice.objects.filter(bill__isnull=False).count())
+
+        # Only the bill that never made it is pushed the next time
+        xero = FakeXero([], [])
+        sync = XeroSync.objects.run(push_bills=True, api=XeroAPI(xero=xero))
+        self.assertEqual(1, sync.bills_pushed)
+        self.assertEqual("Bill %d" % bills[2].id, xero.invoices.saved[0][0]['Reference'])
+
+    def test_pull_links_bills(self):
+        bill = UserBill.objects.create(user=self.user1, period_start=today, period_end=today, due_date=today)
+        data = invoice_data(1, "contact-1")
+        data['Reference'] = "Bill %d" % bill.id
+        other = invoice_data(2, "contact-1")
+        other['Reference'] = "Bill 0"
+        XeroSync.objects.run(api=XeroAPI(xero=FakeXero([], [data, other])))
+        self.assertEqual(bill, XeroInvoice.objects.get(invoice_id="invoice-1").bill)
+        self.assertIsNone(XeroInvoice.objects.get(invoice_id="invoice-2").bill)
+
+        # Pulling it again leaves the link alone
+        XeroSync.objects.run(api=XeroAPI(xero=FakeXero([], [data])))
+        self.assertEqual(bill, XeroInvoice.objects.get(invoice_id="invoice-1").bill)
+
+
+# Copyright 2021 Office Nomads LLC (https://officenomads.com/) Licensed under the AGPL License, Version 3.0 (the "License"); you may not use this file except in compliance with the License. You may obtain a copy of the License at https://www.gnu.org/licenses/agpl-3.0.html. Unless required by applicable law or agreed to in writing, software distributed under the License is distributed on an "AS IS" BASIS, WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the License for the specific language governing permissions and limitations under the License.
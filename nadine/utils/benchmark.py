@@ -0,0 +1,187 @@
+import time
+import random
+import logging
+from datetime import datetime, timedelta, time as dt_time
+from collections import namedtuple
+from decimal import Decimal
+from dateutil.relativedelta import relativedelta
+
+from django.db import connection
+from django.test.utils import CaptureQueriesContext
+from django.contrib.auth.models import User
+from django.utils.timezone import localtime, now, make_aware
+
+from nadine.models.billing import BillingBatch, UserBill
+from nadine.models.membership import Membership, MembershipPackage, SubscriptionDefault, OrganizationMembership, ResourceSubscription
+from nadine.models.organization import Organization
+from nadine.models.resource import Resource, Room
+from nadine.models.stats import DailyStats
+from nadine.models.usage import CoworkingDay, Event
+
+logger = logging.getLogger(__name__)
+
+
+BenchmarkResult = namedtuple('BenchmarkResult', ['name', 'seconds', 'queries'])
+
+
+class SyntheticDataset(object):
+    ''' Generate a coworking space worth of members, subscriptions and activity.
+
+    Everything is driven by a seeded random number generator so the same
+    arguments always produce the same data.
+    '''
+
+    def __init__(self, members=50, organizations=5, months=12, seed=1, end_date=None, prefix="bench"):
+        self.members = members
+        self.organizations = organizations
+        self.months = months
+        self.random = random.Random(seed)
+        self.prefix = prefix
+        self.end_date = end_date or localtime(now()).date()
+        self.start_date = self.end_date - relativedelta(months=months)
+        self.users = []
+
+    def generate(self):
+        self.create_packages()
+        self.create_members()
+        self.create_organizations()
+        self.create_guests()
+        self.create_coworking_days()
+        self.create_events()
+        return self
+
+    def create_packages(self):
+        day = Resource.objects.day_resource
+        desk = Resource.objects.desk_resource
+        key = Resource.objects.key_resource
+        event = Resource.objects.event_resource
+        self.room = Room.objects.create(name="%s room" % self.prefix, floor=1, seats=8, max_capacity=10, default_rate=40)
+
+        self.packages = []
+        for name, defaults in [
+                ("PT5", [(day, 5, 75, 20)]),
+                ("PT10", [(day, 10, 180, 20), (event, 2, 0, 20)]),
+                ("Resident", [(desk, 1, 475, 0), (day, 5, 0, 20), (key, 1, 100, 0), (event, 4, 0, 20)]),
+            ]:
+            package = MembershipPackage.objects.create(name="%s %s" % (self.prefix, name))
+            for resource, allowance, monthly_rate, overage_rate in defaults:
+                SubscriptionDefault.objects.create(
+                    package = package,
+                    resource = resource,
+                    allowance = allowance,
+                    monthly_rate = monthly_rate,
+                    overage_rate = overage_rate,
+                )
+            self.packages.append(package)
+
+    def random_date(self, start_date, end_date):
+        days = (end_date - start_date).days
+        return start_date + timedelta(days=self.random.randint(0, max(days, 0)))
+
+    def create_members(self):
+        ''' Members join over the whole range and some of them leave. '''
+        for i in range(self.members):
+            user = User.objects.create(username="%s_member_%d" % (self.prefix, i), first_name="Member", last_name=str(i))
+            membership = Membership.objects.for_user(user)
+            membership.bill_day = self.random.randint(1, 28)
+            membership.save()
+            start_date = self.random_date(self.start_date, self.end_date)
+            end_date = None
+            if self.random.random() < 0.3:
+                end_date = self.random_date(start_date, self.end_date)
+            membership.set_to_package(self.random.choice(self.packages), start_date=start_date, end_date=end_date)
+            self.users.append(user)
+
+    def create_organizations(self):
+        ''' Organizations with a package of their own and a few members each.
+
+        Organization members do not get an individual package since billing
+        only looks at the first membership of each user.
+        '''
+        for i in range(self.organizations):
+            team = []
+            for j in range(3):
+                team.append(User.objects.create(username="%s_org_%d_%d" % (self.prefix, i, j), first_name="Team", last_name="%d %d" % (i, j)))
+            org = Organization.objects.create(name="%s org %d" % (self.prefix, i), created_by=team[0], lead=team[0])
+            for user in team:
+                org.add_member(user, start_date=self.start_date)
+            membership = OrganizationMembership.objects.create(organization=org, bill_day=self.random.randint(1, 28))
+            membership.set_to_package(self.random.choice(self.packages), start_date=self.random_date(self.start_date, self.end_date))
+            self.users.extend(team)
+
+    def create_guests(self):
+        ''' A few members have their subscriptions paid by another member. '''
+        subscriptions = ResourceSubscription.objects.filter(package_name__startswith=self.prefix, membership__individualmembership__isnull=False)
+        for membership_id in set(subscriptions.values_list('membership', flat=True)):
+            if self.random.random() < 0.1:
+                subscriptions.filter(membership=membership_id).update(paid_by=self.random.choice(self.users))
+
+    def create_coworking_days(self):
+        ''' Daily churn of members and drop ins. '''
+        days = []
+        target_date = self.start_date
+        while target_date <= self.end_date:
+            if target_date.weekday() < 5:
+                for user in self.random.sample(self.users, len(self.users) // 3):
+                    paid_by = None
+                    if self.random.random() < 0.05:
+                        paid_by = self.random.choice(self.users)
+                    payment = self.random.choice(["Bill", "Bill", "Bill", "Trial", "Waive"])
+                    days.append(CoworkingDay(user=user, visit_date=target_date, payment=payment, paid_by=paid_by))
+            target_date = target_date + timedelta(days=1)
+        CoworkingDay.objects.bulk_create(days, batch_size=500)
+
+    def create_events(self):
+        ''' A handful of room bookings every week. '''
+        events = []
+        target_date = self.start_date
+        while target_date <= self.end_date:
+            for user in self.random.sample(self.users, min(3, len(self.users))):
+                start_ts = make_aware(datetime.combine(target_date, dt_time(self.random.randint(8, 16))))
+                end_ts = start_ts + timedelta(minutes=15 * self.random.randint(2, 12))
+                events.append(Event(user=user, room=self.room, start_ts=start_ts, end_ts=end_ts))
+            target_date = target_date + timedelta(days=7)
+        Event.objects.bulk_create(events, batch_size=500)
+
+
+class BillingBenchmark(object):
+    ''' Time the expensive billing and stats operations and count their queries. '''
+
+    def __init__(self, dataset, bulk=False, recalculate=10):
+        self.dataset = dataset
+        self.bulk = bulk
+        self.recalculate = recalculate
+        self.results = []
+
+    def measure(self, name, func, *args, **kwargs):
+        with CaptureQueriesContext(connection) as queries:
+            start = time.perf_counter()
+            value = func(*args, **kwargs)
+            seconds = time.perf_counter() - start
+        result = BenchmarkResult(name, seconds, len(queries))
+        logger.info("%s: %.3fs, %d queries" % result)
+        self.results.append(result)
+        return value
+
+    def run(self):
+        from staff.views.stats import graph_members, graph_income
+        start_date = self.dataset.start_date
+        end_date = self.dataset.end_date
+
+        self.measure("BillingBatch.run", BillingBatch.objects.run, start_date=start_date, end_date=end_date, bulk=self.bulk)
+
+        # Recalculate the biggest open bills
+        bills = UserBill.objects.open().order_by('-cached_total_amount')[:self.recalculate]
+        self.measure("UserBill.recalculate (%d bills)" % len(bills), lambda: [b.recalculate() for b in bills])
+
+        self.measure("UserBill.objects.outstanding", lambda: [b.total for b in UserBill.objects.outstanding()])
+
+        # Each graph reads its own stats like the view does
+        days = [{'date': end_date - timedelta(days=i)} for i in range(30)]
+        stats = lambda: {d.day: d for d in DailyStats.objects.for_range(days[-1]['date'], end_date)}
+        self.measure("stats graph_members (30 days)", lambda: graph_members(days, stats()))
+        self.measure("stats graph_income (30 days)", lambda: graph_income(days, stats()))
+        return self.results
+
+
+# Copyright 2021 Office Nomads LLC (https://officenomads.com/) Licensed under the AGPL License, Version 3.0 (the "License"); you may not use this file except in compliance with the License. You may obtain a copy of the License at https://www.gnu.org/licenses/agpl-3.0.html. Unless required by applicable law or agreed to in writing, software distributed under the License is distributed on an "AS IS" BASIS, WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the License for the specific language governing permissions and limitations under the License.
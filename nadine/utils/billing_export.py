@@ -0,0 +1,203 @@
+import csv
+import zlib
+import logging
+import tempfile
+from collections import OrderedDict
+from datetime import datetime, time
+
+from django.conf import settings
+from django.db.models import Case, When, Value, CharField
+from django.utils.timezone import make_aware
+
+from nadine.models.billing import UserBill, BillLineItem, LineItemTax, Payment
+
+logger = logging.getLogger(__name__)
+
+
+# Rows pulled from the database cursor at a time
+EXPORT_CHUNK_SIZE = getattr(settings, 'BILLING_EXPORT_CHUNK_SIZE', 2000)
+
+# Each export is a column name -> field lookup on its model
+EXPORT_COLUMNS = OrderedDict([
+    ('bills', OrderedDict([
+        ('id', 'id'),
+        ('username', 'user__username'),
+        ('created', 'created_ts'),
+        ('period_start', 'period_start'),
+        ('period_end', 'period_end'),
+        ('due_date', 'due_date'),
+        ('closed', 'closed_ts'),
+        ('mark_paid', 'mark_paid'),
+        ('amount', 'cached_total_amount'),
+        ('tax_amount', 'cached_total_tax_amount'),
+        ('paid', 'cached_total_paid'),
+        ('owed', 'cached_total_owed'),
+        ('note', 'note'),
+    ])),
+    ('line_items', OrderedDict([
+        ('id', 'id'),
+        ('bill_id', 'bill_id'),
+        ('username', 'bill__user__username'),
+        ('period_start', 'bill__period_start'),
+        ('type', 'line_item_type'),
+        ('description', 'description'),
+        ('amount', 'amount'),
+        ('custom', 'custom'),
+        ('subscription_id', 'subscriptionlineitem__subscription_id'),
+        ('resource', 'subscriptionlineitem__subscription__resource__name'),
+        ('visit_date', 'coworkingdaylineitem__day__visit_date'),
+        ('event_id', 'eventlineitem__event_id'),
+    ])),
+    ('taxes', OrderedDict([
+        ('id', 'id'),
+        ('line_item_id', 'line_item_id'),
+        ('bill_id', 'line_item__bill_id'),
+        ('username', 'line_item__bill__user__username'),
+        ('period_start', 'line_item__bill__period_start'),
+        ('tax_rate', 'tax_rate__name'),
+        ('percentage', 'tax_rate__percentage'),
+        ('amount', 'amount'),
+    ])),
+    ('payments', OrderedDict([
+        ('id', 'id'),
+        ('bill_id', 'bill_id'),
+        ('username', 'user__username'),
+        ('created', 'created_ts'),
+        ('amount', 'amount'),
+        ('method', 'method__name'),
+        ('external_id', 'external_id'),
+        ('note', 'note'),
+    ])),
+])
+
+
+def export_query(export, start_date, end_date):
+    ''' The rows for an export over a date range.
+    Bills, line items and taxes go by the bill period start and payments by when they were made. '''
+    if export == 'bills':
+        return UserBill.objects.filter(period_start__range=(start_date, end_date))
+    if export == 'line_items':
+        line_item_type = Case(
+            When(subscriptionlineitem__isnull=False, then=Value('subscription')),
+            When(coworkingdaylineitem__isnull=False, then=Value('coworking_day')),
+            When(eventlineitem__isnull=False, then=Value('event')),
+            default=Value('other'),
+            output_field=CharField(),
+        )
+        return BillLineItem.objects.filter(bill__period_start__range=(start_date, end_date)).annotate(line_item_type=line_item_type)
+    if export == 'taxes':
+        return LineItemTax.objects.filter(line_item__bill__period_start__range=(start_date, end_date))
+    if export == 'payments':
+        start_ts = make_aware(datetime.combine(start_date, time.min))
+        end_ts = make_aware(datetime.combine(end_date, time.max))
+        return Payment.objects.filter(created_ts__range=(start_ts, end_ts))
+    raise Exception("Unknown export '%s'" % export)
+
+
+def export_columns(export, columns=None):
+    ''' Check the requested columns against an export, defaulting to all of them. '''
+    if export not in EXPORT_COLUMNS:
+        raise Exception("Unknown export '%s'" % export)
+    available = EXPORT_COLUMNS[export]
+    if not columns:
+        return list(available.keys())
+    unknown = [c for c in columns if c not in available]
+    if unknown:
+        raise Exception("Unknown columns for %s: %s" % (export, ", ".join(unknown)))
+    return list(columns)
+
+
+def export_rows(export, start_date, end_date, columns=None):
+    ''' Generate the header and then every row of an export.
+
+    Rows come off the database in chunks as tuples so memory use does not
+    grow with the size of the export.
+    '''
+    columns = export_columns(export, columns)
+    fields = [EXPORT_COLUMNS[export][c] for c in columns]
+    query = export_query(export, start_date, end_date).order_by('id').values_list(*fields)
+    yield columns
+    for row in query.iterator(chunk_size=EXPORT_CHUNK_SIZE):
+        yield row
+
+
+class Echo(object):
+    ''' File-like object that hands back what is written so csv.writer can feed a generator. '''
+
+    def write(self, value):
+        return value
+
+
+def stream_csv(rows):
+    writer = csv.writer(Echo())
+    for row in rows:
+        yield writer.writerow(row).encode('utf-8')
+
+
+def stream_xlsx(rows):
+    ''' Write the rows to an XLSX workbook and stream it back.
+    Requires openpyxl which is imported here so it stays optional. '''
+    from openpyxl import Workbook
+    workbook = Workbook(write_only=True)
+    sheet = workbook.create_sheet()
+    for row in rows:
+        sheet.append([make_naive_for_excel(v) for v in row])
+    with tempfile.TemporaryFile() as f:
+        workbook.save(f)
+        f.seek(0)
+        chunk = f.read(64 * 1024)
+        while chunk:
+            yield chunk
+            chunk = f.read(64 * 1024)
+
+
+def has_openpyxl():
+    try:
+        import openpyxl
+        return True
+    except ImportError:
+        return False
+
+
+def make_naive_for_excel(value):
+    # Excel has no idea about time zones
+    if isinstance(value, datetime) and value.tzinfo is not None:
+        return value.replace(tzinfo=None)
+    return value
+
+
+def gzip_stream(chunks):
+    compressor = zlib.compressobj(9, zlib.DEFLATED, zlib.MAX_WBITS | 16)
+    for chunk in chunks:
+        data = compressor.compress(chunk)
+        if data:
+            yield data
+    yield compressor.flush()
+
+
+def export_stream(export, start_date, end_date, columns=None, format="csv", gzip=False):
+    ''' Generate the bytes of an export in the given format, optionally gzipped.
+    Everything is validated up front so problems are raised before anything is sent. '''
+    columns = export_columns(export, columns)
+    rows = export_rows(export, start_date, end_date, columns)
+    if format == "csv":
+        stream = stream_csv(rows)
+    elif format == "xlsx":
+        if not has_openpyxl():
+            raise Exception("XLSX export requires the openpyxl package")
+        stream = stream_xlsx(rows)
+    else:
+        raise Exception("Unknown format '%s'" % format)
+    if gzip:
+        stream = gzip_stream(stream)
+    return stream
+
+
+def export_filename(export, start_date, end_date, format="csv", gzip=False):
+    filename = "%s_%s_%s.%s" % (export, start_date.isoformat(), end_date.isoformat(), format)
+    if gzip:
+        filename += ".gz"
+    return filename
+
+
+# Copyright 2021 Office Nomads LLC (https://officenomads.com/) Licensed under the AGPL License, Version 3.0 (the "License"); you may not use this file except in compliance with the License. You may obtain a copy of the License at https://www.gnu.org/licenses/agpl-3.0.html. Unless required by applicable law or agreed to in writing, software distributed under the License is distributed on an "AS IS" BASIS, WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the License for the specific language governing permissions and limitations under the License.
@@ -1,25 +1,71 @@
+import os
 import sys
 import csv
 import base64
 import random
 import hashlib
 import logging
+import tempfile
+import threading
+from concurrent.futures import ThreadPoolExecutor, as_completed, TimeoutError
 from datetime import datetime, timedelta
 from collections import OrderedDict
 
 from django.conf import settings
 
 from suds.client import Client
+from suds.cache import ObjectCache
 
+logger = logging.getLogger(__name__)
+
+
+# Parsed WSDL clients for each thread since suds clients are not thread safe
+_soap_clients = threading.local()
+
+# Worker threads for bulk calls, kept around so they hold on to their clients
+_executor = None
+_executor_lock = threading.Lock()
+
+
+def get_soap_client(url):
+    ''' A suds Client for the given WSDL.
+
+    Each thread parses the WSDL once and keeps the client for as long as the
+    thread lives. The parsed WSDL is also cached on disk so new threads and
+    processes do not have to download it again.
+    '''
+    clients = getattr(_soap_clients, 'clients', None)
+    if clients is None:
+        clients = _soap_clients.clients = {}
+    if url not in clients:
+        location = getattr(settings, 'USA_EPAY_WSDL_CACHE_DIR', os.path.join(tempfile.gettempdir(), 'nadine-usaepay-wsdl'))
+        cache = ObjectCache(location=location, days=getattr(settings, 'USA_EPAY_WSDL_CACHE_DAYS', 7))
+        clients[url] = Client(url, cache=cache, timeout=getattr(settings, 'USA_EPAY_TIMEOUT', 30))
+    return clients[url]
+
+
+def get_executor():
+    global _executor
+    with _executor_lock:
+        if _executor is None:
+            _executor = ThreadPoolExecutor(max_workers=getattr(settings, 'USA_EPAY_MAX_WORKERS', 8), thread_name_prefix="usaepay")
+    return _executor
 
 class PaymentAPI(object):
 
-    def __init__(self, v=4):
+    def __init__(self, v=4, entry_point=None):
+        if entry_point is not None:
+            # Already connected
+            self.enabled = True
+            self.entry_point = entry_point
+            return None
+
         if not hasattr(settings, 'USA_EPAY_SOAP_KEY'):
             self.enabled = False
             return None
 
         self.enabled = True
+        self.version = v
         if v == 2:
             self.url = settings.USA_EPAY_SOAP_1_2
         elif v == 3:
@@ -33,6 +79,49 @@ class PaymentAPI(object):
     def switch_api_ver(self, version):
         self.__init__(v=version)
 
+    def worker_copy(self):
+        ''' An API with its own connection for use in another thread. '''
+        if not hasattr(self, 'version'):
+            # Handed an entry point to use so share it
+            return self
+        return PaymentAPI(v=self.version)
+
+    def map_users(self, method, usernames):
+        ''' Call the given method for each username on a bounded pool of threads.
+        Returns {username: result} where the result is the exception raised for any that failed or timed out. '''
+        usernames = list(usernames)
+        results = {}
+        if not usernames:
+            return results
+        timeout = getattr(settings, 'USA_EPAY_BULK_TIMEOUT', 60)
+
+        def run(username):
+            return getattr(self.worker_copy(), method)(username)
+
+        futures = {get_executor().submit(run, u): u for u in usernames}
+        try:
+            for future in as_completed(futures, timeout=timeout):
+                username = futures[future]
+                try:
+                    results[username] = future.result()
+                except Exception as e:
+                    logger.warning("%s(%s) failed: %s" % (method, username, e))
+                    results[username] = e
+        except TimeoutError:
+            for future, username in futures.items():
+                if username not in results:
+                    future.cancel()
+                    results[username] = TimeoutError("%s(%s) timed out" % (method, username))
+        return results
+
+    def get_customers_for(self, usernames):
+        ''' Look up the customers for many users at once: {username: customers} '''
+        return self.map_users('get_customers', usernames)
+
+    def disable_recurring_for(self, usernames):
+        ''' Turn off automatic billing for many users at once. '''
+        return self.map_users('disable_recurring', usernames)
+
     def get_customers(self, username):
         customers = self.entry_point.getAllCustomers(username)
         if not customers:
@@ -212,11 +301,10 @@ class SearchParamArray(object):
 class USAEPAY_SOAP_API(object):
 
     def __init__(self, url, key, pin):
-        self.client = Client(url)
+        self.client = get_soap_client(url)
 
         # Hash our pin
-        random.seed(datetime.now())
-        salt = random.randint(0, sys.maxsize)
+        salt = random.SystemRandom().randint(0, sys.maxsize)
         salted_value = "%s%s%s" % (key, salt, pin)
         pin_hash = hashlib.sha1(salted_value.encode('utf-8'))
 
@@ -1,7 +1,10 @@
+import logging
+from time import sleep
 from datetime import datetime
 
 from xero import Xero
 from xero.auth import PrivateCredentials
+from xero.exceptions import XeroRateLimitExceeded, XeroNotAvailable
 
 from django.conf import settings
 from django.utils import timezone
@@ -13,6 +16,11 @@ from xml.dom.minidom import parse, parseString
 
 from nadine.models.profile import XeroContact
 
+logger = logging.getLogger(__name__)
+
+# Xero hands back 100 records a page
+XERO_PAGE_SIZE = 100
+
 
 def test_xero_connection():
     api = XeroAPI()
@@ -28,7 +36,15 @@ def test_xero_connection():
 
 class XeroAPI:
 
-    def __init__(self):
+    def __init__(self, xero=None):
+        self.batch_size = getattr(settings, 'XERO_BATCH_SIZE', 50)
+        self.max_retries = getattr(settings, 'XERO_MAX_RETRIES', 5)
+        self.retry_delay = getattr(settings, 'XERO_RETRY_DELAY', 2)
+        if xero is not None:
+            # Already connected
+            self.xero = xero
+            return
+
         self.deposit_account = getattr(settings, 'XERO_DEPOSIT_ACCOUNT', None)
         if self.deposit_account is None:
             raise ImproperlyConfigured("Please set your XERO_DEPOSIT_ACCOUNT setting.")
@@ -143,6 +159,50 @@ class XeroAPI:
                 invoices[username] = [i]
         return invoices
 
+    def call(self, method, *args, **kwargs):
+        ''' Call the Xero API, backing off and trying again when we hit the rate limit. '''
+        attempt = 0
+        while True:
+            try:
+                return method(*args, **kwargs)
+            except (XeroRateLimitExceeded, XeroNotAvailable) as e:
+                attempt += 1
+                if attempt > self.max_retries:
+                    raise
+                delay = self.retry_delay * (2 ** (attempt - 1))
+                headers = getattr(e.response, 'headers', None) or {}
+                if 'Retry-After' in headers:
+                    delay = int(headers['Retry-After'])
+                logger.warning("Xero unavailable, retrying in %ds (%d/%d)" % (delay, attempt, self.max_retries))
+                sleep(delay)
+
+    def get_pages(self, manager, since=None, **kwargs):
+        ''' Generate every record changed since the given time one page at a time. '''
+        if since:
+            kwargs['since'] = since
+        page = 1
+        while True:
+            records = self.call(manager.filter, page=page, **kwargs)
+            for r in records:
+                yield r
+            if len(records) < XERO_PAGE_SIZE:
+                break
+            page += 1
+
+    def get_changed_contacts(self, since=None):
+        return self.get_pages(self.xero.contacts, since)
+
+    def get_changed_invoices(self, since=None):
+        return self.get_pages(self.xero.invoices, since, Type="ACCREC")
+
+    def put_invoices(self, invoices):
+        ''' Create the given invoices in batches and generate what Xero hands back for each in the same order.
+        The next batch is not sent until everything from the last one has been consumed. '''
+        for i in range(0, len(invoices), self.batch_size):
+            batch = invoices[i:i + self.batch_size]
+            for r in self.call(self.xero.invoices.put, batch, summarize_errors=False):
+                yield r
+
     def get_repeating_invoices(self, user):
         xero_data = None
         xero_contact = XeroContact.objects.filter(user=user).first()
@@ -13,18 +13,21 @@ urlpatterns = [
     path('bills/outstanding/', billing.outstanding, name='outstanding'),
     path('bills/<username>/', billing.user_bills, name='user_bills'),
     path('batch_logs/', billing.batch_logs, name='batch_logs'),
+    path('export/', billing.export_billing, name='export'),
 
     # Actions
     path('bill_paid/<int:bill_id>/', billing.action_bill_paid, name='bill_paid'),
     path('billing_flag/<username>/', billing.action_billing_flag, name='billing_flag'),
     path('bill_delay/<bill_id>/', billing.action_bill_delay, name='bill_delay'),
     path('record_payment/', billing.action_record_payment, name='record_payment'),
+    path('record_payments/', billing.action_record_payments, name='record_payments'),
 
     # Integerations
     path('usaepay/m/', payment.usaepay_members, name='payments_members'),
     path('usaepay/void/', payment.usaepay_void, name='payment_void'),
     path('usaepay/<username>/', payment.usaepay_user, name='user_payment'),
     path('charges/<int:year>/<int:month>/<int:day>/', payment.usaepay_transactions, name='charges'),
+    path('charges/<int:year>/<int:month>/<int:day>/reconcile/', payment.usaepay_reconcile, name='reconcile'),
     path('charges/today/', payment.usaepay_transactions_today, name='charges_today'),
     path('xero/<username>/', payment.xero_user, name='xero'),
 ]
@@ -16,6 +16,7 @@ from doors.keymaster.models import DoorEvent
 from arpwatch.models import ArpLog
 from nadine.forms import CoworkingDayForm, DateRangeForm
 from nadine.models import CoworkingDay, Membership, ResourceSubscription
+from nadine.models.stats import DailyStats
 
 
 @staff_member_required
@@ -24,12 +25,12 @@ def graph(request):
     start_date, end_date = date_range_form.get_dates()
     days = [{'date': start_date + timedelta(days=i)} for i in range((end_date - start_date).days)]
     days.reverse()
+    stats = {d.day: d for d in DailyStats.objects.for_range(start_date, end_date)}
     for day in days:
-        memberships = Membership.objects.active_memberships(day['date'])
-        day['daily_logs'] = CoworkingDay.objects.filter(visit_date=day['date']).count()
-        day['has_desk'] = ResourceSubscription.objects.active_subscriptions(target_date=day['date']).filter(resource=3).count()
+        day['daily_logs'] = stats[day['date']].coworking_days
+        day['has_desk'] = stats[day['date']].desks
         day['occupancy'] = day['daily_logs'] + day['has_desk']
-        day['membership'] = memberships.count()
+        day['membership'] = stats[day['date']].memberships
 
     max_membership = 0
     max_has_desk = 0
@@ -8,13 +8,15 @@ from django.shortcuts import render, get_object_or_404
 from django.contrib.auth.decorators import login_required
 from django.contrib.admin.views.decorators import staff_member_required
 from django.template import RequestContext
-from django.http import HttpResponse, HttpResponseRedirect, Http404
+from django.http import HttpResponse, HttpResponseRedirect, HttpResponseBadRequest, Http404, JsonResponse, StreamingHttpResponse
 from django.urls import reverse
 from django.contrib import messages
 from django.db.models import Q, Sum
 from django.conf import settings
 
 from nadine.models import *
+from nadine.models.billing import BillingEvent, billing_journal, read_payment_rows
+from nadine.utils.billing_export import export_stream, export_filename
 from nadine import email
 from nadine.forms import PaymentForm, DateRangeForm
 
@@ -49,7 +51,7 @@ def batch_logs(request):
 def bill_list(request):
     date_range_form = DateRangeForm.from_request(request, days=7)
     start_date, end_date = date_range_form.get_dates()
-    bills = UserBill.objects.filter(period_start__range=(start_date, end_date)).order_by('period_start').reverse()
+    bills = UserBill.objects.with_details().filter(period_start__range=(start_date, end_date)).order_by('period_start').reverse()
     context = {
         'bills': bills,
         'date_range_form': date_range_form,
@@ -61,56 +63,20 @@ def bill_list(request):
 
 @staff_member_required
 def outstanding(request):
-    closed_bills = UserBill.objects.outstanding().filter(closed_ts__isnull=False, in_progress=False).order_by('due_date')
-    open_bills = UserBill.objects.outstanding().filter(closed_ts__isnull=True, in_progress=False).order_by('due_date')
-    in_progress = UserBill.objects.outstanding().filter(in_progress=True).order_by('due_date')
-    if closed_bills:
-        closed_bills_total = closed_bills.aggregate(total=Sum('bill_total'))['total']
-    else:
-        closed_bills_total = 0
-
-    if open_bills:
-        open_bills_total = open_bills.aggregate(total=Sum('bill_total'))['total']
-    else:
-        open_bills_total = 0
-
-    if in_progress:
-        in_progress_total = in_progress.aggregate(total=Sum('bill_total'))['total']
-    else:
-        in_progress_total = 0
-
-    subscriptions_due = []
-    subscriptions_due_total = 0
-    dropins = []
-    dropin_total = 0
-    other_bills = []
-    other_bills_totals = 0
-    for bill in open_bills:
-        if bill.subscriptions_due:
-            subscriptions_due.append(bill)
-            subscriptions_due_total += bill.total
-        elif bill.subscriptions().count() == 0:
-            dropins.append(bill)
-            dropin_total += bill.total
-        else:
-            other_bills.append(bill)
-            other_bills_totals += bill.total
-
-    bill_count = closed_bills.count() + open_bills.count() + in_progress.count()
-    bill_total = closed_bills_total + open_bills_total + in_progress_total
+    report = UserBill.objects.outstanding_report()
     context = {
-        'closed_bills': closed_bills,
-        'subscriptions_due': subscriptions_due,
-        'in_progress': in_progress,
-        'dropins': dropins,
-        'other_bills': other_bills,
-        'dropin_total': dropin_total,
-        'closed_bills_total': closed_bills_total,
-        'subscriptions_due_total': subscriptions_due_total,
-        'in_progress_total': in_progress_total,
-        'other_bills_totals': other_bills_totals,
-        'bill_count': bill_count,
-        'bill_total': bill_total,
+        'closed_bills': report['closed']['bills'],
+        'subscriptions_due': report['subscriptions']['bills'],
+        'in_progress': report['in_progress']['bills'],
+        'dropins': report['dropin']['bills'],
+        'other_bills': report['other']['bills'],
+        'dropin_total': report['dropin']['total'],
+        'closed_bills_total': report['closed']['total'],
+        'subscriptions_due_total': report['subscriptions']['total'],
+        'in_progress_total': report['in_progress']['total'],
+        'other_bills_totals': report['other']['total'],
+        'bill_count': report['bill_count'],
+        'bill_total': report['bill_total'],
     }
     return render(request, 'staff/billing/outstanding.html', context)
 
@@ -122,7 +88,8 @@ def action_bill_paid(request, bill_id):
     amount = bill.total
     if 'amount' in request.POST:
         amount = float(request.POST['amount'])
-    payment = Payment.objects.create(bill=bill, user=bill.user, amount=amount, created_by=request.user)
+    with billing_journal(source=BillingEvent.SOURCE_STAFF, created_by=request.user):
+        payment = Payment.objects.create(bill=bill, user=bill.user, amount=amount, created_by=request.user)
     if 'payment_date' in request.POST:
         payment.created_ts = datetime.strptime(request.POST['payment_date'], "%Y-%m-%d").date()
         payment.save()
@@ -181,7 +148,8 @@ def action_record_payment(request):
         try:
 
             if payment_form.is_valid():
-                payment = payment_form.save(created_by=request.user.username)
+                with billing_journal(source=BillingEvent.SOURCE_STAFF, created_by=request.user):
+                    payment = payment_form.save(created_by=request.user.username)
                 messages.success(request, "Payment of $%s recorded." % payment.amount)
         except Exception as e:
             messages.error(request, str(e))
@@ -194,6 +162,63 @@ def action_record_payment(request):
     return HttpResponseRedirect(reverse('staff:billing:bills'))
 
 
+@staff_member_required
+def action_record_payments(request):
+    ''' Record a batch of payments from an uploaded CSV/JSON file or a JSON body and report on each row. '''
+    if request.method != 'POST':
+        raise Exception("Must be a POST!")
+    try:
+        if 'payments' in request.FILES:
+            upload = request.FILES['payments']
+            file_format = "json" if upload.name.lower().endswith(".json") else "csv"
+            rows = read_payment_rows(upload.read().decode('utf-8'), request.POST.get('format', file_format))
+        elif request.content_type == 'application/json':
+            rows = read_payment_rows(request.body.decode('utf-8'), "json")
+        else:
+            rows = read_payment_rows(request.POST.get('payments', ''), request.POST.get('format', 'csv'))
+    except Exception as e:
+        return JsonResponse({'error': str(e)}, status=400)
+
+    results = Payment.objects.record_payments(rows, created_by=request.user)
+    report = []
+    for result in results:
+        row = {'row': result['row'], 'bill': result['bill'], 'amount': result['amount'], 'external_id': result['external_id']}
+        if 'error' in result:
+            row['error'] = result['error']
+        else:
+            row['payment_id'] = result['payment'].id
+        report.append(row)
+    errors = len([r for r in report if 'error' in r])
+    return JsonResponse({'recorded': len(report) - errors, 'errors': errors, 'results': report})
+
+
+@staff_member_required
+def export_billing(request):
+    ''' Stream bills, line items, taxes or payments for a date range as CSV or XLSX. '''
+    date_range_form = DateRangeForm.from_request(request, days=31)
+    start_date, end_date = date_range_form.get_dates()
+    if not start_date:
+        return HttpResponseBadRequest("Invalid date range")
+    export = request.GET.get('export', 'bills')
+    file_format = request.GET.get('format', 'csv')
+    gzip = request.GET.get('gzip', '') in ('1', 'true', 'yes')
+    columns = [c for c in request.GET.get('columns', '').split(',') if c]
+    try:
+        stream = export_stream(export, start_date, end_date, columns=columns, format=file_format, gzip=gzip)
+    except Exception as e:
+        return HttpResponseBadRequest(str(e))
+
+    if file_format == 'xlsx':
+        content_type = 'application/vnd.openxmlformats-officedocument.spreadsheetml.sheet'
+    else:
+        content_type = 'text/csv'
+    if gzip:
+        content_type = 'application/gzip'
+    response = StreamingHttpResponse(stream, content_type=content_type)
+    response['Content-Disposition'] = 'attachment; filename="%s"' % export_filename(export, start_date, end_date, file_format, gzip)
+    return response
+
+
 @staff_member_required
 def bill_view_redirect(request):
     if "bill_id" in request.POST:
@@ -207,30 +232,31 @@ def bill_view(request, bill_id):
     bill = get_object_or_404(UserBill, id=bill_id)
 
     if request.method == 'POST':
-        if 'delete_payment_id' in request.POST:
-            try:
-                payment_id = request.POST.get('delete_payment_id')
-                payment = Payment.objects.get(id=payment_id)
-                payment.delete()
-                messages.success(request, "Payment deleted.")
-            except Exception as e:
-                messages.error(request, str(e))
-        if 'mark_paid' in request.POST:
-            bill.mark_paid = True
-            bill.save()
-            messages.success(request, "Bill marked as paid.")
-        if 'close_bill' in request.POST:
-            bill.close()
-            messages.success(request, "Bill marked as closed.")
-        if 'waive_day' in request.POST:
-            day_id = request.POST.get('waive_day')
-            day = CoworkingDay.objects.get(pk=day_id)
-            day.mark_waived()
-            bill.recalculate()
-            messages.success(request, "Activity on %s waived and bill recalculated." % day.visit_date)
-        if 'recalculate' in request.POST:
-            bill.recalculate()
-            messages.success(request, "Bill recalculated.")
+        with billing_journal(source=BillingEvent.SOURCE_STAFF, created_by=request.user):
+            if 'delete_payment_id' in request.POST:
+                try:
+                    payment_id = request.POST.get('delete_payment_id')
+                    payment = Payment.objects.get(id=payment_id)
+                    payment.delete()
+                    messages.success(request, "Payment deleted.")
+                except Exception as e:
+                    messages.error(request, str(e))
+            if 'mark_paid' in request.POST:
+                bill.mark_paid = True
+                bill.save()
+                messages.success(request, "Bill marked as paid.")
+            if 'close_bill' in request.POST:
+                bill.close()
+                messages.success(request, "Bill marked as closed.")
+            if 'waive_day' in request.POST:
+                day_id = request.POST.get('waive_day')
+                day = CoworkingDay.objects.get(pk=day_id)
+                day.mark_waived()
+                bill.recalculate()
+                messages.success(request, "Activity on %s waived and bill recalculated." % day.visit_date)
+            if 'recalculate' in request.POST:
+                bill.recalculate()
+                messages.success(request, "Bill recalculated.")
 
     initial_data = {
         'bill_id': bill.id,
@@ -269,13 +295,14 @@ def bill_view(request, bill_id):
         'resources': resources,
         'overdue': overdue,
         'payment_form': payment_form,
+        'billing_events': BillingEvent.objects.for_bill(bill).select_related('created_by'),
     }
     return render(request, 'staff/billing/bill_view.html', context)
 
 @staff_member_required
 def user_bills(request, username):
     user = get_object_or_404(User, username=username)
-    bills = user.bills.all().order_by('-due_date')
+    bills = UserBill.objects.with_details().filter(user=user).order_by('-due_date')
     return render(request, 'staff/billing/user_bills.html', {'user':user, 'bills':bills})
 
 
@@ -6,12 +6,12 @@ from django.shortcuts import render, get_object_or_404
 from django.contrib.auth.decorators import login_required
 from django.contrib.admin.views.decorators import staff_member_required
 from django.template import RequestContext
-from django.http import HttpResponse, HttpResponseRedirect
+from django.http import HttpResponse, HttpResponseRedirect, JsonResponse
 from django.urls import reverse
 from django.contrib import messages
 from django.conf import settings
 
-from nadine.models import XeroContact
+from nadine.models import XeroContact, XeroInvoice, USAePayTransaction, USAePayCustomer
 
 from nadine.utils.xero_api import XeroAPI
 from nadine.utils.payment_api import PaymentAPI
@@ -44,8 +44,7 @@ def xero_user(request, username):
     if not xero_contact:
         xero_contact_search = xero_api.find_contacts(user)
     else:
-        invoices = xero_api.get_invoices(user)
-        invoices.reverse()
+        invoices = XeroInvoice.objects.filter(user=user).order_by('-date')
         repeating_invoices = xero_api.get_repeating_invoices(user)
         xero_contact_data = xero_api.get_contact(user)
 
@@ -127,77 +126,51 @@ def usaepay_transactions_today(request):
     return HttpResponseRedirect(reverse('staff:billing:charges', args=[], kwargs={'year': today.year, 'month': today.month, 'day': today.day}))
 
 
-def add_bills_and_invoices(transactions, open_xero_invoices):
-    for t in transactions:
-        # Pull the member and the amount they owe
-        u = User.objects.filter(username = t['username']).first()
-        if u:
-            t['user'] = u
-            t['outstanding_bills'] = u.profile.outstanding_bills()
-            t['bill_count'] = len(t['outstanding_bills'])
-            # If the amount matches and there is only one, mark this bill as a match
-            if len(t['outstanding_bills']) == 1 and t['amount'] == t['outstanding_bills'][0].amount:
-                t['bill_match'] = t['outstanding_bills'][0]
-            # Sort through our xero invoices and only show the ones that match this total
-            t['xero_invoices'] = open_xero_invoices.get(t['username'], [])
-            for i in t['xero_invoices']:
-                if i['AmountDue'] != t['amount']:
-                    t['xero_invoices'].remove(i)
-
 @staff_member_required
 def usaepay_transactions(request, year, month, day):
     d = date(year=int(year), month=int(month), day=int(day))
     open_batch = False
     ach = []
     credit_cards = []
-    settled_checks = []
     other_transactions = []
     totals = {'cc_total':0, 'ach_total':0, 'settled_checks':0, 'total':0}
 
-    open_xero_invoices = {}
+    # Transactions are read from our copy which is synced when it could be out of date
     try:
-        open_xero_invoices = XeroAPI().get_open_invoices_by_user()
-    except Exception:
-        # Xero not integrated
-        pass
-
-    try:
-        api = PaymentAPI()
-
         if 'close_batch' in request.GET:
+            api = PaymentAPI()
             api.close_current_batch()
             messages.add_message(request, messages.INFO, "Current batch closed")
-
-        # Pull the settled checks seperately
-        settled_checks = api.get_checks_settled_by_date(year, month, day)
-        add_bills_and_invoices(settled_checks, open_xero_invoices)
-        for t in settled_checks:
-            totals['settled_checks'] = totals['settled_checks'] + t['amount']
-
-        # Pull the transactions and suplement the information
-        transactions = api.get_transactions(year, month, day)
-        add_bills_and_invoices(transactions, open_xero_invoices)
-
-        # Total up all the Settled transactions
-        totals['total_count'] = len(transactions) + len(settled_checks)
-        for t in transactions:
-            if t['transaction_type'] == "Sale" and t['status'] != "Declined" and t['status'] != "Error":
-                totals['total'] = totals['total'] + t['amount']
-                if t['card_type'] == "ACH":
-                    ach.append(t)
-                    totals['ach_total'] = totals['ach_total'] + t['amount']
-                else:
-                    credit_cards.append(t)
-                    totals['cc_total'] = totals['cc_total'] + t['amount']
-
-                # Presence of authorized transactions means this batch is still open
-                if t['status'] == "Authorized":
-                    open_batch = True
-            else:
-                other_transactions.append(t)
+            USAePayTransaction.objects.sync_day(d, api)
+        elif 'refresh' in request.GET or USAePayTransaction.objects.needs_sync(d):
+            USAePayTransaction.objects.sync_day(d)
     except Exception as e:
         messages.add_message(request, messages.ERROR, e)
 
+    transactions = list(USAePayTransaction.objects.for_day(d))
+    settled_checks = list(USAePayTransaction.objects.settled_on(d))
+    USAePayTransaction.objects.reconcile(transactions + settled_checks)
+    for t in settled_checks:
+        totals['settled_checks'] = totals['settled_checks'] + t.amount
+
+    # Total up all the Settled transactions
+    totals['total_count'] = len(transactions) + len(settled_checks)
+    for t in transactions:
+        if t.transaction_type == "Sale" and t.status != "Declined" and t.status != "Error":
+            totals['total'] = totals['total'] + t.amount
+            if t.card_type == "ACH":
+                ach.append(t)
+                totals['ach_total'] = totals['ach_total'] + t.amount
+            else:
+                credit_cards.append(t)
+                totals['cc_total'] = totals['cc_total'] + t.amount
+
+            # Presence of authorized transactions means this batch is still open
+            if t.status == "Authorized":
+                open_batch = True
+        else:
+            other_transactions.append(t)
+
     context = {
         'date': d,
         'ach':ach,
@@ -212,18 +185,51 @@ def usaepay_transactions(request, year, month, day):
     return render(request, 'staff/billing/charges.html', context)
 
 
+@staff_member_required
+def usaepay_reconcile(request, year, month, day):
+    ''' The transactions for a day matched up with outstanding bills and Xero invoices as JSON. '''
+    d = date(year=int(year), month=int(month), day=int(day))
+    if 'refresh' in request.GET:
+        try:
+            USAePayTransaction.objects.sync_day(d)
+        except Exception as e:
+            return JsonResponse({'error': str(e)}, status=502)
+
+    transactions = list(USAePayTransaction.objects.for_day(d))
+    settled_checks = list(USAePayTransaction.objects.settled_on(d))
+    USAePayTransaction.objects.reconcile(transactions + settled_checks)
+
+    def as_json(t):
+        return {
+            'transaction_id': t.transaction_id,
+            'username': t.username,
+            'date_time': t.date_time,
+            'transaction_type': t.transaction_type,
+            'card_type': t.card_type,
+            'status': t.status,
+            'amount': t.amount,
+            'outstanding_bills': [b.id for b in t.outstanding_bills],
+            'bill_match': t.bill_match.id if t.bill_match else None,
+            'xero_invoices': [i.invoice_number for i in t.xero_invoices],
+        }
+    return JsonResponse({
+        'date': d,
+        'transactions': [as_json(t) for t in transactions],
+        'settled_checks': [as_json(t) for t in settled_checks],
+    })
+
+
 @staff_member_required
 def usaepay_members(request):
-    members = []
-    api = PaymentAPI()
-    for u in User.helper.active_members():
-        username = u.username
-        customers = api.get_customers(username)
-        if customers:
-            for c in customers:
-                if c.Enabled:
-                    members.append({'user': u, 'username': username, 'next': c.Next, 'customer_number': c.CustNum})
-    return render(request, 'staff/billing/usaepay_members.html', {'members': members})
+    error = None
+    if 'refresh' in request.GET:
+        try:
+            USAePayCustomer.objects.sync()
+        except Exception as e:
+            error = str(e)
+    active_members = User.helper.active_members()
+    members = USAePayCustomer.objects.filter(enabled=True, user__in=active_members).order_by('username')
+    return render(request, 'staff/billing/usaepay_members.html', {'members': members, 'error': error})
 
 
 @staff_member_required
@@ -238,6 +244,7 @@ def usaepay_void(request):
             if 'username' in request.POST and 'confirmed' in request.POST:
                 username = request.POST.get('username')
                 api.void_transaction(username, transaction_id)
+                USAePayTransaction.objects.update_from_gateway(api.get_transaction(transaction_id))
                 messages.add_message(request, messages.INFO, "Transaction for %s voided" % username)
                 return HttpResponseRedirect(reverse('staff:billing:charges_today'))
     except Exception as e:
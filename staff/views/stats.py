@@ -16,6 +16,7 @@ from django.utils.timezone import localtime, now
 
 from nadine.models.core import Neighborhood
 from nadine.models.membership import Membership, MembershipPackage, ResourceSubscription
+from nadine.models.stats import DailyStats
 from nadine.models.usage import CoworkingDay
 from nadine.forms import DateRangeForm
 
@@ -58,20 +59,17 @@ class MonthHistory:
         self.data = {}  # str:str key:values for the month
 
 
-def calculate_dropins(start_date, end_date):
-    all_logs = CoworkingDay.objects.filter(visit_date__gte=start_date, visit_date__lte=end_date)
-    return (all_logs.filter(payment='Visit').distinct().count(), all_logs.filter(payment='Trial').distinct().count(), all_logs.filter(payment='Waive').distinct().count(), all_logs.filter(payment='Bill').distinct().count())
+def calculate_dropins(stats):
+    """returns a tuple of (visits, trial, waive, billed) coworking days for the given DailyStats"""
+    return (sum(d.visits for d in stats), sum(d.trial_days for d in stats), sum(d.waived_days for d in stats), sum(d.billed_days for d in stats))
 
 
-def calculate_monthly_low_high(package, dates):
-    """returns a tuple of (min, max) for number of memberships in the date range of dates"""
-    high = 0
-    low = 100000000
-    for working_date in dates:
-        num_residents = User.helper.members_by_package(package, working_date).count()
-        high = max(high, num_residents)
-        low = min(low, num_residents)
-        avg = int(round((low + high) / 2))
+def calculate_monthly_low_high(stats, package):
+    """returns a tuple of (min, max, avg) for number of members of the package in the given DailyStats"""
+    counts = [d.package_members(package.name) for d in stats] or [0]
+    low = min(counts)
+    high = max(counts)
+    avg = int(round((low + high) / 2))
     return (low, high, avg)
 
 
@@ -85,20 +83,20 @@ def p(p, w):
 
 @staff_member_required
 def daily(request):
-    # Group the daily logs into months
+    # Group the daily stats into months
     daily_logs_by_month = []
-    number_dict = {'month': 'firstrun'}
-    for daily_log in CoworkingDay.objects.all().order_by('visit_date').reverse():
-        month = '%(year)i-%(month)i' % {'year': daily_log.visit_date.year, "month": daily_log.visit_date.month}
-        if number_dict['month'] != month:
-            if number_dict['month'] != 'firstrun':
-                daily_logs_by_month.append(number_dict)
-            number_dict = {'month': month, 'Bill': 0, 'Trial': 0, 'Waive': 0, 'total': 1}
-            number_dict[daily_log.payment] = 1
-        else:
-            number_dict['total'] = number_dict['total'] + 1
-            if daily_log.payment in number_dict:
-                number_dict[daily_log.payment] = number_dict[daily_log.payment] + 1
+    first_day = DailyStats.objects.first_day()
+    if first_day:
+        stats = DailyStats.objects.for_range(first_day, localtime(now()).date())
+        for day in reversed([d for d in stats if d.coworking_days > 0]):
+            month = '%(year)i-%(month)i' % {'year': day.day.year, "month": day.day.month}
+            if not daily_logs_by_month or daily_logs_by_month[-1]['month'] != month:
+                daily_logs_by_month.append({'month': month, 'Bill': 0, 'Trial': 0, 'Waive': 0, 'total': 0})
+            number_dict = daily_logs_by_month[-1]
+            number_dict['total'] = number_dict['total'] + day.coworking_days
+            number_dict['Bill'] = number_dict['Bill'] + day.billed_days
+            number_dict['Trial'] = number_dict['Trial'] + day.trial_days
+            number_dict['Waive'] = number_dict['Waive'] + day.waived_days
 
     return render(request, 'staff/stats/daily.html', {'daily_logs_by_month': daily_logs_by_month})
 
@@ -125,17 +123,18 @@ def memberships(request):
         month_histories.append(month_history)
         working_month = working_month + timedelta(days=month_history.days_in_month)
 
+    stats = list(DailyStats.objects.for_range(month_histories[0].start_date, month_histories[-1].end_date))
+    packages = list(MembershipPackage.objects.filter(enabled=True))
     for month in month_histories:
-        dates = [date(month.year, month.month, i) for i in range(1, month.days_in_month + 1)]
-
-        for package in MembershipPackage.objects.filter(enabled=True):
-            data = calculate_monthly_low_high(package, dates)
+        month_stats = [d for d in stats if month.start_date <= d.day <= month.end_date]
+        for package in packages:
+            data = calculate_monthly_low_high(month_stats, package)
             if average_only:
                 month.data[package.name] = data[2]
             else:
                 month.data[package.name] = '%s - %s' % (data[0], data[1])
 
-        month.data['visits'], month.data['trial'], month.data['waive'], month.data['billed'] = calculate_dropins(month.start_date, month.end_date)
+        month.data['visits'], month.data['trial'], month.data['waive'], month.data['billed'] = calculate_dropins(month_stats)
 
         year_histories = []
         current_year = -1
@@ -154,12 +153,13 @@ def memberships(request):
 def history(request):
     date_range_form = DateRangeForm.from_request(request, days=365)
     start_date, end_date = date_range_form.get_dates()
-    logs = [log for log in Membership.objects.all()]
     monthly_stats = [{'start_date': d, 'end_date': beginning_of_next_month(d) - timedelta(days=1)} for d in first_days_in_months(start_date, end_date)]
+    stats = list(DailyStats.objects.for_range(monthly_stats[0]['start_date'], monthly_stats[-1]['end_date']))
     for stat in monthly_stats:
-        stat['monthly_total'] = Membership.objects.active_memberships(stat['end_date']).count()
-        stat['started'] = Membership.objects.date_range(start=stat['start_date'], end=stat['end_date'], action='started').count()
-        stat['ended'] = Membership.objects.date_range(start=stat['start_date'], end=stat['end_date'], action='ended').count()
+        month_stats = [d for d in stats if stat['start_date'] <= d.day <= stat['end_date']]
+        stat['monthly_total'] = month_stats[-1].memberships
+        stat['started'] = sum(d.started for d in month_stats)
+        stat['ended'] = sum(d.ended for d in month_stats)
     monthly_stats.reverse()
     context = {'monthly_stats': monthly_stats,
                'date_range_form': date_range_form,
@@ -292,15 +292,16 @@ def graph(request):
     date_range_form = DateRangeForm.from_request(request, days=30)
     start_date, end_date = date_range_form.get_dates()
     days = [{'date': start_date + timedelta(days=i)} for i in range((end_date - start_date).days)]
+    stats = {d.day: d for d in DailyStats.objects.for_range(start_date, end_date)}
     if graph == "members":
         title = "Members by Day"
-        min_v, max_v, avg_v, days = graph_members(days)
+        min_v, max_v, avg_v, days = graph_members(days, stats)
     elif graph == "income":
         title = "Monthly Membership Income by Day"
-        min_v, max_v, avg_v, days = graph_income(days)
+        min_v, max_v, avg_v, days = graph_income(days, stats)
     elif graph == "amv":
         title = "Average Monthly Value"
-        min_v, max_v, avg_v, days = graph_members(days)
+        min_v, max_v, avg_v, days = graph_members(days, stats)
     elif graph == "churn":
         title = "Membership Churn"
     context = {
@@ -314,12 +315,12 @@ def graph(request):
     return render(request, 'staff/stats/graph.html', context)
 
 
-def graph_members(days):
+def graph_members(days, stats):
     member_min = 0
     member_max = 0
     member_total = 0
     for day in days:
-        day['value'] = Membership.objects.active_memberships(day['date']).count()
+        day['value'] = stats[day['date']].memberships
         member_total = member_total + day['value']
         if day['value'] > member_max:
             member_max = day['value']
@@ -329,16 +330,13 @@ def graph_members(days):
     return (member_min, member_max, member_avg, days)
 
 
-def graph_income(days):
+def graph_income(days, stats):
     income_min = 0
     income_max = 0
     income_total = 0
     for day in days:
-        membership_count = 0
-        membership_income = 0
-        for membership in Membership.objects.active_memberships(day['date']):
-            membership_count = membership_count + 1
-            membership_income = membership_income + membership.monthly_rate()
+        membership_count = stats[day['date']].memberships
+        membership_income = stats[day['date']].monthly_revenue
         income_total = income_total + membership_income
         if membership_income > income_max:
             income_max = membership_income
@@ -350,13 +348,13 @@ def graph_income(days):
     return (income_min, income_max, income_avg, days)
 
 
-def graph_amv(days):
+def graph_amv(days, stats):
     min_v = max_v = avg_v = 100
     member_min = 0
     member_max = 0
     member_total = 0
     for day in days:
-        day['value'] = Membership.objects.active_memberships(day['date']).count()
+        day['value'] = stats[day['date']].memberships
         member_total = member_total + day['value']
         if day['value'] > member_max:
             member_max = day['value']